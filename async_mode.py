@@ -0,0 +1,80 @@
+import os
+import sys
+
+
+"""
+Cooperative (gevent) server mode.
+
+With SERVER_MODE=async, gunicorn runs gevent workers (see gunicorn_config.py)
+that each serve up to ASYNC_WORKER_CONNECTIONS requests at once. gevent
+patches the standard library so that socket I/O, and therefore redis-py and
+requests, yields to other greenlets instead of blocking; patch_psycopg2 does
+the same for Postgres queries. One process can then hold hundreds of
+conversations that are waiting on Postgres, Redis or the Graph API.
+
+The handlers are unchanged: state kept per thread (the database session,
+current_user, budgets and tracing) is kept per greenlet once threading is
+patched. Queries still wait for one of the DB_POOL_SIZE + DB_MAX_OVERFLOW
+connections, so raise those along with ASYNC_WORKER_CONNECTIONS.
+
+The test suite runs in this mode with:
+
+    python async_mode.py test
+"""
+SERVER_MODE = os.environ.get("SERVER_MODE", "sync")
+ASYNC_WORKER_CONNECTIONS = int(os.environ.get("ASYNC_WORKER_CONNECTIONS", 500))
+
+
+def enabled():
+    return SERVER_MODE == "async"
+
+
+def patch():
+    """
+    Make blocking I/O cooperative. Must run before anything else is imported,
+    gunicorn's gevent worker does the equivalent of the first step itself.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    patch_psycopg2()
+
+
+def patch_psycopg2():
+    """
+    Have psycopg2 wait for the server through gevent instead of blocking the
+    process, see http://initd.org/psycopg/docs/advanced.html#support-for-coroutine-libraries
+    """
+    try:
+        from psycopg2 import extensions
+    except ImportError:
+        # Not using Postgres, e.g. tests against SQLite.
+        return
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from psycopg2 import extensions, OperationalError
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError("Bad result from poll: %r" % state)
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    """
+    Run a unittest module (e.g. test) with cooperative I/O.
+    """
+    patch()
+    import unittest
+    unittest.main(module=sys.argv[1], argv=sys.argv[:1] + sys.argv[2:])
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from urllib.parse import urlsplit
+
+import requests
+
+import core
+import graph_delivery
+import metrics
+
+
+"""
+Reusable image attachments for facts.
+
+An image is uploaded once through the Attachment Upload API and the returned
+attachment_id is stored on the fact; study prompts send the id, so Facebook
+doesn't fetch the image again for every prompt or reminder. See
+https://developers.facebook.com/docs/messenger-platform/send-messages/saving-assets
+
+Uploads are remembered by the SHA-256 of the image under ATTACHMENT_KEY, so
+the same image (e.g. forwarded again, or used for several facts) is only
+uploaded once. The keys expire after ATTACHMENT_EXPIRATION_IN_SECONDS
+without being reused, so the dedup cache doesn't grow without bound. The images users send are fetched right away, because the
+URLs Messenger gives us expire. Only https URLs on Facebook's CDN hosts
+(ATTACHMENT_HOSTS and their subdomains) are fetched, and redirects aren't
+followed, so a forged webhook can't make us request internal addresses.
+
+webhook_replay.py's Graph API stub accepts uploads, for local runs and tests.
+"""
+ATTACHMENT_UPLOAD_URL = core.GRAPH_API_URL + "me/message_attachments"
+ATTACHMENT_KEY = "attachments:sha256:%s"
+ATTACHMENT_EXPIRATION_IN_SECONDS = int(os.environ.get("ATTACHMENT_EXPIRATION_IN_SECONDS", 30 * 24 * 3600))
+ATTACHMENT_MAX_BYTES = int(os.environ.get("ATTACHMENT_MAX_BYTES", 8 * 1024 * 1024))
+ATTACHMENT_HOSTS = os.environ.get("ATTACHMENT_HOSTS", "fbcdn.net,fbsbx.com").split(",")
+
+
+class AttachmentError(Exception):
+    """The image couldn't be fetched or uploaded"""
+    pass
+
+
+def image_url(message):
+    """Return the URL of the first image attached to a webhook message, if any"""
+    for attachment in message.get("attachments", []):
+        if attachment.get("type") == "image" and attachment.get("payload", {}).get("url"):
+            return attachment["payload"]["url"]
+    return None
+
+
+def is_fetchable(url):
+    """Whether url is an https URL on one of ATTACHMENT_HOSTS or their subdomains"""
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return False
+    if parts.scheme != "https" or not host:
+        return False
+    return any(host == allowed or host.endswith("." + allowed) for allowed in ATTACHMENT_HOSTS)
+
+
+def fetch_image(url, session=None):
+    """Return (content, content_type) of the image at url"""
+    session = core.graph_session if session is None else session
+    if not is_fetchable(url):
+        raise AttachmentError("not fetching image from %s" % url)
+    try:
+        response = session.get(url, stream=True, allow_redirects=False,
+                               timeout=(graph_delivery.GRAPH_CONNECT_TIMEOUT_SECONDS,
+                                        graph_delivery.GRAPH_READ_TIMEOUT_SECONDS))
+        if response.status_code != requests.codes.ok:
+            raise AttachmentError("status %d fetching image" % response.status_code)
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > ATTACHMENT_MAX_BYTES:
+                raise AttachmentError("image is larger than %d bytes" % ATTACHMENT_MAX_BYTES)
+    except requests.RequestException as e:
+        raise AttachmentError("%s: %s" % (type(e).__name__, e))
+    return b"".join(chunks), response.headers.get("Content-Type", "image/jpeg")
+
+
+def upload_image(content, content_type, client=None, session=None):
+    """
+    Return a reusable attachment_id for the image, uploading it only if the
+    same content hasn't been uploaded before.
+    """
+    client = core.cache if client is None else client
+    session = core.graph_session if session is None else session
+    digest = hashlib.sha256(content).hexdigest()
+    key = ATTACHMENT_KEY % digest
+    try:
+        pipe = client.pipeline()
+        pipe.get(key)
+        pipe.expire(key, ATTACHMENT_EXPIRATION_IN_SECONDS)
+        attachment_id, _ = pipe.execute()
+    except Exception as e:
+        print("ERROR: Failed to look up attachment %s, uploading it" % digest)
+        print("ERROR: Reason: %s" % str(e))
+        attachment_id = None
+    if attachment_id is not None:
+        metrics.incr("attachments.reused")
+        return attachment_id.decode("utf-8")
+
+    message = {"attachment": {"type": "image", "payload": {"is_reusable": True}}}
+    try:
+        response = graph_delivery.request(session, "POST", ATTACHMENT_UPLOAD_URL,
+                                          params={"access_token": core.get_page_access_token()},
+                                          data={"message": json.dumps(message)},
+                                          files={"filedata": (digest, content, content_type)})
+    except graph_delivery.GraphUnavailable as e:
+        raise AttachmentError(str(e))
+    if response.status_code != requests.codes.ok:
+        raise AttachmentError("upload rejected: %s" % response.text)
+
+    attachment_id = json.loads(response.text)["attachment_id"]
+    metrics.incr("attachments.uploaded")
+    try:
+        client.set(key, attachment_id, ex=ATTACHMENT_EXPIRATION_IN_SECONDS)
+    except Exception as e:
+        print("ERROR: Failed to remember attachment %s" % digest)
+        print("ERROR: Reason: %s" % str(e))
+    return attachment_id
+
+
+def attach_image(fact, url, client=None, session=None):
+    """
+    Fetch the image at url, upload it if needed and attach it to fact.
+    Returns False if that failed.
+    """
+    try:
+        content, content_type = fetch_image(url, session)
+        fact.attachment_id = upload_image(content, content_type, client, session)
+    except AttachmentError as e:
+        print("ERROR: Failed to attach image %s" % url)
+        print("ERROR: Reason: %s" % str(e))
+        return False
+    return True
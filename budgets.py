@@ -0,0 +1,229 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import contextlib
+import functools
+import threading
+
+import requests
+
+import metrics
+import tracing
+
+
+"""
+Per-event budgets for SQL statements, Redis round trips and Graph API calls.
+
+handle_message_event tracks every webhook event. While an event is tracked,
+SQL statements are counted through a SQLAlchemy engine event, Redis round
+trips through CountingRedis (core.cache wraps its client in one), and Graph
+API calls through CountingSession (core.graph_session). The same wrappers
+give Redis and Graph calls their spans when tracing is on (see tracing.py).
+
+An event's budget is looked up by its flow: the intent for messages in the
+DEFAULT state, otherwise the name of the conversation state. Events that go
+over budget are logged and counted as budget.exceeded; the tests assert the
+same budgets so a flow that quietly gains queries fails the suite.
+"""
+# Flows that read the due queue allow for it being rebuilt (1 query, 2 round trips).
+EVENT_BUDGETS = {
+    "add_fact": {"sql": 2, "redis": 2, "graph": 1},
+    # Note: view_facts sends one message per fact, so Graph calls aren't budgeted.
+    #   The due count is one read of the due_counts rollup.
+    "view_facts": {"sql": 3, "redis": 1},
+    # Note: Facts with an image send it as a message of its own.
+    "study_next_fact": {"sql": 3, "redis": 5, "graph": 2},
+    "EXPECTING_FACT_QUESTION": {"sql": 1, "redis": 2, "graph": 1},
+    "EXPECTING_FACT_ANSWER": {"sql": 6, "redis": 9, "graph": 1},
+    "EXPECTING_STUDY_ANSWER": {"sql": 3, "redis": 5, "graph": 1},
+    "EXPECTING_STUDY_PERF_RATING": {"sql": 7, "redis": 10, "graph": 1}
+}
+
+_local = threading.local()
+
+
+class Usage:
+    """What a single event used"""
+    def __init__(self, flow):
+        self.flow = flow
+        self.intent = flow
+        self.sql = 0
+        self.redis = 0
+        self.graph = 0
+        self.statements = []
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'flow': self.flow,
+            'intent': self.intent,
+            'sql': self.sql,
+            'redis': self.redis,
+            'graph': self.graph
+        }
+
+    def over_budget(self, budgets=None):
+        """Return the names of the counts that exceed the flow's budget"""
+        budget = (EVENT_BUDGETS if budgets is None else budgets).get(self.flow)
+        if budget is None:
+            return []
+        return [kind for kind in ("sql", "redis", "graph") if kind in budget and getattr(self, kind) > budget[kind]]
+
+
+@contextlib.contextmanager
+def track(flow, deferred=None):
+    """
+    Count what the current thread uses until the block exits. If deferred is
+    given the usage is appended to it instead of being reported, so that work
+    the event leaves for later can be counted first (see attribute).
+    """
+    usage = Usage(flow)
+    previous = getattr(_local, "usage", None)
+    _local.usage = usage
+    try:
+        yield usage
+    finally:
+        _local.usage = previous
+        if deferred is None:
+            report(usage)
+        else:
+            deferred.append(usage)
+
+
+def current():
+    """The usage being tracked by this thread, if any"""
+    return getattr(_local, "usage", None)
+
+
+@contextlib.contextmanager
+def attribute(usage):
+    """Count what the current thread uses in the block towards usage"""
+    previous = getattr(_local, "usage", None)
+    _local.usage = usage
+    try:
+        yield usage
+    finally:
+        _local.usage = previous
+
+
+def set_flow(flow):
+    usage = getattr(_local, "usage", None)
+    if usage is not None:
+        usage.flow = flow
+
+
+def count(kind, statement=None):
+    usage = getattr(_local, "usage", None)
+    if usage is not None:
+        setattr(usage, kind, getattr(usage, kind) + 1)
+        if statement is not None:
+            usage.statements.append(statement)
+
+
+@contextlib.contextmanager
+def capture(usages=None):
+    """
+    Collect the usage of every event tracked by this thread in the block.
+    Pass the list of another thread's capture to add to it.
+    """
+    usages = [] if usages is None else usages
+    previous = getattr(_local, "captured", None)
+    _local.captured = usages
+    try:
+        yield usages
+    finally:
+        _local.captured = previous
+
+
+def report(usage):
+    for kind in ("sql", "redis", "graph"):
+        metrics.observe("budget.%s.%s" % (usage.flow, kind), getattr(usage, kind))
+    exceeded = usage.over_budget()
+    if exceeded:
+        metrics.incr("budget.exceeded")
+        print("ERROR: Event %s went over budget on %s: %s" %
+              (usage.flow, ", ".join(exceeded), usage.serialize))
+    captured = getattr(_local, "captured", None)
+    if captured is not None:
+        captured.append(usage)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    count("sql", statement)
+
+
+class CountingRedis:
+    """Redis client wrapper that counts round trips"""
+    def __init__(self, client):
+        self._client = client
+
+    def pipeline(self, *args, **kwargs):
+        return _CountingPipeline(self._client.pipeline(*args, **kwargs))
+
+    def transaction(self, func, *watches, **kwargs):
+        def counted(pipe):
+            # WATCH before and EXEC after func are sent by the client itself.
+            count("redis")
+            count("redis")
+            return func(_CountingPipeline(pipe))
+        with tracing.span("redis transaction"):
+            return self._client.transaction(counted, *watches, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def counted(*args, **kwargs):
+            count("redis")
+            with tracing.span("redis " + name):
+                return attr(*args, **kwargs)
+        return counted
+
+
+class _CountingPipeline:
+    """
+    Counts one round trip per execute(), plus one per command sent while the
+    pipeline is watching keys (immediate mode).
+    """
+    BUFFERED = ("multi", "execute", "reset")
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pipe.reset()
+
+    def execute(self, *args, **kwargs):
+        count("redis")
+        with tracing.span("redis pipeline", commands=len(self._pipe.command_stack)):
+            return self._pipe.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipe, name)
+        if not callable(attr) or name in self.BUFFERED:
+            return attr
+
+        @functools.wraps(attr)
+        def counted(*args, **kwargs):
+            if name == "watch" or (self._pipe.watching and not self._pipe.explicit_transaction):
+                count("redis")
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingSession(requests.Session):
+    """requests.Session that counts Graph API calls"""
+    def request(self, method, url, *args, **kwargs):
+        count("graph")
+        with tracing.span("graph " + method, url=url.split("?")[0]) as span:
+            response = super(CountingSession, self).request(method, url, *args, **kwargs)
+            if span is not None:
+                span.attributes["status_code"] = response.status_code
+            return response
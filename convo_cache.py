@@ -0,0 +1,198 @@
+from collections import OrderedDict
+
+import os
+import threading
+import time
+import uuid
+
+import metrics
+
+
+"""
+Two-tier cache of conversation states: a bounded in-process L1 in front of
+Redis.
+
+Every state a process stores is kept in its L1 as well as written to Redis,
+and the write is announced on INVALIDATION_CHANNEL in the same round trip.
+Web workers run a listener (started by gunicorn_config.py) that drops L1
+entries when another process announces a write, so consecutive messages from
+a user that reach the same worker are served from memory. L1 entries are
+only used while the listener is subscribed and for at most
+CONVO_CACHE_TTL_SECONDS; processes without a listener always read Redis.
+
+If Redis can't be reached, reads fall back to the L1 entry for as long as
+it would have been kept in Redis, and writes are kept in the L1 and written
+to Redis on the next read once it is back. A user only loses their place in
+a flow if Redis is down and their state isn't in this worker's L1.
+
+Hits, misses and stale reads are counted as convo_cache.hits,
+convo_cache.misses and convo_cache.stale_hits.
+"""
+CONVO_CACHE_SIZE = int(os.environ.get("CONVO_CACHE_SIZE", 10000))
+CONVO_CACHE_TTL_SECONDS = int(os.environ.get("CONVO_CACHE_TTL_SECONDS", 60))
+CONVO_CACHE_RECONNECT_SECONDS = int(os.environ.get("CONVO_CACHE_RECONNECT_SECONDS", 1))
+INVALIDATION_CHANNEL = "convo_state:invalidate"
+
+
+class _Entry:
+    __slots__ = ("value", "stored_at", "expires_at", "dirty")
+
+    def __init__(self, value, stored_at, expires_at, dirty=False):
+        self.value = value
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.dirty = dirty
+
+
+class LocalCache:
+    """Bounded LRU map of Redis keys to the values this process last saw"""
+    def __init__(self, size=CONVO_CACHE_SIZE, clock=time.time):
+        self.size = size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the entry for key unless it has expired, otherwise None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, ex):
+        now = self.clock()
+        entry = _Entry(value, now, now + ex)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_clean(self):
+        """Forget every entry that has been written to Redis"""
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if not entry.dirty]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_entries = LocalCache()
+_subscribed = threading.Event()
+_listener = None
+_origin = None
+
+
+def origin():
+    """Identifies this process in invalidations, so it ignores its own writes"""
+    global _origin
+    if _origin is None or _origin[0] != os.getpid():
+        _origin = (os.getpid(), uuid.uuid4().hex)
+    return _origin[1]
+
+
+def load(client, key, ex):
+    """
+    Return the value stored under key, or None. Raises if neither Redis nor
+    the L1 has it and Redis can't be reached. ex is the expiration the value
+    was stored with, an entry read from Redis is kept for stale reads for at
+    most that long.
+    """
+    entry = _entries.get(key)
+    if (entry is not None and entry.dirty):
+        # Stored while Redis was down, so it's newer than what Redis has.
+        _write(client, key, entry)
+        metrics.incr("convo_cache.hits")
+        return entry.value
+    if (entry is not None and _subscribed.is_set() and
+            _entries.clock() - entry.stored_at < CONVO_CACHE_TTL_SECONDS):
+        metrics.incr("convo_cache.hits")
+        return entry.value
+
+    metrics.incr("convo_cache.misses")
+    try:
+        value = client.get(key)
+    except Exception:
+        if (entry is None):
+            raise
+        print("ERROR: Redis unavailable, using the local convo state for %s" % key)
+        metrics.incr("convo_cache.stale_hits")
+        return entry.value
+
+    if (value is None):
+        _entries.discard(key)
+    else:
+        _entries.put(key, value, ex)
+    return value
+
+
+def store(client, key, value, ex):
+    """Store value under key in the L1 and Redis. Redis errors are logged, not raised."""
+    _write(client, key, _entries.put(key, value, ex))
+
+
+def _write(client, key, entry):
+    ex = max(int(entry.expires_at - _entries.clock()), 1)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.set(key, entry.value, ex=ex)
+        pipe.publish(INVALIDATION_CHANNEL, "%s %s" % (origin(), key))
+        pipe.execute()
+        entry.dirty = False
+    except Exception as e:
+        print("ERROR: Failed to store convo state for %s, keeping it locally" % key)
+        print("ERROR: Reason: %s" % str(e))
+        entry.dirty = True
+
+
+def handle_invalidation(data):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    sender, key = data.split(" ", 1)
+    if (sender != origin()):
+        _entries.discard(key)
+
+
+def listen(client):
+    """Apply invalidations from other processes, resubscribing after errors"""
+    while True:
+        try:
+            pubsub = client.pubsub()
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                if message["type"] == "subscribe":
+                    # Invalidations may have been missed while unsubscribed.
+                    _entries.discard_clean()
+                    _subscribed.set()
+                elif message["type"] == "message":
+                    handle_invalidation(message["data"])
+        except Exception as e:
+            print("ERROR: Convo state invalidation listener disconnected")
+            print("ERROR: Reason: %s" % str(e))
+        _subscribed.clear()
+        time.sleep(CONVO_CACHE_RECONNECT_SECONDS)
+
+
+def start_listener(client):
+    """Start the invalidation listener of this process, once"""
+    global _listener
+    if (CONVO_CACHE_SIZE <= 0):
+        return
+    if (_listener is None or not _listener.is_alive()):
+        _listener = threading.Thread(target=listen, args=(client,), name="convo-cache-listener", daemon=True)
+        _listener.start()
@@ -0,0 +1,1024 @@
+from sqlalchemy import (Column, Integer, BigInteger, SmallInteger, String, DateTime,
+                        ForeignKey, Index, CheckConstraint, create_engine, func, text)
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, backref, load_only, scoped_session, sessionmaker, Session
+from sqlalchemy.util import ThreadLocalRegistry
+from datetime import datetime, timedelta, timezone
+from dateutil import parser
+
+import functools
+import json
+import requests
+import os
+import enum
+import threading
+import time
+
+import budgets
+import convo_cache
+import due_queue
+import graph_delivery
+import metrics
+
+
+"""
+Core StudyBot functionality shared by the webhook, workers and cron jobs.
+
+Nothing in here imports a web framework and no connection is opened at import
+time: the database engine and the Redis client are created on first use, so
+every entry point only pays for the connections it actually needs.
+"""
+
+#===============================================================================
+# Constants
+#===============================================================================
+# See https://developers.facebook.com/docs/messenger-platform/reference/send-api
+# Note: Point this at a stub (see webhook_replay.py) when replaying traffic locally.
+GRAPH_API_URL = os.environ.get("GRAPH_API_URL", "https://graph.facebook.com/v2.6/")
+SEND_API_URL = GRAPH_API_URL + "me/messages"
+# Used in greetings when the user's profile can't be fetched.
+FALLBACK_FIRSTNAME = "there"
+
+RANDOM_PHRASES = [
+    "Hey %s, how the heck are ya? Me, you ask? I'm feeling a little blue. :)",
+    "Studying again %s? Look at you! We gotta future Rhodes scholar here!",
+    "You want to study right now, %s? Nerd Alert! Nerds are so in right now!"
+]
+
+USAGE_INSTRUCTIONS = ("Below is a list of my primary functionality:\n" +
+    "- 'I want to add a fact.'\n" +
+    "- 'I want to view all facts.'\n" +
+    "- 'I want to change a fact.'\n" +
+    "- 'I want to delete a fact.'\n" +
+    "- 'Delete facts 10-20.' or 'Reset progress on all facts.'\n" +
+    "- 'I want to study.'\n" +
+    "- 'I want to silence studying for x days.'\n")
+
+"""
+Note: This is a trade-off between "precision" and "recall" as discussed here:
+https://wit.ai/docs/recipes#which-confidence-threshold-should-i-use
+"""
+MIN_CONFIDENCE_THRESHOLD = 0.7
+
+# Value described by the SM2 Algorithm.
+DEFAULT_EASINESS = 2.5
+
+# Easiness is stored in hundredths; every SM2 adjustment is a whole number of them.
+EASINESS_SCALE = 100
+
+# Due dates are stored as whole days since this date (UTC).
+DUE_DAY_EPOCH = datetime(1970, 1, 1)
+
+# due_counts rows with the number of facts due per day for all users.
+GLOBAL_USER_ID = 0
+
+# Expire cached entries after 5 minutes
+CACHE_EXPIRATION_IN_SECONDS = 300
+
+# FB Message Post Max Length
+FB_MAX_MESSAGE_LENGTH = 640
+
+# Database connection pool settings.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+# Buffer review results in Redis and apply them to the facts table later.
+REVIEW_WRITE_BEHIND = os.environ.get("REVIEW_WRITE_BEHIND", "false").lower() == "true"
+
+# How long to send read-only queries to the primary after the replica failed.
+DB_REPLICA_RETRY_SECONDS = int(os.environ.get("DB_REPLICA_RETRY_SECONDS", 30))
+
+
+#===============================================================================
+# Connections
+#===============================================================================
+class _PrimarySession(Session):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return db.engine
+
+    def has_writes(self):
+        """Whether the session has changes that the replica may not have yet"""
+        return bool(self.info.get("has_writes") or self.new or self.dirty or self.deleted)
+
+
+@event.listens_for(_PrimarySession, "after_flush")
+def _flushed(session, flush_context):
+    session.info["has_writes"] = True
+
+
+@event.listens_for(_PrimarySession, "do_orm_execute")
+def _executed(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["has_writes"] = True
+
+
+class _ReplicaSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return db.replica_engine
+
+
+class _RoutingRegistry:
+    """
+    Thread-local sessions for db.session: the replica's inside read_only,
+    otherwise the primary's.
+    """
+    def __init__(self):
+        self.primary = ThreadLocalRegistry(sessionmaker(class_=_PrimarySession))
+        self.replica = ThreadLocalRegistry(sessionmaker(class_=_ReplicaSession))
+        self.local = threading.local()
+
+    @property
+    def reading_replica(self):
+        return getattr(self.local, "reading_replica", False)
+
+    @reading_replica.setter
+    def reading_replica(self, value):
+        self.local.reading_replica = value
+
+    def _current(self):
+        return self.replica if self.reading_replica else self.primary
+
+    def __call__(self):
+        return self._current()()
+
+    def has(self):
+        return self._current().has()
+
+    def set(self, session):
+        self._current().set(session)
+
+    def clear(self):
+        self._current().clear()
+
+
+def engine_options(url):
+    """
+    Return the create_engine keyword arguments for the configured pool.
+    """
+    options = {
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE_SECONDS
+    }
+    if url.startswith("postgres"):
+        options["pool_size"] = DB_POOL_SIZE
+        options["max_overflow"] = DB_MAX_OVERFLOW
+        if DB_STATEMENT_TIMEOUT_MS:
+            options["connect_args"] = {"options": "-c statement_timeout=%d" % DB_STATEMENT_TIMEOUT_MS}
+    return options
+
+
+class Database:
+    """
+    Lazily configured SQLAlchemy engines and thread-local session.
+
+    The engines are only created (and DATABASE_URL/DATABASE_REPLICA_URL only
+    read) the first time a query needs a connection. Queries made inside
+    functions decorated with read_only go to the replica when one is
+    configured and healthy, through a separate session (see read_only).
+    """
+    def __init__(self):
+        self._engine = None
+        self._replica_engine = None
+        self._replica_down_until = 0
+        self._lock = threading.Lock()
+        self.registry = _RoutingRegistry()
+        self.session = scoped_session(sessionmaker(class_=_PrimarySession))
+        self.session.registry = self.registry
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    url = os.environ['DATABASE_URL']
+                    self._engine = create_engine(url, **engine_options(url))
+        return self._engine
+
+    @property
+    def replica_engine(self):
+        if self._replica_engine is None:
+            with self._lock:
+                if self._replica_engine is None:
+                    url = os.environ['DATABASE_REPLICA_URL']
+                    self._replica_engine = create_engine(url, **engine_options(url))
+        return self._replica_engine
+
+    def replica_available(self):
+        if not os.environ.get("DATABASE_REPLICA_URL"):
+            return False
+        return time.time() >= self._replica_down_until
+
+    def mark_replica_down(self):
+        self._replica_down_until = time.time() + DB_REPLICA_RETRY_SECONDS
+        metrics.incr("db.replica_fallbacks")
+
+    def create_all(self):
+        Model.metadata.create_all(bind=self.engine)
+
+    def drop_all(self):
+        Model.metadata.drop_all(bind=self.engine)
+
+
+class LazyRedis:
+    """
+    Proxy that creates the Redis client from REDIS_URL on first use.
+    """
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import redis
+                    self._client = budgets.CountingRedis(redis.from_url(os.environ.get("REDIS_URL")))
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+
+def read_only(func):
+    """
+    Route the queries made by func to the read replica, on a session of its
+    own that is closed afterwards, so the objects returned are detached. If
+    the replica can't be reached, it is skipped for DB_REPLICA_RETRY_SECONDS
+    and func is retried on the primary; the caller's transaction is left
+    alone either way.
+
+    Reads stay on the primary while the caller's session has written anything
+    (even if it was committed since), since the replica may not have it yet.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if (not db.replica_available() or db.registry.reading_replica or
+                (db.registry.primary.has() and db.session().has_writes())):
+            return func(*args, **kwargs)
+
+        db.registry.reading_replica = True
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            print("ERROR: Read replica unavailable, falling back to primary.")
+            print("ERROR: Reason: %s" % str(e))
+            db.mark_replica_down()
+        finally:
+            db.session.remove()
+            db.registry.reading_replica = False
+        return func(*args, **kwargs)
+    return wrapper
+
+
+db = Database()
+
+cache = LazyRedis()
+
+# Shared so Graph API calls reuse keep-alive connections instead of paying
+# for a new TLS handshake on every request.
+graph_session = budgets.CountingSession()
+
+
+#===============================================================================
+# DB Classes
+#===============================================================================
+Model = declarative_base()
+Model.query = db.session.query_property()
+
+
+class User(Model):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    fb_id = Column(String, unique=True)
+    silence_end_time = Column(DateTime)
+    # Kept up to date by adjust_fact_counts, see migrate_fact_counts.py.
+    fact_count = Column(Integer, nullable=False, default=0, server_default='0')
+    unstudied_fact_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # Note: Fact queries don't join users; load the owner on access if needed.
+    # Listing paths query facts directly with only the columns they display,
+    # see list_user_facts.
+    facts = relationship('Fact', lazy='select', backref=backref('users', lazy='select'))
+
+    def __init__(self, fb_id):
+        self.fb_id = fb_id
+
+    def __repr__(self):
+        return '<FB ID %r>' % self.fb_id
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'id': self.id,
+            'fb_id': self.fb_id,
+            'silence_end_time': self.serialize_date_time,
+            'fact_count': self.fact_count,
+            'unstudied_fact_count': self.unstudied_fact_count,
+            'facts': self.serialize_one2many
+        }
+
+    @property
+    def serialize_one2many(self):
+       """
+       Return object's relations in easily serializeable format.
+       NB! Calls many2many's serialize property.
+       """
+       return [item.serialize for item in self.facts]
+
+    def serialize_date_time(self):
+        if isinstance(self.silence_end_time, datetime):
+            return self.silence_end_time.isoformat()
+        return None
+
+def to_due_day(due_date):
+    """Return the day number of a due date. Naive datetimes are taken to be in UTC."""
+    if due_date.tzinfo is not None:
+        due_date = due_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return (due_date - DUE_DAY_EPOCH).days
+
+
+def from_due_day(due_day):
+    """Return the start of a day number as a naive UTC datetime"""
+    return DUE_DAY_EPOCH + timedelta(days=due_day)
+
+
+class CompactSchedule:
+    """
+    easiness and next_due_date on top of the compact scheduling columns
+    (easiness_hundredths and due_day), for facts and detached copies of their
+    schedule.
+    """
+    @property
+    def easiness(self):
+        if self.easiness_hundredths is None:
+            return None
+        return self.easiness_hundredths / EASINESS_SCALE
+
+    @easiness.setter
+    def easiness(self, value):
+        self.easiness_hundredths = None if value is None else int(round(float(value) * EASINESS_SCALE))
+
+    @property
+    def next_due_date(self):
+        if self.due_day is None:
+            return None
+        return from_due_day(self.due_day)
+
+    @next_due_date.setter
+    def next_due_date(self, value):
+        self.due_day = None if value is None else to_due_day(value)
+
+
+class Fact(CompactSchedule, Model):
+    """
+    A question and answer with its SM2 schedule. Easiness is stored as a
+    SMALLINT of hundredths and the next due date as an INTEGER day number
+    (see migrate_schedule.py); the easiness and next_due_date properties
+    convert to and from the values used elsewhere.
+    """
+    __tablename__ = 'facts'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    question = Column(String, unique=True)
+    answer = Column(String, nullable=False)
+    easiness_hundredths = Column(SmallInteger, nullable=True, default=int(DEFAULT_EASINESS * EASINESS_SCALE))
+    consecutive_correct_answers = Column(SmallInteger, nullable=False, default=0)
+    last_seen = Column(DateTime, nullable=False, default=datetime.utcnow)
+    due_day = Column(Integer)
+    # Days from the previous review (or creation) to due_day, as logged in
+    #   reviews.previous_interval. NULL for facts from before it was kept.
+    interval_days = Column(Integer, default=1)
+    # When the fact was first reviewed, NULL only for facts that were never
+    #   studied (see users.unstudied_fact_count).
+    first_reviewed_at = Column(DateTime)
+    # Reusable Messenger attachment of the fact's image, see attachments.py.
+    attachment_id = Column(String)
+    __table_args__ = (
+        Index('user_id_question', 'user_id', text("lower(question)")),
+        CheckConstraint('easiness_hundredths >= 0', name='check_easiness')
+    )
+
+    def __repr__(self):
+        return '<Fact %d: Q: %s A: %s>' % (self.user_id, self.question, self.answer)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'question': self.question,
+            'answer': self.answer,
+            'easiness': self.serialize_numeric(),
+            'consecutive_correct_answers': self.consecutive_correct_answers,
+            'last_seen': self.serialize_date_time('last_seen'),
+            'next_due_date': self.serialize_date_time('next_due_date'),
+            'attachment_id': self.attachment_id
+        }
+
+    def serialize_numeric(self):
+        if self.easiness_hundredths is not None:
+            return self.easiness
+        return float(0)
+
+    def serialize_date_time(self, column):
+        if column == 'last_seen':
+            if isinstance(self.last_seen, datetime):
+                return self.last_seen.isoformat()
+        elif column == 'next_due_date':
+            if isinstance(self.next_due_date, datetime):
+                return self.next_due_date.isoformat()
+        return None
+
+class Review(Model):
+    """
+    Append-only log of every study review.
+
+    There are deliberately no foreign keys: inserts don't have to check or lock
+    users/facts, and deleting a fact keeps its history. The BRIN index keeps
+    time-range scans cheap on Postgres at a fraction of a B-tree's size, since
+    rows arrive in reviewed_at order.
+    """
+    __tablename__ = 'reviews'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    fact_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    rating = Column(SmallInteger, nullable=False)
+    reviewed_at = Column(DateTime, nullable=False)
+    previous_interval = Column(Integer)
+    new_interval = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index('reviews_user_id_reviewed_at', 'user_id', 'reviewed_at'),
+        Index('reviews_reviewed_at', 'reviewed_at', postgresql_using='brin')
+    )
+
+    def __repr__(self):
+        return '<Review %d: Fact %d rated %d>' % (self.user_id, self.fact_id, self.rating)
+
+
+class DueCount(Model):
+    """
+    Number of facts due per day, per user and (under GLOBAL_USER_ID) for all
+    users. Kept up to date by adjust_due_counts in the same transaction as the
+    facts whose due_day changes, so forecasts never have to scan facts; see
+    forecast.py to rebuild it from scratch. Days without any facts due have
+    no row.
+    """
+    __tablename__ = 'due_counts'
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    due_day = Column(Integer, primary_key=True, autoincrement=False)
+    facts = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DueCount %d: Day %d has %d facts>' % (self.user_id, self.due_day, self.facts)
+
+#===============================================================================
+# General Classes
+#===============================================================================
+class ConvoState:
+    def __init__(self, user_id, state=None):
+        self.user_id = user_id
+        self.tmp_fact = Fact(user_id=user_id)
+        self.state = State.DEFAULT if state is None else state
+        # {'action', 'first_id', 'last_id'} of a bulk delete or reset awaiting confirmation
+        self.bulk_operation = None
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'user_id': self.user_id,
+            'tmp_fact': self.tmp_fact.serialize,
+            'state': self.state.value,
+            'bulk_operation': self.bulk_operation
+        }
+
+    @staticmethod
+    def deserialize(data):
+        """Rebuild a ConvoState from the JSON produced by serialize"""
+        tmp = json.loads(data)
+        convo_state = ConvoState(tmp["user_id"], State(tmp["state"]))
+        convo_state.tmp_fact = Fact()
+        convo_state.tmp_fact.id = tmp["tmp_fact"]["id"]
+        convo_state.tmp_fact.user_id = tmp["tmp_fact"]["user_id"]
+        convo_state.tmp_fact.question = tmp["tmp_fact"]["question"]
+        convo_state.tmp_fact.answer = tmp["tmp_fact"]["answer"]
+        convo_state.tmp_fact.easiness = tmp["tmp_fact"]["easiness"]
+        convo_state.tmp_fact.consecutive_correct_answers = tmp["tmp_fact"]["consecutive_correct_answers"]
+        convo_state.tmp_fact.next_due_date = parse_date_time(tmp["tmp_fact"]["next_due_date"])
+        convo_state.tmp_fact.last_seen = parse_date_time(tmp["tmp_fact"]["last_seen"])
+        convo_state.tmp_fact.attachment_id = tmp["tmp_fact"].get("attachment_id")
+        convo_state.bulk_operation = tmp.get("bulk_operation")
+        return convo_state
+
+"""
+The following states are used to create a conversation flow.
+"""
+class State(enum.Enum):
+    DEFAULT                           = 0
+    EXPECTING_FACT_QUESTION           = 1
+    EXPECTING_FACT_ANSWER             = 2
+    EXPECTING_FACT_ID_FOR_CHANGE      = 3
+    EXPECTING_FACT_ID_FOR_DELETE      = 4
+    EXPECTING_CONFIRMATION_FOR_DELETE = 5
+    EXPECTING_DURATION_FOR_SILENCE    = 6
+    EXPECTING_STUDY_ANSWER            = 7
+    EXPECTING_STUDY_PERF_RATING       = 8
+    EXPECTING_FACT_ID_FOR_DISPLAY     = 9
+    EXPECTING_CONFIRMATION_FOR_BULK   = 10
+    EXPECTING_FACT_IDS_FOR_RESET      = 11
+
+
+# ===============================================================================
+# Data Routines
+# ===============================================================================
+def get_user(user_id):
+    return User.query.filter_by(fb_id=user_id).one_or_none()
+
+
+@read_only
+def get_all_users():
+    return User.query.all()
+
+
+# Columns shown when listing facts (see send_facts).
+LIST_FACT_COLUMNS = ("id", "question")
+
+
+def get_user_facts(sender_id):
+    return get_user(sender_id).facts
+
+
+@read_only
+def list_user_facts(sender_id):
+    """
+    Read-only variant of get_user_facts for display purposes. Only the columns
+    in LIST_FACT_COLUMNS are loaded.
+    """
+    return (Fact.query.options(load_only(*LIST_FACT_COLUMNS)).join(User, User.id == Fact.user_id)
+            .filter(User.fb_id == sender_id).order_by(Fact.id).all())
+
+
+@read_only
+def find_user_fact(user_id, **criteria):
+    return Fact.query.filter_by(user_id=user_id, **criteria).one_or_none()
+
+
+def get_next_fact_to_study(sender_id, client=None):
+    """
+    Get the fact with the nearest next_due_date.
+    """
+    return get_next_due_fact(get_user(sender_id).id, client)
+
+
+def get_next_due_fact(user_id, client=None, from_queue=True):
+    """
+    Get the fact with the nearest next_due_date from the user's due queue, or
+    from the database if from_queue is False. Returns None without querying
+    the database if the queue says the user has no facts.
+    """
+    client = cache if client is None else client
+    if not from_queue:
+        return _get_next_fact_from_db(user_id, client)
+    try:
+        fact_id = due_queue.next_fact_id(client, user_id, lambda: load_due_schedule(user_id, client))
+    except Exception as e:
+        print("ERROR: Due queue unavailable, falling back to the database")
+        print("ERROR: Reason: %s" % str(e))
+        return _get_next_fact_from_db(user_id, client)
+
+    if (fact_id is None):
+        return None
+    fact = Fact.query.get(fact_id)
+    if (fact is None or fact.user_id != user_id):
+        # The queue is out of date, e.g. the fact was deleted elsewhere.
+        due_queue.drop(client, user_id)
+        return _get_next_fact_from_db(user_id, client)
+    return _overlay_pending_reviews(user_id, [fact], client)[0]
+
+
+def load_due_schedule(user_id, client=None):
+    """
+    Return (fact_id, next_due_date) pairs for all of the user's facts, used to
+    rebuild the user's due queue.
+    """
+    schedule = dict((fact_id, None if due_day is None else from_due_day(due_day)) for fact_id, due_day in
+                    db.session.query(Fact.id, Fact.due_day).filter(Fact.user_id == user_id).all())
+    if REVIEW_WRITE_BEHIND:
+        import review_buffer
+        pending = review_buffer.pending_due_dates(user_id, client)
+        schedule.update((fact_id, due) for fact_id, due in pending.items() if fact_id in schedule)
+    return schedule.items()
+
+
+def _get_next_fact_from_db(user_id, client=None):
+    facts = _overlay_pending_reviews(user_id, Fact.query.filter_by(user_id=user_id).all(), client)
+    fact_return = None
+    if (facts):
+        # Try/except block needed for now, since some facts don't have an initialized due date.
+        try:
+            facts.sort(key=lambda x: x.next_due_date)
+            fact_return = facts[0]
+        except Exception:
+            print("ERROR: Exception when sorting facts in get_next_fact_to_study")
+
+    return (fact_return)
+
+
+def _overlay_pending_reviews(user_id, facts, client=None):
+    if REVIEW_WRITE_BEHIND:
+        # Read-your-writes: reflect reviews that haven't been flushed yet.
+        import review_buffer
+        review_buffer.overlay_pending_reviews(user_id, facts, client)
+    return facts
+
+
+def sm2_interval(consecutive_correct_answers, easiness):
+    """
+    Number of days until the next review per the SM2 algorithm.
+    """
+    if (consecutive_correct_answers == 1):
+        return 1
+    elif (consecutive_correct_answers == 2):
+        return 6
+    return consecutive_correct_answers * int(round(easiness * EASINESS_SCALE)) // EASINESS_SCALE
+
+
+def apply_sm2_rating(fact, perf_rating, reviewed_at=None):
+    """
+    Update the fact's scheduling fields per the SM2 algorithm and return the
+    new interval in days. The caller is responsible for committing the change.
+    """
+    assert ((perf_rating >= 0) and (perf_rating <= 5))
+
+    fact.last_seen = datetime.utcnow() if reviewed_at is None else reviewed_at
+    if (fact.first_reviewed_at is None):
+        fact.first_reviewed_at = fact.last_seen
+
+    # Update consecutive correct answers.
+    if (perf_rating >= 3):
+        fact.consecutive_correct_answers = fact.consecutive_correct_answers + 1
+    else:
+        fact.consecutive_correct_answers = 0
+
+    # Update next due date.
+    interval = sm2_interval(fact.consecutive_correct_answers, fact.easiness)
+    fact.due_day = fact.due_day + interval
+    fact.interval_days = interval
+
+    # Update easiness, in hundredths: 0.1 - (5-q) * (0.8 + (5-q) * 0.2)
+    new_easiness = fact.easiness_hundredths + (10 - (5-perf_rating) * (80 + (5-perf_rating) * 20))
+    fact.easiness_hundredths = max(130, new_easiness)
+    return interval
+
+
+def review_fact(fact, perf_rating, reviewed_at=None):
+    """
+    Apply perf_rating to fact and return the matching review log row. The
+    previous interval is the one the fact was last scheduled with.
+    """
+    previous_interval = fact.interval_days
+    new_interval = apply_sm2_rating(fact, perf_rating, reviewed_at)
+    return {
+        'fact_id': fact.id,
+        'user_id': fact.user_id,
+        'rating': perf_rating,
+        'reviewed_at': fact.last_seen,
+        'previous_interval': previous_interval,
+        'new_interval': new_interval
+    }
+
+
+def log_reviews(session, rows):
+    """
+    Append review log rows in a single multi-row INSERT, in the session's
+    current transaction.
+    """
+    if rows:
+        session.execute(Review.__table__.insert(), rows)
+
+
+def is_unstudied(schedule):
+    """
+    Whether a fact (or a copy of its schedule) has never been reviewed.
+    """
+    return (schedule.first_reviewed_at is None)
+
+
+_ADJUST_FACT_COUNTS = text(
+    "UPDATE users SET fact_count = fact_count + :facts, unstudied_fact_count = unstudied_fact_count + :unstudied "
+    "WHERE id = :user_id")
+
+
+def adjust_fact_counts(session, changes):
+    """
+    Update the users' fact counters in the session's current transaction.
+    changes are (user_id, facts, unstudied) deltas.
+    """
+    deltas = {}
+    for user_id, facts, unstudied in changes:
+        previous = deltas.get(user_id, (0, 0))
+        deltas[user_id] = (previous[0] + facts, previous[1] + unstudied)
+
+    rows = [{'user_id': user_id, 'facts': facts, 'unstudied': unstudied}
+            for user_id, (facts, unstudied) in sorted(deltas.items()) if facts or unstudied]
+    if rows:
+        session.execute(_ADJUST_FACT_COUNTS, rows)
+    for row in rows:
+        # Reload the counters of users already in the session when next read.
+        user = session.identity_map.get(session.identity_key(User, row['user_id']))
+        if (user is not None):
+            session.expire(user, ['fact_count', 'unstudied_fact_count'])
+
+
+@read_only
+def count_due_facts(user_id, today=None):
+    """
+    Number of the user's facts due today or earlier, from the due_counts
+    rollup (one index range read, whatever the size of the deck).
+    """
+    today = to_due_day(datetime.utcnow()) if today is None else today
+    due = (db.session.query(func.sum(DueCount.facts))
+           .filter(DueCount.user_id == user_id, DueCount.due_day <= today).scalar())
+    return int(due or 0)
+
+
+# Note: ON CONFLICT needs Postgres 9.5 or SQLite 3.24.
+_ADJUST_DUE_COUNT = text(
+    "INSERT INTO due_counts (user_id, due_day, facts) VALUES (:user_id, :due_day, :delta) "
+    "ON CONFLICT (user_id, due_day) DO UPDATE SET facts = due_counts.facts + excluded.facts")
+_DELETE_EMPTY_DUE_COUNT = text(
+    "DELETE FROM due_counts WHERE user_id = :user_id AND due_day = :due_day AND facts <= 0")
+
+
+def adjust_due_counts(session, moves):
+    """
+    Update due_counts for facts whose due_day changed, in the session's
+    current transaction. moves are (user_id, old_due_day, new_due_day) with
+    None for the old day of a new fact and the new day of a deleted one.
+    """
+    deltas = {}
+    for user_id, old_due_day, new_due_day in moves:
+        if (old_due_day == new_due_day):
+            continue
+        for owner in (user_id, GLOBAL_USER_ID):
+            if (old_due_day is not None):
+                deltas[(owner, old_due_day)] = deltas.get((owner, old_due_day), 0) - 1
+            if (new_due_day is not None):
+                deltas[(owner, new_due_day)] = deltas.get((owner, new_due_day), 0) + 1
+
+    # Rows are locked in key order so concurrent transactions can't deadlock.
+    rows = [{'user_id': user_id, 'due_day': due_day, 'delta': delta}
+            for (user_id, due_day), delta in sorted(deltas.items()) if delta]
+    if rows:
+        session.execute(_ADJUST_DUE_COUNT, rows)
+    # Drop days nothing is due on any more, so reads only cover days with facts.
+    emptied = [row for row in rows if row['delta'] < 0]
+    if emptied:
+        session.execute(_DELETE_EMPTY_DUE_COUNT, emptied)
+
+
+def _lock_user_facts(user_id, first_id=None, last_id=None):
+    """
+    Lock the user's facts with IDs from first_id to last_id (all of them if
+    not given) against concurrent writes, and return their scheduling columns.
+    """
+    query = (db.session.query(Fact.id, Fact.due_day, Fact.first_reviewed_at)
+             .filter(Fact.user_id == user_id))
+    if (first_id is not None):
+        query = query.filter(Fact.id >= first_id)
+    if (last_id is not None):
+        query = query.filter(Fact.id <= last_id)
+    return query.with_for_update().all()
+
+
+def delete_user_facts(user_id, first_id=None, last_id=None):
+    """
+    Delete the user's facts with IDs from first_id to last_id (all of them if
+    not given) with a single DELETE, and update the due_counts rollup and fact
+    counters, in the session's current transaction. Returns the deleted IDs.
+    """
+    rows = _lock_user_facts(user_id, first_id, last_id)
+    if not rows:
+        return []
+    fact_ids = [row.id for row in rows]
+    facts = Fact.__table__
+    db.session.execute(facts.delete()
+                       .where(facts.c.user_id == user_id)
+                       .where(facts.c.id.in_(fact_ids)))
+    adjust_due_counts(db.session, [(user_id, row.due_day, None) for row in rows])
+    adjust_fact_counts(db.session, [(user_id, -len(rows), -sum(1 for row in rows if is_unstudied(row)))])
+    return fact_ids
+
+
+def reset_user_facts(user_id, first_id=None, last_id=None, now=None):
+    """
+    Reset the study progress of the user's facts with IDs from first_id to
+    last_id (all of them if not given) with a single UPDATE, so they are
+    studied again from tomorrow as if they were new. Updates the due_counts
+    rollup and fact counters in the session's current transaction and returns
+    the reset IDs.
+
+    Changing last_seen means reviews of these facts that are still buffered
+    (see review_buffer.py) are skipped by the flusher.
+    """
+    now = datetime.utcnow() if now is None else now
+    rows = _lock_user_facts(user_id, first_id, last_id)
+    if not rows:
+        return []
+    fact_ids = [row.id for row in rows]
+    due_day = to_due_day(now + timedelta(days=1))
+    facts = Fact.__table__
+    db.session.execute(facts.update()
+                       .where(facts.c.user_id == user_id)
+                       .where(facts.c.id.in_(fact_ids))
+                       .values(easiness_hundredths=int(DEFAULT_EASINESS * EASINESS_SCALE),
+                               consecutive_correct_answers=0,
+                               due_day=due_day,
+                               interval_days=1,
+                               first_reviewed_at=None,
+                               last_seen=now))
+    adjust_due_counts(db.session, [(user_id, row.due_day, due_day) for row in rows])
+    adjust_fact_counts(db.session, [(user_id, 0, sum(1 for row in rows if not is_unstudied(row)))])
+    return fact_ids
+
+
+@read_only
+def get_review_stats(user_id=None, start=None, end=None):
+    """
+    Return (number of reviews, average rating) for a user and/or time period.
+    Both filters are served by the reviews indexes.
+    """
+    query = db.session.query(func.count(Review.id), func.avg(Review.rating))
+    if user_id is not None:
+        query = query.filter(Review.user_id == user_id)
+    if start is not None:
+        query = query.filter(Review.reviewed_at >= start)
+    if end is not None:
+        query = query.filter(Review.reviewed_at < end)
+    count, average = query.one()
+    return (count, float(average) if average is not None else None)
+
+
+def load_convo_state(sender_id, client=None):
+    """
+    Return the user's stored ConvoState or None, see convo_cache.py. Raises if
+    it can't be read from Redis or the local cache.
+    """
+    client = cache if client is None else client
+    user_data = convo_cache.load(client, sender_id, CACHE_EXPIRATION_IN_SECONDS)
+    if not user_data:
+        return None
+    return ConvoState.deserialize(user_data)
+
+
+def store_convo_state(sender_id, convo_state, client=None):
+    client = cache if client is None else client
+    convo_cache.store(client, sender_id, json.dumps(convo_state.serialize), CACHE_EXPIRATION_IN_SECONDS)
+
+
+# ===============================================================================
+# Messaging Routines
+# ===============================================================================
+def get_page_access_token():
+    """
+    This PAT (Page Access Token) is used to authenticate our requests/responses.
+    It was generated during the setup of our Facebook page and Facebook app.
+    It was set in our Heroku environment using the following command:
+       heroku config:add PAGE_ACCESS_TOKEN=your_token_here
+    """
+    return(os.environ["PAGE_ACCESS_TOKEN"])
+
+
+def change_typing_indicator(enabled, user_id):
+    if(enabled):
+        action = "typing_on"
+    else:
+        action = "typing_off"
+
+    headers = {
+        'Content-type': 'application/json'
+    }
+    params = {
+        "access_token": get_page_access_token()
+    }
+    data = json.dumps({
+        "recipient": {"id": user_id},
+        "sender_action": action
+    })
+
+    # Typing indicators are only useful right now, so they aren't retried.
+    try:
+        r = graph_delivery.request(graph_session, "POST", SEND_API_URL, params=params, data=data, headers=headers)
+    except graph_delivery.GraphUnavailable as e:
+        print("DEBUG: Skipped typing indicator for %s: %s" % (user_id, str(e)))
+        return
+
+    # Check the returned status code of the POST.
+    if r.status_code != requests.codes.ok:
+        print("DEBUG: " + r.text)
+
+
+def send_message(user_id, msg_text, is_response):
+    """
+    Send the message msg_text to recipient.
+    Returns True when the Send API accepted the message. If the Graph API is
+    unavailable the message is dead-lettered for the retry worker (see
+    graph_delivery.py) and False is returned.
+    """
+    if msg_text == "":
+        return False
+    return _send(user_id, {"text": msg_text}, is_response)
+
+
+def send_image(user_id, attachment_id, is_response):
+    """
+    Send a previously uploaded image (see attachments.py) to recipient, like
+    send_message.
+    """
+    return _send(user_id, {"attachment": {"type": "image", "payload": {"attachment_id": attachment_id}}},
+                 is_response)
+
+
+def _send(user_id, content, is_response):
+    if (is_response):
+        msg_type = "RESPONSE"
+    else:
+        msg_type = "NON_PROMOTIONAL_SUBSCRIPTION"
+
+    headers = {
+        'Content-type': 'application/json'
+    }
+    params = {
+        "access_token": get_page_access_token()
+    }
+    message = {
+        "message_type": msg_type,
+        "recipient": {"id": user_id},
+        "message": content
+    }
+
+    try:
+        r = graph_delivery.request(graph_session, "POST", SEND_API_URL, params=params, data=json.dumps(message),
+                                   headers=headers)
+    except graph_delivery.GraphUnavailable as e:
+        graph_delivery.dead_letter(cache, message, str(e))
+        return False
+
+    # Check the returned status code of the POST.
+    if r.status_code != requests.codes.ok:
+        print("DEBUG: " + r.text)
+        return False
+    return True
+
+
+"""
+Explaination at https://developers.facebook.com/docs/messenger-platform/identity/user-profile
+"""
+def get_users_firstname(user_id):
+    url = GRAPH_API_URL + str(user_id)
+
+    params = {
+        "access_token": get_page_access_token(),
+        "fields": "first_name"
+    }
+
+    try:
+        r = graph_delivery.request(graph_session, "GET", url, params=params)
+        json_response = json.loads(r.text)
+        return (json_response["first_name"])
+    except (graph_delivery.GraphUnavailable, ValueError, KeyError) as e:
+        print("ERROR: Failed to get first name of user %s" % user_id)
+        print("ERROR: Reason: %s" % str(e))
+        return FALLBACK_FIRSTNAME
+
+
+# ===============================================================================
+# General Routines
+# ===============================================================================
+def format_date_time(date_time):
+    if isinstance(date_time, datetime):
+        return "{:%B %d, %Y}".format(date_time)
+    return None
+
+
+def parse_date_time(date_time):
+    if isinstance(date_time, str):
+        return parser.parse(date_time)
+    return None
+
+
+def log_startup_time(entry_point):
+    """
+    Record how long after process start the given entry point became ready.
+    """
+    import psutil
+    elapsed = time.time() - psutil.Process(os.getpid()).create_time()
+    metrics.observe("startup.%s_seconds" % entry_point, elapsed)
+    print("DEBUG: %s ready %.3f seconds after process start." % (entry_point, elapsed))
+    return elapsed
@@ -0,0 +1,111 @@
+import calendar
+import os
+
+
+"""
+Per-user due queue kept in a Redis sorted set.
+
+Members are fact ids scored by their next_due_date (as a UTC timestamp), so the
+next fact to study is a single ZRANGEBYSCORE. Every built queue also contains
+EMPTY_MARKER with an infinite score: a queue holding only the marker means the
+user has no facts, which is answered without touching the database.
+
+Queues are rebuilt lazily from Postgres when missing. Writes only ever update
+queues that already exist, so a partially populated queue is never created.
+"""
+DUE_QUEUE_KEY = "due:%s"
+EMPTY_MARKER = "-"
+
+# Queues are a cache of the facts table; let idle ones expire.
+DUE_QUEUE_EXPIRATION_IN_SECONDS = int(os.environ.get("DUE_QUEUE_EXPIRATION_IN_SECONDS", 7 * 24 * 3600))
+
+
+def due_score(next_due_date):
+    """
+    Return next_due_date as a UTC timestamp. Naive datetimes are taken to be in
+    UTC and facts without a due date are due immediately.
+    """
+    if next_due_date is None:
+        return 0
+    return calendar.timegm(next_due_date.utctimetuple()) + next_due_date.microsecond / 1e6
+
+
+def next_fact_id(client, user_id, load_schedule):
+    """
+    Return the id of the user's fact with the nearest due date, or None if the
+    user has no facts. load_schedule is called to rebuild a missing queue and
+    must return (fact_id, next_due_date) pairs.
+    """
+    member, score = _first(client, user_id, load_schedule)
+    if member == EMPTY_MARKER:
+        return None
+    return int(member)
+
+
+def earliest_due(client, user_id, load_schedule):
+    """
+    Return the nearest due date of the user's facts as a UTC timestamp, or None
+    if the user has no facts.
+    """
+    member, score = _first(client, user_id, load_schedule)
+    if member == EMPTY_MARKER:
+        return None
+    return score
+
+
+def _first(client, user_id, load_schedule):
+    key = DUE_QUEUE_KEY % user_id
+    members = client.zrangebyscore(key, '-inf', '+inf', start=0, num=1, withscores=True)
+    if not members:
+        rebuild(client, user_id, load_schedule())
+        members = client.zrangebyscore(key, '-inf', '+inf', start=0, num=1, withscores=True)
+
+    member, score = members[0]
+    return member.decode(), score
+
+
+def rebuild(client, user_id, schedule):
+    key = DUE_QUEUE_KEY % user_id
+    mapping = dict((str(fact_id), due_score(next_due_date)) for fact_id, next_due_date in schedule)
+    mapping[EMPTY_MARKER] = float('inf')
+    pipe = client.pipeline()
+    pipe.delete(key)
+    pipe.zadd(key, mapping)
+    pipe.expire(key, DUE_QUEUE_EXPIRATION_IN_SECONDS)
+    pipe.execute()
+
+
+def schedule(client, user_id, fact_id, next_due_date):
+    """Add or move a fact in the user's queue, if the queue has been built"""
+    _update_if_built(client, user_id, lambda pipe, key: pipe.zadd(key, {str(fact_id): due_score(next_due_date)}))
+
+
+def unschedule(client, user_id, fact_id):
+    """Remove a fact from the user's queue, if the queue has been built"""
+    _update_if_built(client, user_id, lambda pipe, key: pipe.zrem(key, str(fact_id)))
+
+
+def drop(client, user_id):
+    """Forget the user's queue so that it is rebuilt on next use"""
+    client.delete(DUE_QUEUE_KEY % user_id)
+
+
+def _update_if_built(client, user_id, update):
+    key = DUE_QUEUE_KEY % user_id
+
+    def update_queue(pipe):
+        if not pipe.exists(key):
+            return
+        pipe.multi()
+        update(pipe, key)
+        pipe.expire(key, DUE_QUEUE_EXPIRATION_IN_SECONDS)
+
+    try:
+        client.transaction(update_queue, key)
+    except Exception as e:
+        print("ERROR: Failed to update due queue for user %s" % user_id)
+        print("ERROR: Reason: %s" % str(e))
+        try:
+            drop(client, user_id)
+        except Exception:
+            pass # The queue expires on its own.
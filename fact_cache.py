@@ -0,0 +1,139 @@
+from collections import OrderedDict
+
+import os
+import random
+import threading
+import time
+
+import core
+import metrics
+
+
+"""
+In-process cache of fact rows.
+
+The change, delete and detail flows look the same fact up again on
+consecutive turns (e.g. EXPECTING_FACT_ID_FOR_CHANGE and then
+EXPECTING_FACT_ANSWER), so lookups by id are served from a bounded LRU cache
+keyed by (user_id, fact_id). Entries expire after FACT_CACHE_TTL_SECONDS.
+
+Each user has a version counter in Redis, FACT_VERSION_KEY, which is bumped
+whenever one of their facts changes. An entry is only used if it was stored
+under the current version, so a change made by another worker or by the
+review flusher is seen on the next lookup. A missing version (never set,
+expired or lost with Redis) starts again from a random value, so entries
+stored under the old one can't match. If Redis can't be reached the cache is
+bypassed.
+
+Cached facts are returned as transient copies that aren't attached to the
+session; writes go through queries by id.
+
+Hits and misses are counted as fact_cache.hits and fact_cache.misses.
+"""
+FACT_CACHE_SIZE = int(os.environ.get("FACT_CACHE_SIZE", 1024))
+FACT_CACHE_TTL_SECONDS = int(os.environ.get("FACT_CACHE_TTL_SECONDS", 300))
+FACT_VERSION_KEY = "facts:version:%s"
+FACT_VERSION_EXPIRATION_IN_SECONDS = 60 * 60 * 24
+
+_COLUMNS = ("id", "user_id", "question", "answer", "easiness_hundredths", "consecutive_correct_answers",
+            "last_seen", "due_day", "interval_days", "first_reviewed_at", "attachment_id")
+
+
+class FactCache:
+    """Bounded LRU map of (user_id, fact_id) to fact column values"""
+    def __init__(self, size=FACT_CACHE_SIZE, ttl_seconds=FACT_CACHE_TTL_SECONDS, clock=time.time):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, user_id, fact_id, version):
+        """Return a copy of the fact if it's cached under version, otherwise None"""
+        key = (user_id, fact_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, entry_version, values = entry
+            if expires_at <= self.clock() or entry_version != version:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return core.Fact(**values)
+
+    def put(self, fact, version):
+        key = (fact.user_id, fact.id)
+        values = dict((column, getattr(fact, column)) for column in _COLUMNS)
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl_seconds, version, values)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, user_id, fact_id):
+        with self.lock:
+            self.entries.pop((user_id, fact_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_facts = FactCache()
+
+
+def get_user_fact(user_id, fact_id, client=None):
+    """
+    Return the user's fact with the given id, or None if they don't have one.
+    """
+    version = current_version(user_id, client)
+    if (version is not None):
+        fact = _facts.get(user_id, fact_id, version)
+        if (fact is not None):
+            metrics.incr("fact_cache.hits")
+            return fact
+
+    metrics.incr("fact_cache.misses")
+    fact = core.find_user_fact(user_id, id=fact_id)
+    if (fact is not None and version is not None):
+        _facts.put(fact, version)
+    return fact
+
+
+def current_version(user_id, client=None):
+    client = core.cache if client is None else client
+    key = FACT_VERSION_KEY % user_id
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.set(key, random.getrandbits(48), nx=True, ex=FACT_VERSION_EXPIRATION_IN_SECONDS)
+        pipe.get(key)
+        return int(pipe.execute()[1])
+    except Exception as e:
+        print("ERROR: Failed to read fact version for user %s, bypassing fact cache" % user_id)
+        print("ERROR: Reason: %s" % str(e))
+        return None
+
+
+def invalidate(user_id, fact_id, client=None):
+    """Forget a fact after it was changed or deleted (call after committing)"""
+    _facts.discard(user_id, fact_id)
+    bump_versions([user_id], client)
+
+
+def bump_versions(user_ids, client=None):
+    """Invalidate every cached fact of the given users, in all processes"""
+    client = core.cache if client is None else client
+    try:
+        pipe = client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.incr(FACT_VERSION_KEY % user_id)
+            pipe.expire(FACT_VERSION_KEY % user_id, FACT_VERSION_EXPIRATION_IN_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        # Other processes see the change once their entries expire.
+        print("ERROR: Failed to bump fact versions for users %s" % user_ids)
+        print("ERROR: Reason: %s" % str(e))
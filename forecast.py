@@ -0,0 +1,114 @@
+from datetime import datetime
+
+import argparse
+import json
+
+from sqlalchemy import text
+
+import core
+import reminders
+
+
+"""
+Daily review and reminder volume forecast.
+
+Review volume comes from the due_counts rollup (core.DueCount), which holds
+the number of facts due per day per user and for all users, and is updated
+whenever a fact is created, reviewed or deleted. Reminder volume comes from
+the reminder queue, which has each user's next reminder time. A forecast of
+N days reads at most N rollup rows and makes one Redis round trip, however
+many facts and users there are.
+
+Reviews due before today are reported as overdue. Rows are deleted when
+their count drops to 0, so the overdue sum only reads past days that still
+have facts due, not the whole history. Only each user's next
+reminder is counted, not the repeats sent while they don't study.
+
+    python forecast.py --days 14
+    python forecast.py --days 14 --user <fb_id>
+
+The rollup is created on an existing database by migrate_due_counts.py. It
+can be rebuilt from the facts table, e.g. to drop empty rows left by older
+versions (this locks facts against writes while it runs):
+
+    python forecast.py rebuild
+"""
+FORECAST_MAX_DAYS = 90
+
+
+def forecast(days, user_id=core.GLOBAL_USER_ID, today=None, client=None):
+    """
+    Return the expected number of reviews (and, for all users, reminders) for
+    each of the next days, starting today (UTC).
+    """
+    days = max(1, min(days, FORECAST_MAX_DAYS))
+    today = core.to_due_day(datetime.utcnow()) if today is None else today
+    counts = dict(core.db.session.query(core.DueCount.due_day, core.DueCount.facts)
+                  .filter(core.DueCount.user_id == user_id)
+                  .filter(core.DueCount.due_day >= today, core.DueCount.due_day < today + days).all())
+    overdue = (core.db.session.query(core.func.sum(core.DueCount.facts))
+               .filter(core.DueCount.user_id == user_id, core.DueCount.due_day < today).scalar())
+
+    result = {
+        'overdue_reviews': int(overdue or 0),
+        'days': [{'date': core.from_due_day(day).date().isoformat(), 'reviews': counts.get(day, 0)}
+                 for day in range(today, today + days)]
+    }
+    if (user_id == core.GLOBAL_USER_ID):
+        reminder_counts = count_reminders(today, days, client)
+        result['overdue_reminders'] = reminder_counts[0]
+        for day, reminders_due in zip(result['days'], reminder_counts[1:]):
+            day['reminders'] = reminders_due
+    return result
+
+
+def count_reminders(today, days, client=None):
+    """Return the number of reminders due before today, then on each of the next days"""
+    client = core.cache if client is None else client
+    # Reminders are scored by UTC timestamp, and due days are whole UTC days.
+    start = today * 86400
+    pipe = client.pipeline(transaction=False)
+    pipe.zcount(reminders.REMINDER_QUEUE_KEY, "-inf", "(%d" % start)
+    for day in range(days):
+        day_start = start + day * 86400
+        pipe.zcount(reminders.REMINDER_QUEUE_KEY, day_start, "(%d" % (day_start + 86400))
+    return pipe.execute()
+
+
+def rebuild():
+    """Recompute due_counts from the facts table in one transaction"""
+    with core.db.engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("LOCK TABLE facts IN SHARE MODE"))
+        connection.execute(text("DELETE FROM due_counts"))
+        connection.execute(text(
+            "INSERT INTO due_counts (user_id, due_day, facts) "
+            "SELECT user_id, due_day, count(*) FROM facts WHERE due_day IS NOT NULL GROUP BY user_id, due_day"))
+        connection.execute(text(
+            "INSERT INTO due_counts (user_id, due_day, facts) "
+            "SELECT :global_user_id, due_day, count(*) FROM facts WHERE due_day IS NOT NULL GROUP BY due_day"),
+            {"global_user_id": core.GLOBAL_USER_ID})
+    print("DEBUG: Rebuilt due_counts from facts.")
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forecast the daily review and reminder volume.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("rebuild", help="recompute the rollup from the facts table")
+    parser.add_argument("--days", type=int, default=7, help="number of days to forecast")
+    parser.add_argument("--user", help="forecast reviews of a single user, by FB ID")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        core.db.create_all()
+        rebuild()
+    elif args.user:
+        user = core.get_user(args.user)
+        if user is None:
+            parser.error("no user with FB ID %s" % args.user)
+        print(json.dumps(forecast(args.days, user.id), indent=2))
+    else:
+        print(json.dumps(forecast(args.days), indent=2))
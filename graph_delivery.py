@@ -0,0 +1,234 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+import metrics
+
+
+"""
+Graph API timeouts, circuit breaker and dead-letter queue.
+
+Every Graph API call goes through request(), which applies strict connect
+and read timeouts and a per-process circuit breaker. After
+GRAPH_FAILURE_THRESHOLD consecutive transient failures (timeouts, connection
+errors, 429 and 5xx responses) the circuit opens, and calls fail fast with
+GraphUnavailable for GRAPH_CIRCUIT_RESET_SECONDS. After that a single trial
+call is let through, and its result closes the circuit or opens it again.
+
+Messages that couldn't be sent because of a transient failure are added to
+a Redis sorted set, scored by when to retry them, instead of being lost. The
+retry worker (run this module) redelivers them with exponential backoff
+while its own circuit is closed. A message is dropped when the Send API
+rejects it outright, after GRAPH_RETRY_MAX_ATTEMPTS, or once it is older than
+GRAPH_DEAD_LETTER_MAX_AGE_SECONDS (Messenger only accepts replies within a
+day of the user's message).
+"""
+GRAPH_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("GRAPH_CONNECT_TIMEOUT_SECONDS", 2))
+GRAPH_READ_TIMEOUT_SECONDS = float(os.environ.get("GRAPH_READ_TIMEOUT_SECONDS", 5))
+GRAPH_FAILURE_THRESHOLD = int(os.environ.get("GRAPH_FAILURE_THRESHOLD", 5))
+GRAPH_CIRCUIT_RESET_SECONDS = float(os.environ.get("GRAPH_CIRCUIT_RESET_SECONDS", 30))
+
+DEAD_LETTER_KEY = "graph:dead_letters"
+GRAPH_RETRY_BASE_SECONDS = float(os.environ.get("GRAPH_RETRY_BASE_SECONDS", 10))
+GRAPH_RETRY_MAX_SECONDS = float(os.environ.get("GRAPH_RETRY_MAX_SECONDS", 3600))
+GRAPH_RETRY_MAX_ATTEMPTS = int(os.environ.get("GRAPH_RETRY_MAX_ATTEMPTS", 10))
+GRAPH_RETRY_BATCH_SIZE = int(os.environ.get("GRAPH_RETRY_BATCH_SIZE", 50))
+GRAPH_RETRY_POLL_SECONDS = float(os.environ.get("GRAPH_RETRY_POLL_SECONDS", 1))
+GRAPH_DEAD_LETTER_MAX_AGE_SECONDS = float(os.environ.get("GRAPH_DEAD_LETTER_MAX_AGE_SECONDS", 23 * 3600))
+
+
+class GraphUnavailable(Exception):
+    """The Graph API call failed transiently, or wasn't made because the circuit is open"""
+    pass
+
+
+class CircuitBreaker:
+    """Consecutive failure counting circuit breaker, safe to share between threads"""
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=GRAPH_FAILURE_THRESHOLD, reset_seconds=GRAPH_CIRCUIT_RESET_SECONDS,
+                 clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may be made now"""
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and self.clock() - self.opened_at >= self.reset_seconds:
+                # Let a single trial call through.
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                print("DEBUG: Graph API circuit closed.")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+        metrics.set_gauge("graph.circuit_open", 0)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    print("ERROR: Graph API circuit opened after %d failures." % self.failures)
+                    metrics.incr("graph.circuit_opened")
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = self.clock()
+                metrics.set_gauge("graph.circuit_open", 1)
+
+
+breaker = CircuitBreaker()
+
+
+def request(session, method, url, circuit=None, **kwargs):
+    """
+    Make a Graph API call with timeouts through the circuit breaker and return
+    the response. Raises GraphUnavailable when the call failed transiently or
+    the circuit is open; other error responses are returned to the caller.
+    """
+    circuit = breaker if circuit is None else circuit
+    if not circuit.allow():
+        metrics.incr("graph.rejected")
+        raise GraphUnavailable("circuit open")
+
+    kwargs.setdefault("timeout", (GRAPH_CONNECT_TIMEOUT_SECONDS, GRAPH_READ_TIMEOUT_SECONDS))
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        metrics.incr("graph.failures")
+        circuit.record_failure()
+        raise GraphUnavailable("%s: %s" % (type(e).__name__, e))
+    except BaseException:
+        # Count it too, so a failed trial call can't leave the circuit half open.
+        metrics.incr("graph.failures")
+        circuit.record_failure()
+        raise
+
+    if response.status_code == 429 or response.status_code >= 500:
+        metrics.incr("graph.failures")
+        circuit.record_failure()
+        raise GraphUnavailable("status %d: %s" % (response.status_code, response.text))
+    circuit.record_success()
+    return response
+
+
+#===============================================================================
+# Dead letters
+#===============================================================================
+def dead_letter(client, message, reason, now=None):
+    """
+    Queue a Send API message body for redelivery. Returns False if it couldn't
+    be queued either.
+    """
+    now = time.time() if now is None else now
+    letter = {"id": uuid.uuid4().hex, "message": message, "attempts": 0, "first_failed_at": now}
+    try:
+        client.zadd(DEAD_LETTER_KEY, {json.dumps(letter): now + retry_delay(0)})
+    except Exception as e:
+        print("ERROR: Failed to dead-letter message to %s, dropping it" % message["recipient"]["id"])
+        print("ERROR: Reason: %s" % str(e))
+        metrics.incr("graph.dead_letters.lost")
+        return False
+    print("DEBUG: Dead-lettered message to %s: %s" % (message["recipient"]["id"], reason))
+    metrics.incr("graph.dead_letters.queued")
+    return True
+
+
+def retry_delay(attempts):
+    return min(GRAPH_RETRY_BASE_SECONDS * 2 ** attempts, GRAPH_RETRY_MAX_SECONDS)
+
+
+def redeliver_due(client=None, session=None, circuit=None, now=None, batch_size=GRAPH_RETRY_BATCH_SIZE):
+    """
+    Try to send the dead letters that are due. Returns the number delivered.
+    """
+    import core
+    client = core.cache if client is None else client
+    session = core.graph_session if session is None else session
+    circuit = breaker if circuit is None else circuit
+    now = time.time() if now is None else now
+
+    delivered = 0
+    for member in client.zrangebyscore(DEAD_LETTER_KEY, 0, now, start=0, num=batch_size):
+        if not circuit.allow():
+            break
+        # Claim the letter, another worker may have got to it first.
+        if not client.zrem(DEAD_LETTER_KEY, member):
+            continue
+        letter = json.loads(member)
+        recipient = letter["message"]["recipient"]["id"]
+        if now - letter["first_failed_at"] > GRAPH_DEAD_LETTER_MAX_AGE_SECONDS:
+            print("ERROR: Dropping expired dead letter to %s" % recipient)
+            metrics.incr("graph.dead_letters.expired")
+            continue
+
+        try:
+            response = _post(session, circuit, letter["message"])
+        except Exception as e:
+            # Note: Anything else that goes wrong is retried too, the letter was already claimed.
+            print("ERROR: Failed to redeliver dead letter to %s" % recipient)
+            print("ERROR: Reason: %s" % str(e))
+            letter["attempts"] += 1
+            if letter["attempts"] >= GRAPH_RETRY_MAX_ATTEMPTS:
+                print("ERROR: Giving up on dead letter to %s after %d attempts" % (recipient, letter["attempts"]))
+                metrics.incr("graph.dead_letters.abandoned")
+            else:
+                client.zadd(DEAD_LETTER_KEY, {json.dumps(letter): now + retry_delay(letter["attempts"])})
+            continue
+
+        if response.status_code == requests.codes.ok:
+            delivered += 1
+            metrics.incr("graph.dead_letters.redelivered")
+        else:
+            print("ERROR: Send API rejected dead letter to %s: %s" % (recipient, response.text))
+            metrics.incr("graph.dead_letters.rejected")
+    return delivered
+
+
+def _post(session, circuit, message):
+    import core
+    return request(session, "POST", core.SEND_API_URL, circuit=circuit,
+                   params={"access_token": core.get_page_access_token()},
+                   data=json.dumps(message), headers={'Content-type': 'application/json'})
+
+
+def seconds_until_next(client):
+    entries = client.zrange(DEAD_LETTER_KEY, 0, 0, withscores=True)
+    if not entries:
+        return GRAPH_RETRY_POLL_SECONDS
+    return min(max(entries[0][1] - time.time(), 0), GRAPH_RETRY_POLL_SECONDS)
+
+
+def run_retry_worker(client=None):
+    import core
+    client = core.cache if client is None else client
+    while True:
+        try:
+            redeliver_due(client)
+            time.sleep(seconds_until_next(client))
+        except Exception as e:
+            print("ERROR: Dead letter retry worker failed")
+            print("ERROR: Reason: %s" % str(e))
+            time.sleep(1)
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    print("DEBUG: Dead letter retry worker is running!")
+    run_retry_worker()
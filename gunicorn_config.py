@@ -0,0 +1,28 @@
+import async_mode
+
+
+"""
+Gunicorn server hooks, see http://docs.gunicorn.org/en/stable/settings.html#server-hooks
+"""
+if async_mode.enabled():
+    # Cooperative workers, see async_mode.py.
+    worker_class = "gevent"
+    worker_connections = async_mode.ASYNC_WORKER_CONNECTIONS
+
+
+def post_fork(server, worker):
+    if async_mode.enabled():
+        async_mode.patch_psycopg2()
+
+
+def post_worker_init(worker):
+    """
+    Warm up connections once per worker, after the app has been loaded and
+    before the worker starts accepting requests.
+    """
+    import warmup
+    warmup.warm_up()
+
+    import convo_cache
+    import core
+    convo_cache.start_listener(core.cache)
@@ -0,0 +1,165 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+"""
+Local fallback intent classifier.
+
+Used when Messenger's built-in NLP sends no intent, or none above
+MIN_CONFIDENCE_THRESHOLD, so that a plainly worded request doesn't get the
+usage instructions and an extra round trip.
+
+The model is a multinomial naive Bayes over word unigrams and bigrams,
+trained on the utterances below when first used (once per process, see
+warmup.py). A prediction is one dot product over the vocabulary.
+
+default_intent is trained on the kind of free text users send while adding
+facts, so that questions and answers are not mistaken for commands.
+"""
+TRAINING_UTTERANCES = {
+    "add_fact": [
+        "I want to add a fact", "add a fact", "add fact", "new fact", "create a fact",
+        "I want to create a new fact", "add a new question", "can I add a fact",
+        "let me add a fact", "make a new flashcard", "add a flashcard", "create fact",
+        "I'd like to add something to study", "save a new fact"
+    ],
+    "change_fact": [
+        "I want to change a fact", "change a fact", "change fact", "edit a fact", "edit fact",
+        "update a fact", "update fact", "modify a fact", "I want to edit fact 3",
+        "change fact 12", "fix a fact", "I need to update one of my facts", "rewrite a fact"
+    ],
+    "view_facts": [
+        "I want to view all facts", "view facts", "view all facts", "show my facts",
+        "show all facts", "list my facts", "list facts", "what are my facts",
+        "show me everything I'm studying", "see my facts", "display my facts",
+        "what facts do I have", "show me my flashcards"
+    ],
+    "view_detailed_fact": [
+        "view fact details", "show fact details", "show me the details of a fact",
+        "view a fact in detail", "details for fact 3", "show me fact 5", "view detailed fact",
+        "I want to see the details of a fact", "more detail on a fact", "fact details"
+    ],
+    "delete_fact": [
+        "I want to delete a fact", "delete a fact", "delete fact", "remove a fact",
+        "remove fact", "delete fact 4", "get rid of a fact", "erase a fact",
+        "I don't need this fact anymore", "throw away a fact", "drop a fact",
+        "delete all facts", "delete all my facts", "delete facts 10-20", "delete facts 3 to 8",
+        "remove all facts", "delete everything"
+    ],
+    "reset_progress": [
+        "reset progress", "reset my progress", "reset progress on all facts", "start over",
+        "reset all facts", "reset facts 10-20", "reset progress on facts 3 to 8",
+        "forget my progress", "restart studying from scratch", "reset my study progress"
+    ],
+    "study_next_fact": [
+        "I want to study", "study", "let's study", "study time", "quiz me", "test me",
+        "start studying", "study now", "I'm ready to study", "give me a question",
+        "next fact", "practice", "review my facts", "let's review", "study time!"
+    ],
+    "silence_studying": [
+        "I want to silence studying for 2 days", "silence studying", "silence notifications",
+        "stop reminding me", "no reminders for a week", "mute studying for 3 hours",
+        "pause studying", "don't remind me for a day", "silence for 5 days",
+        "snooze reminders", "stop notifications for a while", "leave me alone for 2 hours"
+    ],
+    "abort": [
+        "abort", "cancel", "cancel that", "never mind", "nevermind", "stop that",
+        "forget it", "quit", "exit", "abort that request", "go back", "I changed my mind"
+    ],
+    "confirmation": [
+        "yes", "yeah", "yep", "sure", "ok", "okay", "yes please", "confirm",
+        "yes I'm sure", "do it", "absolutely", "that's right", "correct", "go ahead"
+    ],
+    "default_intent": [
+        "What is the capital of France", "Paris", "What is the powerhouse of the cell",
+        "The mitochondria", "Who wrote Hamlet", "William Shakespeare", "What year did the war end",
+        "1945", "How many bones are in the human body", "206", "What is 7 times 8", "56",
+        "Define photosynthesis", "The process plants use to turn light into energy",
+        "This is a question", "This is the answer", "Is this a question", "What does it stand for",
+        "How many legs does a spider have", "Eight", "no", "nope", "hmm", "what", "I don't know",
+        "thanks", "cool", "lol"
+    ]
+}
+
+LOCAL_INTENT_MIN_CONFIDENCE = float(os.environ.get("LOCAL_INTENT_MIN_CONFIDENCE", 0.75))
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+_classifier = None
+_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Return the words of text followed by its word bigrams"""
+    words = _TOKEN_PATTERN.findall(text.lower())
+    return words + ["%s %s" % pair for pair in zip(words, words[1:])]
+
+
+class IntentClassifier:
+    """Multinomial naive Bayes over word unigrams and bigrams"""
+    def __init__(self, utterances, smoothing=0.1):
+        self.intents = sorted(utterances)
+        self.vocabulary = {}
+        for intent in self.intents:
+            for utterance in utterances[intent]:
+                for token in tokenize(utterance):
+                    self.vocabulary.setdefault(token, len(self.vocabulary))
+
+        counts = np.zeros((len(self.intents), len(self.vocabulary)))
+        for row, intent in enumerate(self.intents):
+            for utterance in utterances[intent]:
+                counts[row] += self.vectorize(utterance)
+        counts += smoothing
+        self.log_likelihood = np.log(counts / counts.sum(axis=1, keepdims=True))
+
+    def vectorize(self, text):
+        features = np.zeros(len(self.vocabulary))
+        for token in tokenize(text):
+            column = self.vocabulary.get(token)
+            if column is not None:
+                features[column] += 1
+        return features
+
+    def predict(self, text):
+        """
+        Return the most likely intent of text and its probability, or
+        (None, 0.0) if none of the words in text are known.
+        """
+        features = self.vectorize(text)
+        if not features.any():
+            return None, 0.0
+        # Intents are equally likely a priori.
+        scores = self.log_likelihood.dot(features)
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.intents[best], float(probabilities[best])
+
+
+def get_classifier():
+    global _classifier
+    if _classifier is None:
+        with _lock:
+            if _classifier is None:
+                _classifier = IntentClassifier(TRAINING_UTTERANCES)
+    return _classifier
+
+
+def classify(text, min_confidence=LOCAL_INTENT_MIN_CONFIDENCE):
+    """
+    Return the intent of text, or "default_intent" if the classifier is unsure.
+    """
+    start = time.time()
+    intent, confidence = get_classifier().predict(text)
+    metrics.observe("intent_classifier.seconds", time.time() - start)
+    if intent is None or confidence < min_confidence:
+        metrics.incr("intent_classifier.unsure")
+        return "default_intent"
+    metrics.incr("intent_classifier.%s" % intent)
+    return intent
@@ -0,0 +1,63 @@
+import threading
+
+
+"""
+Minimal in-process metrics registry.
+
+Counters are monotonically increasing totals, observations keep a running
+count/sum/max so averages can be derived without storing every sample, and
+gauges hold the last value reported. The registry is per-process; each
+gunicorn worker reports its own numbers.
+"""
+_lock = threading.Lock()
+_counters = {}
+_observations = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    with _lock:
+        stats = _observations.get(name)
+        if stats is None:
+            stats = {"count": 0, "sum": 0.0, "max": None}
+            _observations[name] = stats
+        stats["count"] += 1
+        stats["sum"] += value
+        if stats["max"] is None or value > stats["max"]:
+            stats["max"] = value
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Return a copy of every metric in easily serializeable format"""
+    with _lock:
+        observations = {}
+        for name, stats in _observations.items():
+            observations[name] = dict(stats)
+            observations[name]["avg"] = stats["sum"] / stats["count"] if stats["count"] else 0.0
+        return {
+            "counters": dict(_counters),
+            "observations": observations,
+            "gauges": dict(_gauges)
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _observations.clear()
+        _gauges.clear()
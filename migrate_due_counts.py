@@ -0,0 +1,67 @@
+import argparse
+
+from core import db, GLOBAL_USER_ID
+
+
+"""
+Create the due_counts rollup and fill it in from the facts table (Postgres).
+
+    due_counts  one row per (user_id, due_day) with the number of facts due
+                that day, and per due_day for all users under GLOBAL_USER_ID;
+                see core.DueCount
+
+Every fact create, review and delete updates the rollup in the same
+transaction (see core.adjust_due_counts), so run this before deploying code
+that keeps it. Facts are locked against writes while it is filled in, so the
+migration can run while the bot is up. It can be run again safely, which
+recomputes the rollup.
+
+    heroku run python migrate_due_counts.py
+"""
+MIGRATION = [
+    """
+    CREATE TABLE IF NOT EXISTS due_counts (
+        user_id  INTEGER NOT NULL,
+        due_day  INTEGER NOT NULL,
+        facts    INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, due_day)
+    )
+    """,
+    "LOCK TABLE facts IN SHARE MODE",
+    "DELETE FROM due_counts",
+    """
+    INSERT INTO due_counts (user_id, due_day, facts)
+    SELECT user_id, due_day, count(*)
+      FROM facts
+     WHERE due_day IS NOT NULL
+     GROUP BY user_id, due_day
+    """,
+    """
+    INSERT INTO due_counts (user_id, due_day, facts)
+    SELECT %d, due_day, count(*)
+      FROM facts
+     WHERE due_day IS NOT NULL
+     GROUP BY due_day
+    """ % GLOBAL_USER_ID
+]
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        for statement in MIGRATION:
+            print("DEBUG: %s" % " ".join(statement.split()))
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Created and filled in the due_counts rollup.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create and fill in the due_counts rollup.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
@@ -0,0 +1,78 @@
+import argparse
+
+from core import db, DEFAULT_EASINESS, EASINESS_SCALE
+
+
+"""
+Add the per-user fact counters to the users table and fill them in (Postgres).
+
+    fact_count            INTEGER, number of facts
+    unstudied_fact_count  INTEGER, number of facts that were never reviewed
+
+A fact was never reviewed if its first_reviewed_at is NULL. Existing facts get
+the time of their first logged review (unless they were reset since their
+last one), or failing that their last_seen unless they still have no correct
+answers at the default easiness, which is the best guess for facts reviewed
+before the review log. Run migrate_reviews.py first.
+
+From then on the webhook and the review flusher keep them up to date (see
+core.adjust_fact_counts). Facts are locked against writes while the counts
+are filled in, so the migration can run while the bot is up. It can be run
+again safely.
+
+    heroku run python migrate_fact_counts.py
+"""
+MIGRATION = [
+    "ALTER TABLE facts ADD COLUMN IF NOT EXISTS first_reviewed_at TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS fact_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS unstudied_fact_count INTEGER NOT NULL DEFAULT 0",
+    "LOCK TABLE facts IN SHARE ROW EXCLUSIVE MODE",
+    """
+    UPDATE facts
+       SET first_reviewed_at = logged.first_reviewed_at
+      FROM (SELECT fact_id, min(reviewed_at) AS first_reviewed_at, max(reviewed_at) AS last_reviewed_at
+              FROM reviews
+             GROUP BY fact_id) AS logged
+     WHERE facts.id = logged.fact_id
+       AND facts.first_reviewed_at IS NULL
+       AND facts.last_seen <= logged.last_reviewed_at
+    """,
+    """
+    UPDATE facts
+       SET first_reviewed_at = last_seen
+     WHERE first_reviewed_at IS NULL
+       AND NOT (consecutive_correct_answers = 0 AND easiness_hundredths = %d)
+    """ % int(DEFAULT_EASINESS * EASINESS_SCALE),
+    """
+    UPDATE users
+       SET fact_count = counts.facts,
+           unstudied_fact_count = counts.unstudied
+      FROM (SELECT user_id,
+                   count(*) AS facts,
+                   count(*) FILTER (WHERE first_reviewed_at IS NULL) AS unstudied
+              FROM facts
+             GROUP BY user_id) AS counts
+     WHERE users.id = counts.user_id
+    """
+]
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        for statement in MIGRATION:
+            print("DEBUG: %s" % " ".join(statement.split()))
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Filled in the fact counters of all users.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add and fill in the per-user fact counters.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
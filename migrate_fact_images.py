@@ -0,0 +1,38 @@
+import argparse
+
+from core import db
+
+
+"""
+Add the image attachment column to the facts table (Postgres).
+
+    attachment_id  VARCHAR, reusable Messenger attachment (see attachments.py)
+
+Existing facts have no image. The migration can be run again safely.
+
+    heroku run python migrate_fact_images.py
+"""
+MIGRATION = [
+    "ALTER TABLE facts ADD COLUMN IF NOT EXISTS attachment_id VARCHAR"
+]
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        for statement in MIGRATION:
+            print("DEBUG: %s" % statement)
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Added the image attachment column to facts.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add the image attachment column to facts.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
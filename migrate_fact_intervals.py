@@ -0,0 +1,52 @@
+import argparse
+
+from core import db
+
+
+"""
+Keep the interval each fact was last scheduled with (Postgres).
+
+    interval_days  INTEGER, days from the previous review (or creation) to due_day
+
+The review log takes previous_interval from it. Facts that were reviewed get
+the new_interval of their latest logged review. Other existing facts are
+left NULL (unknown), since their interval can't be recovered. New facts
+start at 1 day. The migration runs in one transaction and can be run again
+safely.
+
+    heroku run python migrate_fact_intervals.py
+"""
+MIGRATION = [
+    "ALTER TABLE facts ADD COLUMN IF NOT EXISTS interval_days INTEGER",
+    "ALTER TABLE facts ALTER COLUMN interval_days SET DEFAULT 1",
+    """
+    UPDATE facts
+       SET interval_days = latest.new_interval
+      FROM (SELECT DISTINCT ON (fact_id) fact_id, new_interval
+              FROM reviews
+             ORDER BY fact_id, reviewed_at DESC, id DESC) AS latest
+     WHERE facts.id = latest.fact_id
+       AND facts.interval_days IS NULL
+    """
+]
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        for statement in MIGRATION:
+            print("DEBUG: %s" % " ".join(statement.split()))
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Added the interval column to facts.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add and fill in the facts' last scheduled interval.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
@@ -0,0 +1,53 @@
+import argparse
+
+from core import db
+
+
+"""
+Create the append-only review log (Postgres).
+
+    reviews  one row per study review, see core.Review
+
+The table has no foreign keys and is only ever appended to, so it can be
+created while the bot is up. Until it exists every rating fails to commit,
+so run this before deploying code that logs reviews. It can be run again
+safely.
+
+    heroku run python migrate_reviews.py
+"""
+MIGRATION = [
+    """
+    CREATE TABLE IF NOT EXISTS reviews (
+        id                BIGSERIAL PRIMARY KEY,
+        fact_id           INTEGER NOT NULL,
+        user_id           INTEGER NOT NULL,
+        rating            SMALLINT NOT NULL,
+        reviewed_at       TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        previous_interval INTEGER,
+        new_interval      INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS reviews_user_id_reviewed_at ON reviews (user_id, reviewed_at)",
+    "CREATE INDEX IF NOT EXISTS reviews_reviewed_at ON reviews USING brin (reviewed_at)"
+]
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        for statement in MIGRATION:
+            print("DEBUG: %s" % " ".join(statement.split()))
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Created the reviews table.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the review log table.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
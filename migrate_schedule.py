@@ -0,0 +1,72 @@
+import argparse
+
+from core import db
+
+
+"""
+Migrate the facts table to the compact scheduling columns (Postgres).
+
+Before:
+    easiness                    NUMERIC
+    consecutive_correct_answers INTEGER
+    next_due_date               TIMESTAMP
+
+After:
+    easiness_hundredths         SMALLINT (easiness * 100)
+    consecutive_correct_answers SMALLINT
+    due_day                     INTEGER (days since 1970-01-01, UTC)
+
+Due dates are rounded down to the start of their day; SM2 intervals are whole
+days, so a fact keeps its place in the schedule. The migration runs in one
+transaction and can be run again safely.
+
+Stop the review_flusher before migrating and deploy the new code straight
+after.
+
+    heroku run python migrate_schedule.py
+"""
+MIGRATION = [
+    "ALTER TABLE facts ADD COLUMN IF NOT EXISTS easiness_hundredths SMALLINT",
+    "ALTER TABLE facts ADD COLUMN IF NOT EXISTS due_day INTEGER",
+    """
+    UPDATE facts
+       SET easiness_hundredths = round(easiness * 100),
+           due_day = floor(extract(epoch FROM next_due_date) / 86400)
+    """,
+    "ALTER TABLE facts ALTER COLUMN easiness_hundredths SET DEFAULT 250",
+    "ALTER TABLE facts ALTER COLUMN consecutive_correct_answers TYPE SMALLINT",
+    "ALTER TABLE facts DROP CONSTRAINT IF EXISTS check_easiness",
+    "ALTER TABLE facts ADD CONSTRAINT check_easiness CHECK (easiness_hundredths >= 0)",
+    "ALTER TABLE facts DROP COLUMN easiness",
+    "ALTER TABLE facts DROP COLUMN next_due_date"
+]
+
+
+def is_migrated(connection):
+    return connection.execute(
+        "SELECT count(*) FROM information_schema.columns "
+        "WHERE table_name = 'facts' AND column_name = 'next_due_date'").scalar() == 0
+
+
+def migrate(dry_run=False):
+    with db.engine.begin() as connection:
+        if is_migrated(connection):
+            print("DEBUG: facts already uses the compact scheduling columns.")
+            return False
+        for statement in MIGRATION:
+            print("DEBUG: %s" % " ".join(statement.split()))
+            if not dry_run:
+                connection.execute(statement)
+    if not dry_run:
+        print("DEBUG: Migrated facts to the compact scheduling columns.")
+    return not dry_run
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate facts to the compact scheduling columns.")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+    migrate(args.dry_run)
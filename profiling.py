@@ -0,0 +1,192 @@
+import argparse
+import contextlib
+import cProfile
+import glob
+import io
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+
+import budgets
+
+
+"""
+Sampled CPU profiling of webhook requests.
+
+Opt-in: when PROFILE_EVERY_N is set, one in every N POST / requests is run
+under cProfile. A request carrying the PROFILE_HEADER header is profiled too
+if it comes from one of PROFILE_ALLOWED_SOURCES. When neither is set the
+middleware isn't installed at all, so there is no overhead.
+
+Each profile is written to PROFILE_DIR as a .prof file (readable with pstats
+or snakeviz) next to a .json file with the intent and conversation state of
+the events in the request. Events that a payload from several senders
+hands to worker threads are profiled in those threads and merged into the
+request's file. To list the functions that take the most time:
+
+    python profiling.py report --dir /tmp/studybot-profiles --intent study_next_fact
+"""
+PROFILE_EVERY_N = int(os.environ.get("PROFILE_EVERY_N", 0))
+PROFILE_HEADER = "X-StudyBot-Profile"
+PROFILE_ALLOWED_SOURCES = [source for source in os.environ.get("PROFILE_ALLOWED_SOURCES", "").split(",") if source]
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/studybot-profiles")
+
+_local = threading.local()
+
+
+def enabled():
+    return PROFILE_EVERY_N > 0 or bool(PROFILE_ALLOWED_SOURCES)
+
+
+class _ProfiledRequest:
+    """The budget usages of a profiled request and the profiles of its worker threads"""
+    def __init__(self):
+        self.usages = []
+        self.worker_profiles = []
+        self.lock = threading.Lock()
+
+
+def current_request():
+    """The request being profiled by this thread, to hand over to worker threads"""
+    return getattr(_local, "request", None)
+
+
+@contextlib.contextmanager
+def worker(request):
+    """
+    Profile the block and capture its budget usages as part of request, when
+    a worker thread handles some of a profiled request's events.
+    """
+    if request is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    with budgets.capture(request.usages):
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with request.lock:
+                request.worker_profiles.append(profile)
+
+
+class ProfilingMiddleware:
+    """WSGI middleware that profiles a sample of webhook requests"""
+    def __init__(self, app, every_n=PROFILE_EVERY_N, allowed_sources=PROFILE_ALLOWED_SOURCES,
+                 directory=PROFILE_DIR):
+        self.app = app
+        self.every_n = every_n
+        self.allowed_sources = allowed_sources
+        self.directory = directory
+        self.requests = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        profile = cProfile.Profile()
+        request = _ProfiledRequest()
+        start = time.time()
+        _local.request = request
+        try:
+            with budgets.capture(request.usages):
+                # Note: Flask has built the whole response by the time this returns.
+                response = profile.runcall(self.app, environ, start_response)
+        finally:
+            _local.request = None
+        with request.lock:
+            profiles = [profile] + request.worker_profiles
+        self.save(profiles, request.usages, time.time() - start)
+        return response
+
+    def should_profile(self, environ):
+        if environ.get("REQUEST_METHOD") != "POST" or environ.get("PATH_INFO") != "/":
+            return False
+        header = "HTTP_" + PROFILE_HEADER.upper().replace("-", "_")
+        if environ.get(header) and source_address(environ) in self.allowed_sources:
+            return True
+        if self.every_n > 0:
+            with self.lock:
+                return next(self.requests) % self.every_n == 0
+        return False
+
+    def save(self, profiles, usages, duration):
+        events = [{"intent": usage.intent, "state": event_state(usage)} for usage in usages]
+        name = "%d-%d-%s" % (time.time() * 1000, os.getpid(),
+                             "+".join("%s-%s" % (e["intent"], e["state"]) for e in events) or "none")
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(path + ".prof")
+            with open(path + ".json", "w") as metadata:
+                json.dump({"duration_seconds": duration, "events": events}, metadata)
+            print("DEBUG: Profiled request in %.3f seconds, saved to %s.prof" % (duration, path))
+        except Exception as e:
+            print("ERROR: Failed to save profile %s" % path)
+            print("ERROR: Reason: %s" % str(e))
+
+
+def source_address(environ):
+    """
+    Return the client address. Heroku's router appends the address it received
+    the request from to X-Forwarded-For, so only the last entry is trusted.
+    """
+    forwarded_for = environ.get("HTTP_X_FORWARDED_FOR")
+    if forwarded_for:
+        return forwarded_for.split(",")[-1].strip()
+    return environ.get("REMOTE_ADDR")
+
+
+def event_state(usage):
+    # A flow that differs from the intent is the name of a non-default state.
+    return usage.flow if usage.flow != usage.intent else "DEFAULT"
+
+
+def report(directory=PROFILE_DIR, limit=20, intent=None, state=None, sort="cumulative"):
+    """
+    Return the top functions over all saved profiles, optionally only those
+    with an event of the given intent and/or state.
+    """
+    paths = []
+    for metadata_path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(metadata_path) as metadata:
+            events = json.load(metadata)["events"]
+        if any((intent is None or e["intent"] == intent) and (state is None or e["state"] == state)
+               for e in events):
+            paths.append(metadata_path[:-len(".json")] + ".prof")
+    if not paths:
+        return "No profiles found."
+
+    output = io.StringIO()
+    stats = pstats.Stats(*paths, stream=output)
+    output.write("%d profiled requests\n" % len(paths))
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Aggregate StudyBot request profiles.")
+    commands = parser.add_subparsers(dest="command")
+    report_parser = commands.add_parser("report", help="print the top functions over all profiles")
+    report_parser.add_argument("--dir", default=PROFILE_DIR)
+    report_parser.add_argument("--limit", type=int, default=20)
+    report_parser.add_argument("--intent")
+    report_parser.add_argument("--state")
+    report_parser.add_argument("--sort", default="cumulative", help="e.g. cumulative, tottime, calls")
+
+    args = parser.parse_args()
+    if args.command == "report":
+        print(report(args.dir, args.limit, args.intent, args.state, args.sort))
+    else:
+        parser.print_help()
@@ -0,0 +1,253 @@
+import os
+import time
+
+import core
+import due_queue
+import metrics
+
+
+"""
+Event-driven study reminders.
+
+Every user with facts has an entry in a Redis sorted set scored by the time
+they should next be reminded: the later of their earliest next_due_date and
+their silence_end_time. The webhook reschedules a user whenever that time can
+move (a fact is created, deleted or reviewed, or studying is silenced), and
+the scheduler (run this module) sleeps until the earliest entry is due.
+
+Only due entries are ever looked at, so the work done follows the number of
+reminders sent rather than the number of users. Entries are only hints: a
+user's silence period and due date are checked against the database before
+a reminder is sent, and the entry is moved if it fired too early.
+
+A reminder is never scheduled sooner than REMINDER_INTERVAL_SECONDS after the
+previous one, and a pending reminder isn't brought forward to a time that
+has already passed, so studying while other facts are overdue (or rating a
+fact so that it is due again today) doesn't trigger another reminder right
+away. Users who are in the middle of a conversation are reminded once their
+conversation state has expired.
+
+Due reminders are sent most overdue first and paced at REMINDER_SEND_RATE,
+so that a large number of users becoming due at once doesn't turn into a
+burst of Send API calls (and of replies to the webhook). The rate is only
+raised when needed to send the whole backlog within
+REMINDER_SPREAD_WINDOW_SECONDS. How far the oldest due reminder is behind
+schedule is reported as the reminders.lag_seconds gauge.
+"""
+REMINDER_QUEUE_KEY = "reminders:queue"
+# When each user was last reminded.
+REMINDER_LAST_SENT_KEY = "reminders:last_sent"
+
+# How long to wait before reminding again a user who hasn't studied yet.
+REMINDER_INTERVAL_SECONDS = int(os.environ.get("REMINDER_INTERVAL_SECONDS", 24 * 3600))
+REMINDER_RETRY_SECONDS = int(os.environ.get("REMINDER_RETRY_SECONDS", 60))
+# Upper bound on how long the scheduler sleeps, so newly scheduled reminders
+#   that are due sooner than anything else are picked up quickly.
+REMINDER_POLL_SECONDS = float(os.environ.get("REMINDER_POLL_SECONDS", 1))
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", 100))
+REMINDER_SEND_RATE = float(os.environ.get("REMINDER_SEND_RATE", 5))
+REMINDER_SPREAD_WINDOW_SECONDS = float(os.environ.get("REMINDER_SPREAD_WINDOW_SECONDS", 15 * 60))
+
+
+def reminder_time(due_at, silence_end_time=None):
+    """
+    Return when a user should next be reminded as a UTC timestamp, given the
+    timestamp of their earliest due fact. Returns None if nothing is due.
+    """
+    if due_at is None:
+        return None
+    if silence_end_time is not None:
+        return max(due_at, due_queue.due_score(silence_end_time))
+    return due_at
+
+
+def reschedule(user_id, silence_end_time=None, client=None, now=None):
+    """
+    Recompute when the user should next be reminded. Called whenever the
+    user's earliest due date or silence period may have changed.
+    """
+    client = core.cache if client is None else client
+    now = time.time() if now is None else now
+    try:
+        due_at = due_queue.earliest_due(client, user_id, lambda: core.load_due_schedule(user_id, client))
+        when = reminder_time(due_at, silence_end_time)
+        if when is not None:
+            when = hold_back(client, user_id, when, now)
+        schedule_reminder(client, user_id, when)
+    except Exception as e:
+        print("ERROR: Failed to reschedule reminder for user %s" % user_id)
+        print("ERROR: Reason: %s" % str(e))
+
+
+def hold_back(client, user_id, when, now):
+    """
+    Return when, moved to no sooner than REMINDER_INTERVAL_SECONDS after the
+    user's last reminder. If when has already passed, the user's pending
+    reminder is kept if it is later.
+    """
+    pipe = client.pipeline(transaction=False)
+    pipe.hget(REMINDER_LAST_SENT_KEY, user_id)
+    pipe.zscore(REMINDER_QUEUE_KEY, user_id)
+    last_sent, pending = pipe.execute()
+    if last_sent is not None:
+        when = max(when, float(last_sent) + REMINDER_INTERVAL_SECONDS)
+    if pending is not None and when <= now:
+        when = max(when, pending)
+    return when
+
+
+def schedule_reminder(client, user_id, when):
+    if when is None:
+        client.zrem(REMINDER_QUEUE_KEY, user_id)
+    else:
+        client.zadd(REMINDER_QUEUE_KEY, {user_id: when})
+
+
+def send_rate(backlog, target_rate=REMINDER_SEND_RATE, window_seconds=REMINDER_SPREAD_WINDOW_SECONDS):
+    """
+    Return the number of reminders to send per second: the target rate, or
+    whatever is needed to send the backlog within the window.
+    """
+    return max(target_rate, backlog / window_seconds)
+
+
+class Pacer:
+    """Spaces out calls to wait() so they happen at most at a given rate"""
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.next_slot = 0
+
+    def wait(self, rate):
+        now = self.clock()
+        if self.next_slot > now:
+            self.sleep(self.next_slot - now)
+            now = self.next_slot
+        self.next_slot = now + 1.0 / rate
+
+
+def fire_due_reminders(client=None, now=None, batch_size=REMINDER_BATCH_SIZE, pacer=None):
+    """
+    Send the reminders that are due, most overdue first, pacing the sends with
+    pacer if one is given. Returns the number of entries processed.
+    """
+    client = core.cache if client is None else client
+    now = time.time() if now is None else now
+    due = client.zrangebyscore(REMINDER_QUEUE_KEY, '-inf', now, start=0, num=batch_size, withscores=True)
+    if not due:
+        report_lag(0, 0)
+        return 0
+
+    backlog = client.zcount(REMINDER_QUEUE_KEY, '-inf', now)
+    rate = send_rate(backlog)
+    report_lag(now - due[0][1], backlog)
+    print("DEBUG: %d reminders due, %.1f seconds behind schedule, sending %.2f/s." %
+          (backlog, now - due[0][1], rate))
+
+    for member, score in due:
+        if pacer:
+            pacer.wait(rate)
+        # Removing the entry claims it, in case another scheduler is running.
+        if not client.zrem(REMINDER_QUEUE_KEY, member):
+            continue
+        user_id = int(member)
+        sent_at = max(now, time.time())
+        try:
+            remind(user_id, client, sent_at)
+        except Exception as e:
+            print("ERROR: Failed to remind user %s" % user_id)
+            print("ERROR: Reason: %s" % str(e))
+            core.db.session.rollback()
+            schedule_reminder(client, user_id, sent_at + REMINDER_RETRY_SECONDS)
+    return len(due)
+
+
+def report_lag(lag_seconds, backlog):
+    metrics.set_gauge("reminders.lag_seconds", lag_seconds)
+    metrics.set_gauge("reminders.backlog", backlog)
+
+
+def remind(user_id, client, now):
+    """
+    Remind the user to study if they are due and not silenced, and schedule
+    their next reminder. Returns True if a reminder was sent.
+    """
+    user = core.User.query.get(user_id)
+    if user is None:
+        return False
+    fact = core.get_next_due_fact(user_id, client)
+    due_at = due_queue.due_score(fact.next_due_date) if fact else None
+    when = reminder_time(due_at, user.silence_end_time)
+    if when is None or when > now:
+        schedule_reminder(client, user_id, when)
+        metrics.incr("reminders.deferred")
+        return False
+
+    convo_state = core.load_convo_state(user.fb_id, client)
+    if (convo_state is not None and convo_state.state != core.State.DEFAULT):
+        # Don't interrupt the user; their state expires if they walk away.
+        schedule_reminder(client, user_id, now + core.CACHE_EXPIRATION_IN_SECONDS)
+        metrics.incr("reminders.deferred")
+        return False
+
+    send_reminder(user, fact, client)
+    client.hset(REMINDER_LAST_SENT_KEY, user_id, now)
+    schedule_reminder(client, user_id, now + REMINDER_INTERVAL_SECONDS)
+    metrics.incr("reminders.sent")
+    metrics.observe("reminders.delay_seconds", now - when)
+    return True
+
+
+def send_reminder(user, fact, client=None):
+    core.send_message(user.fb_id, "Time to study!", False)
+    if (fact.attachment_id):
+        core.send_image(user.fb_id, fact.attachment_id, False)
+    core.send_message(user.fb_id, fact.question, False)
+    convo_state = core.ConvoState(user_id=user.id, state=core.State.EXPECTING_STUDY_ANSWER)
+    convo_state.tmp_fact = fact
+    core.store_convo_state(user.fb_id, convo_state, client)
+
+
+def rebuild(client=None):
+    """
+    Schedule every user from the database. Only needed to bootstrap the
+    scheduler or to recover a lost queue.
+    """
+    client = core.cache if client is None else client
+    users = core.get_all_users()
+    for user in users:
+        reschedule(user.id, user.silence_end_time, client)
+    print("DEBUG: Scheduled reminders for %d users." % len(users))
+
+
+def seconds_until_next(client, now=None):
+    now = time.time() if now is None else now
+    first = client.zrange(REMINDER_QUEUE_KEY, 0, 0, withscores=True)
+    if not first:
+        return REMINDER_POLL_SECONDS
+    return min(max(first[0][1] - now, 0), REMINDER_POLL_SECONDS)
+
+
+def run_scheduler(client=None):
+    client = core.cache if client is None else client
+    if not client.exists(REMINDER_QUEUE_KEY):
+        rebuild(client)
+    pacer = Pacer()
+    while True:
+        try:
+            fire_due_reminders(client, pacer=pacer)
+            core.db.session.remove()
+            time.sleep(seconds_until_next(client))
+        except Exception as e:
+            print("ERROR: Reminder scheduler failed")
+            print("ERROR: Reason: %s" % str(e))
+            time.sleep(1)
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    print("DEBUG: Reminder scheduler is running!")
+    core.log_startup_time("reminders")
+    run_scheduler()
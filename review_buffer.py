@@ -0,0 +1,299 @@
+from sqlalchemy.orm.attributes import set_committed_value
+
+import json
+import os
+import socket
+import time
+import uuid
+
+import core
+import due_queue
+import fact_cache
+import metrics
+
+
+"""
+Write-behind buffering of study review results.
+
+When REVIEW_WRITE_BEHIND is enabled a rating is acknowledged as soon as the
+review is appended to a Redis stream. A flusher process (run this module)
+applies buffered reviews to the facts table in batched transactions.
+
+Applied reviews are appended to the reviews log table with one multi-row
+INSERT per batch.
+
+Every review carries the fact's last_seen value from before the review. The
+flusher only updates a fact whose last_seen still matches, so a review that is
+delivered twice (e.g. the flusher died between commit and XACK) is applied
+exactly once.
+
+Until a review is flushed, its result is kept in a per-user hash that
+get_next_due_fact overlays on the facts it loads (read-your-writes), and the
+fact's new due date is written to the user's due queue straight away.
+"""
+REVIEW_STREAM = "reviews:stream"
+REVIEW_GROUP = "review-flushers"
+PENDING_REVIEWS_KEY = "reviews:pending:%s"
+
+FLUSH_BATCH_SIZE = int(os.environ.get("REVIEW_FLUSH_BATCH_SIZE", 500))
+FLUSH_BLOCK_MS = int(os.environ.get("REVIEW_FLUSH_BLOCK_MS", 1000))
+
+# Note: Heroku keeps DYNO stable across restarts, so a restarted flusher picks
+#   up the reviews it had read but not acknowledged.
+CONSUMER_NAME = os.environ.get("DYNO", socket.gethostname())
+
+
+class _Schedule(core.CompactSchedule):
+    """Scheduling fields of a fact, detached from the database session"""
+    COLUMNS = ('easiness_hundredths', 'consecutive_correct_answers', 'due_day', 'last_seen', 'interval_days',
+               'first_reviewed_at')
+
+    def __init__(self, easiness_hundredths, consecutive_correct_answers, due_day, last_seen, interval_days=None,
+                 first_reviewed_at=None):
+        self.easiness_hundredths = easiness_hundredths
+        self.consecutive_correct_answers = consecutive_correct_answers
+        self.due_day = due_day
+        self.last_seen = last_seen
+        self.interval_days = interval_days
+        self.first_reviewed_at = first_reviewed_at
+
+    @staticmethod
+    def of(fact):
+        return _Schedule(fact.easiness_hundredths, fact.consecutive_correct_answers, fact.due_day, fact.last_seen,
+                         fact.interval_days, fact.first_reviewed_at)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'easiness_hundredths': self.easiness_hundredths,
+            'consecutive_correct_answers': self.consecutive_correct_answers,
+            'due_day': self.due_day,
+            'last_seen': self.last_seen.isoformat(),
+            'interval_days': self.interval_days,
+            'first_reviewed_at': self.first_reviewed_at.isoformat() if self.first_reviewed_at else None
+        }
+
+    @staticmethod
+    def deserialize(data):
+        return _Schedule(data['easiness_hundredths'],
+                         data['consecutive_correct_answers'],
+                         data['due_day'],
+                         core.parse_date_time(data['last_seen']),
+                         data['interval_days'],
+                         core.parse_date_time(data['first_reviewed_at']))
+
+
+def record_review(sender_id, fact, perf_rating, client=None):
+    """
+    Buffer the result of reviewing fact. Returns the review's id.
+    """
+    client = core.cache if client is None else client
+    review_id = uuid.uuid4().hex
+    before = _Schedule.of(fact)
+    after = _Schedule.of(fact)
+    previous_interval = before.interval_days
+    new_interval = core.apply_sm2_rating(after, perf_rating)
+
+    pending = after.serialize
+    pending['review_id'] = review_id
+
+    pipe = client.pipeline()
+    pipe.xadd(REVIEW_STREAM, {
+        'review_id': review_id,
+        'sender_id': sender_id,
+        'fact_id': fact.id,
+        'user_id': fact.user_id,
+        'rating': perf_rating,
+        # Note: Stream fields can't be None.
+        'previous_interval': '' if previous_interval is None else previous_interval,
+        'new_interval': new_interval,
+        'before': json.dumps(before.serialize),
+        'after': json.dumps(after.serialize)
+    })
+    pipe.hset(PENDING_REVIEWS_KEY % fact.user_id, fact.id, json.dumps(pending))
+    pipe.execute()
+    due_queue.schedule(client, fact.user_id, fact.id, after.next_due_date)
+    metrics.incr("reviews.buffered")
+    return review_id
+
+
+def overlay_pending_reviews(user_id, facts, client=None):
+    """
+    Replace the scheduling fields of facts with the results of reviews that
+    haven't been flushed yet. The facts are not marked as modified.
+    """
+    client = core.cache if client is None else client
+    pending = client.hgetall(PENDING_REVIEWS_KEY % user_id)
+    if not pending:
+        return facts
+
+    for fact in facts:
+        data = pending.get(str(fact.id).encode())
+        if data:
+            schedule = _Schedule.deserialize(json.loads(data))
+            for column in _Schedule.COLUMNS:
+                set_committed_value(fact, column, getattr(schedule, column))
+    return facts
+
+
+def pending_due_dates(user_id, client=None):
+    """
+    Return {fact_id: next_due_date} for the user's reviews that haven't been
+    flushed yet.
+    """
+    client = core.cache if client is None else client
+    pending = client.hgetall(PENDING_REVIEWS_KEY % user_id)
+    return dict((int(fact_id), _Schedule.deserialize(json.loads(data)).next_due_date)
+                for fact_id, data in pending.items())
+
+
+def discard_pending(user_id, fact_ids, client=None):
+    """
+    Forget the unflushed reviews of facts that were deleted or reset (call
+    after committing). The flusher skips them, because the facts' last_seen
+    no longer matches.
+    """
+    client = core.cache if client is None else client
+    if fact_ids:
+        client.hdel(PENDING_REVIEWS_KEY % user_id, *fact_ids)
+
+
+def apply_reviews(session, reviews):
+    """
+    Apply reviews to the facts table and append them to the review log in the
+    session's current transaction. Returns the number of reviews that changed
+    a fact.
+    """
+    facts = core.Fact.__table__
+    log_rows = []
+    moves = []
+    counts = []
+    for review in reviews:
+        before = _Schedule.deserialize(json.loads(review['before']))
+        after = _Schedule.deserialize(json.loads(review['after']))
+        result = session.execute(facts.update()
+            .where(facts.c.id == int(review['fact_id']))
+            .where(facts.c.last_seen == before.last_seen)
+            .values(easiness_hundredths=after.easiness_hundredths,
+                    consecutive_correct_answers=after.consecutive_correct_answers,
+                    due_day=after.due_day,
+                    last_seen=after.last_seen,
+                    interval_days=after.interval_days,
+                    first_reviewed_at=after.first_reviewed_at))
+        if result.rowcount:
+            log_rows.append({
+                'fact_id': int(review['fact_id']),
+                'user_id': int(review['user_id']),
+                'rating': int(review['rating']),
+                'reviewed_at': after.last_seen,
+                'previous_interval': int(review['previous_interval']) if review['previous_interval'] else None,
+                'new_interval': int(review['new_interval'])
+            })
+            moves.append((int(review['user_id']), before.due_day, after.due_day))
+            if core.is_unstudied(before):
+                counts.append((int(review['user_id']), 0, -1))
+        else:
+            # Already applied, or the fact was deleted or changed since.
+            metrics.incr("reviews.flush_skipped")
+    core.log_reviews(session, log_rows)
+    core.adjust_due_counts(session, moves)
+    core.adjust_fact_counts(session, counts)
+    return len(log_rows)
+
+
+def flush(client=None, consumer=CONSUMER_NAME, batch_size=FLUSH_BATCH_SIZE, block_ms=None):
+    """
+    Apply one batch of buffered reviews. Returns the number of stream entries
+    processed.
+    """
+    client = core.cache if client is None else client
+    ensure_group(client)
+
+    # Reviews this consumer read but never acknowledged come first.
+    entries = _read(client, consumer, '0', batch_size, None)
+    if not entries:
+        entries = _read(client, consumer, '>', batch_size, block_ms)
+    if not entries:
+        return 0
+
+    start = time.time()
+    reviews = [_decode(fields) for entry_id, fields in entries]
+    session = core.db.session
+    try:
+        applied = apply_reviews(session, reviews)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+
+    fact_cache.bump_versions(sorted(set(int(review['user_id']) for review in reviews)), client)
+    client.xack(REVIEW_STREAM, REVIEW_GROUP, *[entry_id for entry_id, fields in entries])
+    for review in reviews:
+        _clear_pending(client, review)
+
+    metrics.incr("reviews.flushed", applied)
+    metrics.observe("reviews.flush_batch_seconds", time.time() - start)
+    print("DEBUG: Flushed %d of %d buffered reviews." % (applied, len(reviews)))
+    return len(entries)
+
+
+def ensure_group(client):
+    from redis.exceptions import ResponseError
+    try:
+        client.xgroup_create(REVIEW_STREAM, REVIEW_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def run_flusher():
+    while True:
+        try:
+            flush(block_ms=FLUSH_BLOCK_MS)
+        except Exception as e:
+            print("ERROR: Failed to flush reviews")
+            print("ERROR: Reason: %s" % str(e))
+            time.sleep(1)
+
+
+def _read(client, consumer, stream_id, count, block_ms):
+    response = client.xreadgroup(REVIEW_GROUP, consumer, {REVIEW_STREAM: stream_id},
+                                 count=count, block=block_ms)
+    if not response:
+        return []
+    return response[0][1]
+
+
+def _decode(fields):
+    return dict((key.decode(), value.decode()) for key, value in fields.items())
+
+
+def _clear_pending(client, review):
+    """
+    Drop the read-your-writes entry for the review, unless a newer review of
+    the same fact replaced it in the meantime.
+    """
+    from redis.exceptions import WatchError
+    key = PENDING_REVIEWS_KEY % review['user_id']
+    with client.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            pending = pipe.hget(key, review['fact_id'])
+            if pending and json.loads(pending)['review_id'] == review['review_id']:
+                pipe.multi()
+                pipe.hdel(key, review['fact_id'])
+                pipe.execute()
+        except WatchError:
+            pass
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    print("DEBUG: Review flusher is running!")
+    core.log_startup_time("review_flusher")
+    run_flusher()
@@ -1,187 +1,125 @@
-from flask import Flask, request
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Blueprint, request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decimal import Decimal
-from dateutil import parser
+from sqlalchemy.orm import load_only
 
 import pytz
 import json
-import requests
 import os
-import enum
-import redis
+import re
+import threading
 import time
 
+import attachments
+import budgets
+import metrics
+import profiling
+from core import (db, cache, User, Fact, ConvoState, State, RANDOM_PHRASES,
+                  USAGE_INSTRUCTIONS, MIN_CONFIDENCE_THRESHOLD, DEFAULT_EASINESS,
+                  FB_MAX_MESSAGE_LENGTH, get_user, list_user_facts, find_user_fact, get_next_due_fact,
+                  review_fact, log_reviews, adjust_due_counts, adjust_fact_counts, is_unstudied,
+                  count_due_facts, delete_user_facts, reset_user_facts,
+                  load_convo_state, store_convo_state,
+                  change_typing_indicator, get_users_firstname, format_date_time,
+                  parse_date_time, log_startup_time)
+import core
+import due_queue
+import fact_cache
+import forecast
+import intent_classifier
+import reminders
+import review_buffer
+import tracing
+import warmup
+import webhook_replay
+from typing_indicator import TypingIndicatorManager
 
-print("DEBUG: Executing init.")
-
-# Create the Flask application instance.
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
 
 #===============================================================================
 # Constants
 #===============================================================================
-# See https://developers.facebook.com/docs/messenger-platform/reference/send-api
-SEND_API_URL = "https://graph.facebook.com/v2.6/me/messages"
-
-RANDOM_PHRASES = [
-    "Hey %s, how the heck are ya? Me, you ask? I'm feeling a little blue. :)",
-    "Studying again %s? Look at you! We gotta future Rhodes scholar here!",
-    "You want to study right now, %s? Nerd Alert! Nerds are so in right now!"
-]
-
-USAGE_INSTRUCTIONS = ("Below is a list of my primary functionality:\n" +
-    "- 'I want to add a fact.'\n" +
-    "- 'I want to view all facts.'\n" +
-    "- 'I want to change a fact.'\n" +
-    "- 'I want to delete a fact.'\n" +
-    "- 'I want to study.'\n" +
-    "- 'I want to silence studying for x days.'\n")
-
-"""
-Note: This is a trade-off between "precision" and "recall" as discussed here:
-https://wit.ai/docs/recipes#which-confidence-threshold-should-i-use
-"""
-MIN_CONFIDENCE_THRESHOLD = 0.7
+# Only show the typing indicator when a response takes longer than this.
+TYPING_INDICATOR_THRESHOLD_SECONDS = float(os.environ.get("TYPING_INDICATOR_THRESHOLD_MS", 500)) / 1000
 
-# Value described by the SM2 Algorithm.
-DEFAULT_EASINESS = 2.5
+# Number of senders from one webhook payload whose events are handled at once.
+WEBHOOK_BATCH_WORKERS = int(os.environ.get("WEBHOOK_BATCH_WORKERS", 4))
 
-# Expire cached entries after 5 minutes
-CACHE_EXPIRATION_IN_SECONDS = 300
+# Sent instead of the replies to a sender's events when their changes couldn't be committed.
+COMMIT_FAILED_MESSAGE = "Sorry, something went wrong and I couldn't save that. Can you try again?"
 
-# FB Message Post Max Length
-FB_MAX_MESSAGE_LENGTH = 640
+# Sent in reply to an event of a batch that failed and was rolled back on its own.
+EVENT_FAILED_MESSAGE = "Sorry, something went wrong with that message. Can you try again?"
 
 
 #===============================================================================
-# DB Classes
+# Global Data
 #===============================================================================
-class User(db.Model):
-    __tablename__ = 'users'
-    id = db.Column(db.Integer, primary_key=True)
-    fb_id = db.Column(db.String, unique=True)
-    silence_end_time = db.Column(db.DateTime)
-    facts = db.relationship('Fact', lazy='select', backref=db.backref('users', lazy='joined'))
-
-    def __init__(self, fb_id):
-        self.fb_id = fb_id
-
-    def __repr__(self):
-        return '<FB ID %r>' % self.fb_id
-
-    @property
-    def serialize(self):
-        """Return object data in easily serializeable format"""
-        return {
-            'id': self.id,
-            'fb_id': self.fb_id,
-            'silence_end_time': self.serialize_date_time,
-            'facts': self.serialize_one2many
-        }
-
-    @property
-    def serialize_one2many(self):
-       """
-       Return object's relations in easily serializeable format.
-       NB! Calls many2many's serialize property.
-       """
-       return [item.serialize for item in self.facts]
-
-    def serialize_date_time(self):
-        if isinstance(self.silence_end_time, datetime):
-            return self.silence_end_time.isoformat()
-        return None
+class _PerThread:
+    """
+    Proxy for an object that each thread sets separately, so that events from
+    different senders can be handled concurrently (see handle_message_events).
+    """
+    def __init__(self):
+        object.__setattr__(self, "_local", threading.local())
 
-class Fact(db.Model):
-    __tablename__ = 'facts'
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    question = db.Column(db.String, unique=True)
-    answer = db.Column(db.String, nullable=False)
-    easiness = db.Column(db.Numeric, nullable=True, default=DEFAULT_EASINESS)
-    consecutive_correct_answers = db.Column(db.Integer, nullable=False, default=0)
-    last_seen = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    next_due_date = db.Column(db.DateTime)
-    __table_args__ = (
-        db.Index('user_id_question', 'user_id', db.text("lower(question)")),
-        db.CheckConstraint('easiness >= 0', name='check_easiness')
-    )
-
-    def __repr__(self):
-        return '<Fact %d: Q: %s A: %s>' % (self.user_id, self.question, self.answer)
-
-    @property
-    def serialize(self):
-        """Return object data in easily serializeable format"""
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'question': self.question,
-            'answer': self.answer,
-            'easiness': self.serialize_numeric(),
-            'consecutive_correct_answers': self.consecutive_correct_answers,
-            'last_seen': self.serialize_date_time('last_seen'),
-            'next_due_date': self.serialize_date_time('next_due_date')
-        }
-
-    def serialize_numeric(self):
-        if isinstance(self.easiness, Decimal):
-            return float(self.easiness)
-        return float(0)
-
-    def serialize_date_time(self, column):
-        if column == 'last_seen':
-            if isinstance(self.last_seen, datetime):
-                return self.last_seen.isoformat()
-        elif column == 'next_due_date':
-            if isinstance(self.next_due_date, datetime):
-                return self.next_due_date.isoformat()
-        return None
+    def _get(self):
+        return getattr(self._local, "value", None)
 
-#===============================================================================
-# General Classes
-#===============================================================================
-class ConvoState:
-    def __init__(self, user_id, state=None):
-        self.user_id = user_id
-        self.tmp_fact = Fact(user_id=user_id)
-        self.state = State.DEFAULT if state is None else state
-
-    @property
-    def serialize(self):
-        """Return object data in easily serializeable format"""
-        return {
-            'user_id': self.user_id,
-            'tmp_fact': self.tmp_fact.serialize,
-            'state': self.state.value
-        }
+    def _set(self, value):
+        self._local.value = value
 
-"""
-The following states are used to create a conversation flow.
-"""
-class State(enum.Enum):
-    DEFAULT                           = 0
-    EXPECTING_FACT_QUESTION           = 1
-    EXPECTING_FACT_ANSWER             = 2
-    EXPECTING_FACT_ID_FOR_CHANGE      = 3
-    EXPECTING_FACT_ID_FOR_DELETE      = 4
-    EXPECTING_CONFIRMATION_FOR_DELETE = 5
-    EXPECTING_DURATION_FOR_SILENCE    = 6
-    EXPECTING_STUDY_ANSWER            = 7
-    EXPECTING_STUDY_PERF_RATING       = 8
-    EXPECTING_FACT_ID_FOR_DISPLAY     = 9
+    def __bool__(self):
+        return self._get() is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+
+current_user = _PerThread()
+
+# The _SenderBatch being handled by the current thread, if any.
+_batches = threading.local()
+
+batch_executor = ThreadPoolExecutor(max_workers=WEBHOOK_BATCH_WORKERS)
+
+routes = Blueprint('studybot', __name__)
+
+# Note: The lambda looks up change_typing_indicator at call time so it can be
+#   replaced (e.g. mocked) after import.
+typing_indicators = TypingIndicatorManager(
+    lambda enabled, user_id: change_typing_indicator(enabled=enabled, user_id=user_id),
+    TYPING_INDICATOR_THRESHOLD_SECONDS)
+
+# Opt-in sampling of webhook payloads for replay, None unless configured.
+recorder = webhook_replay.recorder_from_env()
 
 
 #===============================================================================
-# Global Data
+# App Factory
 #===============================================================================
-current_user = None
+def create_app():
+    """
+    Create the Flask application instance.
+    No connection is opened here; the database engine and the Redis client
+    are created lazily by the core module on first use.
+    """
+    print("DEBUG: Executing init.")
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+
+    @app.teardown_appcontext
+    def shutdown_session(exception=None):
+        db.session.remove()
 
-cache = redis.from_url(os.environ.get("REDIS_URL"))
+    if (profiling.enabled()):
+        app.wsgi_app = profiling.ProfilingMiddleware(app.wsgi_app)
+
+    log_startup_time("web")
+    return app
 
 
 #===============================================================================
@@ -192,7 +130,7 @@ GET requests are used for authentication.
 Handle GET requests by verifying Facebook is sending the correct token that we
 setup in the facebook app.
 """
-@app.route('/', methods=['GET'])
+@routes.route('/', methods=['GET'])
 def handle_verification():
     print("DEBUG: Handling Verification.")
     if request.args.get('hub.verify_token', '') == get_verif_token():
@@ -207,11 +145,13 @@ POST requests are for communication.
 Handle POST requests by interpretting the user message, then sending the
 appropriate response.
 """
-@app.route('/', methods=['POST'])
+@routes.route('/', methods=['POST'])
 def handle_messages():
     print("DEBUG: Handling Messages")
     payload = request.get_json()
     print(payload)
+    if (recorder and payload):
+        recorder.record(payload)
 
     """
     Note: For more information on what is being processed here, see the webhook
@@ -220,6 +160,7 @@ def handle_messages():
     if (payload):
         # The webhook event should only be coming from a Page subscription.
         if (payload.get("object") == "page"):
+            message_events = []
             # The "entry" is an array and could contain multiple webhook events.
             for entry in payload["entry"]:
                 # The "messaging" event occurs when a message is sent to our page.
@@ -230,221 +171,8 @@ def handle_messages():
                         pass
 
                     if (messaging_event.get("message")):
-                        """
-                        Note: The ID is a page-scoped ID (PSID). It is a unique
-                        identifier for a given person interacting with a given page.
-                        """
-                        sender_id = messaging_event["sender"]["id"]
-                        if messaging_event["message"].get("text"):
-                            sender_msg = messaging_event["message"]["text"].encode('unicode_escape')
-                        else:
-                            sender_msg = "Not text"
-                        if messaging_event["message"].get("nlp"):
-                            nlp = messaging_event["message"]["nlp"]
-                        else:
-                            nlp = {"entities": {}}
-
-                        print("DEBUG: Incoming from %s: %s" % (sender_id, sender_msg))
-                        bot_msg = ""
-
-                        change_typing_indicator(enabled=True, user_id=sender_id)
-
-                        if (is_first_time_user(sender_id)):
-                            create_user(sender_id)
-                            send_welcome_message(sender_id)
-                            set_convo_state(sender_id, State.DEFAULT)
-                        else:
-                            restore_convo_state(sender_id)
-                            print("DEBUG: current_user")
-                            print(current_user.serialize)
-
-                            convo_state = current_user.state
-
-                            print("DEBUG: Conversation State: " + convo_state.name)
-                            strongest_intent = get_strongest_intent(nlp["entities"], MIN_CONFIDENCE_THRESHOLD)
-                            print("DEBUG: NLP intent: " + strongest_intent)
-
-                            if (convo_state == State.DEFAULT):
-                                if (msg_contains_greeting(nlp["entities"], MIN_CONFIDENCE_THRESHOLD)):
-                                    send_greeting_message(sender_id)
-                                else:
-                                    if (strongest_intent == "add_fact"):
-                                        bot_msg = "Ok, let's add that new fact. What is the question?"
-                                        current_user.tmp_fact = Fact(user_id=current_user.user_id)
-                                        set_convo_state(sender_id, State.EXPECTING_FACT_QUESTION)
-                                    elif (strongest_intent == "change_fact"):
-                                        fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
-                                        state = State.EXPECTING_FACT_ID_FOR_CHANGE
-                                        if fact_id:
-                                            tmp_fact = get_fact(fact_id)
-                                            if tmp_fact:
-                                                current_user.tmp_fact = tmp_fact
-                                                bot_msg = "Ok, let's update that fact. What is the question?"
-                                                state = State.EXPECTING_FACT_QUESTION
-                                            else:
-                                                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                                state = State.DEFAULT
-                                        else:
-                                            bot_msg = "Ok, which fact do you want to change?"
-                                        set_convo_state(sender_id, state)
-                                    elif (strongest_intent == "silence_studying"):
-                                        duration_seconds = get_nlp_duration(nlp['entities'], MIN_CONFIDENCE_THRESHOLD)
-                                        if (duration_seconds):
-                                            target_datetime = set_silence_time(sender_id, duration_seconds)
-                                            bot_msg = "Ok, silencing study notifications until " + str(target_datetime) + "."
-                                        else:
-                                            bot_msg = "Ok, how long do you want to silence notifications for?"
-                                            set_convo_state(sender_id, State.EXPECTING_DURATION_FOR_SILENCE)
-                                    elif (strongest_intent == "view_facts"):
-                                        user = get_user(sender_id)
-                                        if user and len(user.facts) == 0:
-                                            bot_msg = "Whoops! We don't have any facts for you try adding a new fact."
-                                        else:
-                                            send_facts_for_display(sender_id, "Ok, here are the facts we have.")
-                                    elif (strongest_intent == "view_detailed_fact"):
-                                        fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
-                                        state = State.EXPECTING_FACT_ID_FOR_DISPLAY
-                                        if fact_id:
-                                            tmp_fact = get_fact(fact_id)
-                                            if tmp_fact:
-                                                send_facts(sender_id, "Here's the fact.", [tmp_fact], True)
-                                            else:
-                                                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                            state = State.DEFAULT
-                                        else:
-                                            bot_msg = "Ok, which fact do you want details for?"
-                                        set_convo_state(sender_id, state)
-                                    elif (strongest_intent == "delete_fact"):
-                                        fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
-                                        state = State.EXPECTING_FACT_ID_FOR_DELETE
-                                        if fact_id:
-                                            tmp_fact = get_fact(fact_id)
-                                            if tmp_fact:
-                                                current_user.tmp_fact = tmp_fact
-                                                bot_msg = "Are you sure you want to delete this fact?\n"
-                                                bot_msg += "Question: %s\n" % current_user.tmp_fact.question
-                                                state = State.EXPECTING_CONFIRMATION_FOR_DELETE
-                                            else:
-                                                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                                state = State.DEFAULT
-                                        else:
-                                            bot_msg = "Ok, which fact do you want to delete?"
-                                        set_convo_state(sender_id, state)
-                                    elif (strongest_intent == "study_next_fact"):
-                                        fact = get_next_fact_to_study(sender_id)
-                                        if (fact):
-                                            bot_msg = "Ok, let's study!\n"
-                                            bot_msg = bot_msg + fact.question
-                                            set_convo_state(sender_id, State.EXPECTING_STUDY_ANSWER)
-                                        else:
-                                            bot_msg = "No studying needed! You're all caught up."
-                                            set_convo_state(sender_id, State.DEFAULT)
-                                    elif (strongest_intent == "default_intent"):
-                                        bot_msg = "I'm not sure what you mean."
-                                        bot_msg = bot_msg + " " + USAGE_INSTRUCTIONS
-                                        set_convo_state(sender_id, current_user.state)
-                            elif (strongest_intent == "abort"):
-                                bot_msg = "Ok, aborting that request."
-                                set_convo_state(sender_id, State.DEFAULT)
-
-                            elif (convo_state == State.EXPECTING_STUDY_ANSWER):
-                                fact = get_next_fact_to_study(sender_id)
-                                bot_msg = "Here is the answer:\n"
-                                bot_msg = bot_msg + fact.answer
-                                bot_msg = bot_msg + "\nHow hard was that on a scale from 0 (impossible) to 5 (trivial)?"
-                                set_convo_state(sender_id, State.EXPECTING_STUDY_PERF_RATING)
-
-                            elif (convo_state == State.EXPECTING_STUDY_PERF_RATING):
-                                # Get a valid integer from the string response.
-                                valid_rating = False
-                                try:
-                                    performance_rating = int(sender_msg)
-                                    if ((performance_rating >= 0) and (performance_rating <= 5)):
-                                        valid_rating = True
-                                except Exception:
-                                    pass # Error handled by "valid_rating" flag.
-
-                                if (valid_rating):
-                                    update_next_fact_per_SM2_alg(sender_id, performance_rating)
-                                    bot_msg = "Got it, fact studied!"
-                                    set_convo_state(sender_id, State.DEFAULT)
-                                else:
-                                    bot_msg = "I didn't get a number from that, can you try again on a scale from 0 to 5?"
-                                    set_convo_state(sender_id, State.EXPECTING_STUDY_PERF_RATING)
-
-                            elif (convo_state == State.EXPECTING_FACT_ID_FOR_DISPLAY):
-                                tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
-                                if not tmp_fact:
-                                    bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                else:
-                                    current_user.tmp_fact = tmp_fact
-                                    send_facts(sender_id, "Here's the fact.", [tmp_fact], True)
-                                set_convo_state(sender_id, State.DEFAULT)
-
-                            elif (convo_state == State.EXPECTING_FACT_ID_FOR_CHANGE):
-                                tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
-                                if not tmp_fact:
-                                    bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                    state = State.DEFAULT
-                                else:
-                                    current_user.tmp_fact = tmp_fact
-                                    bot_msg = "Ok, let's update that fact. What is the question?"
-                                    state = State.EXPECTING_FACT_QUESTION
-                                set_convo_state(sender_id, state)
-
-                            elif (convo_state == State.EXPECTING_FACT_ID_FOR_DELETE):
-                                tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
-                                if not tmp_fact:
-                                    bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
-                                    state = State.DEFAULT
-                                else:
-                                    current_user.tmp_fact = tmp_fact
-                                    bot_msg = "Are you sure you want to delete this fact?\n"
-                                    bot_msg += "Question: %s\n" % current_user.tmp_fact.question
-                                    state = State.EXPECTING_CONFIRMATION_FOR_DELETE
-                                set_convo_state(sender_id, state)
-
-                            elif (convo_state == State.EXPECTING_CONFIRMATION_FOR_DELETE):
-                                confirmed = strongest_intent == "confirmation"
-                                if confirmed:
-                                    if delete_fact(current_user.tmp_fact.id):
-                                        bot_msg = "Fact deleted successfully."
-                                    else:
-                                        bot_msg = "Failed to delete fact."
-                                else:
-                                    bot_msg = "Ok, I won't delete this fact."
-                                current_user.tmp_fact = Fact(user_id=current_user.user_id)
-                                set_convo_state(sender_id, State.DEFAULT)
-
-                            elif (convo_state == State.EXPECTING_FACT_QUESTION):
-                                current_user.tmp_fact.user_id = current_user.user_id
-                                current_user.tmp_fact.question = sender_msg.decode("unicode_escape")
-                                set_convo_state(sender_id, State.EXPECTING_FACT_ANSWER)
-                                bot_msg = "Thanks, what's the answer to that question?"
-
-                            elif (convo_state == State.EXPECTING_FACT_ANSWER):
-                                current_user.tmp_fact.answer = sender_msg.decode("unicode_escape")
-                                added_update = "update" if current_user.tmp_fact.id else "create"
-                                if upsert_fact(current_user.tmp_fact.id):
-                                    bot_msg = "Ok, I %sd the following question and answer:\n" % added_update
-                                    bot_msg += "Question: %s\n" % current_user.tmp_fact.question
-                                    bot_msg += "Answer: %s" % current_user.tmp_fact.answer
-                                else:
-                                    bot_msg = "We couldn't %s that fact." % added_update
-                                set_convo_state(sender_id, State.DEFAULT)
-
-                            elif (convo_state == State.EXPECTING_DURATION_FOR_SILENCE):
-                                duration_seconds = get_nlp_duration(nlp['entities'], MIN_CONFIDENCE_THRESHOLD)
-                                if (duration_seconds):
-                                    target_datetime = set_silence_time(sender_id, duration_seconds)
-                                    bot_msg = "Ok, silencing study notifications until " + str(target_datetime) + "."
-                                else:
-                                    bot_msg = "Sorry, I couldn't get a duration from that."
-                                set_convo_state(sender_id, State.DEFAULT)
-
-                            send_large_message(sender_id, bot_msg, is_response=True)
-
-                        change_typing_indicator(enabled=False, user_id=sender_id)
+                        message_events.append(messaging_event)
+            handle_message_events(message_events)
         else:
             print("DEBUG: Error: Event object is not a page.")
     else:
@@ -457,55 +185,562 @@ def handle_messages():
     return ("ok", 200)
 
 
-# ===============================================================================
-# Helper Routines
-# ===============================================================================
-def get_next_fact_to_study(sender_id):
+"""
+GET /metrics reports this worker's in-process counters and timings.
+"""
+@routes.route('/metrics', methods=['GET'])
+def handle_metrics():
+    return (json.dumps(metrics.snapshot()), 200, {'Content-type': 'application/json'})
+
+
+"""
+GET /forecast?days=N reports the expected review and reminder volume of all
+users for the next N days, see forecast.py.
+"""
+@routes.route('/forecast', methods=['GET'])
+def handle_forecast():
+    days = request.args.get('days', 7, type=int)
+    return (json.dumps(forecast.forecast(days)), 200, {'Content-type': 'application/json'})
+
+
+"""
+GET /ready reports whether this worker has finished warming up its connections.
+"""
+@routes.route('/ready', methods=['GET'])
+def handle_readiness():
+    status_code = 200 if warmup.is_ready() else 503
+    return (json.dumps(warmup.status()), status_code, {'Content-type': 'application/json'})
+
+
+class _SenderBatch:
+    """What is loaded once for all of a sender's events in one payload"""
+    NOT_LOADED = object()
+
+    def __init__(self, sender_id):
+        self.sender_id = sender_id
+        self.user = _SenderBatch.NOT_LOADED
+        self.convo_state_loaded = False
+        self.convo_state_changed = False
+        self.has_changes = False
+        # Events handled so far; the due queue is only updated after the commit.
+        self.events_handled = 0
+        # (budget usage, function, args, kwargs) to run once the changes are committed.
+        self.after_commit = []
+        # Typing indicators and budget usages of the events, ended once the replies are sent.
+        self.indicators = []
+        self.usages = []
+
+
+def current_batch():
+    return getattr(_batches, "current", None)
+
+
+def after_commit(func, *args, **kwargs):
     """
-    Get the fact with the nearest next_due_date.
+    Call func once the current changes are committed: at the end of the
+    sender's batch of events (not at all if they are rolled back), or right
+    away outside of one. Replies and cache, due queue and reminder updates
+    all go through here, so nothing is sent or cached before it is committed.
     """
-    facts = get_user_facts(sender_id)
-    fact_return = None
-    if (facts):
-        # Try/except block needed for now, since some facts don't have an initialized due date.
+    batch = current_batch()
+    if (batch is None):
+        return func(*args, **kwargs)
+    batch.after_commit.append((budgets.current(), func, args, kwargs))
+
+
+def run_after_commit(batch):
+    for usage, func, args, kwargs in batch.after_commit:
         try:
-            facts.sort(key=lambda x: x.next_due_date)
-            fact_return = facts[0]
-        except Exception:
-            print("ERROR: Exception when sorting facts in get_next_fact_to_study")
+            # Counted towards the event that queued it.
+            with budgets.attribute(usage):
+                func(*args, **kwargs)
+        except Exception as e:
+            print("ERROR: Failed to run %s after commit" % getattr(func, "__name__", func))
+            print("ERROR: Reason: %s" % str(e))
+    batch.after_commit = []
 
-    return (fact_return)
 
+def group_by_sender(messaging_events):
+    """Return [(sender_id, events)] in order of each sender's first event"""
+    groups = OrderedDict()
+    for messaging_event in messaging_events:
+        groups.setdefault(messaging_event["sender"]["id"], []).append(messaging_event)
+    return list(groups.items())
 
-def update_next_fact_per_SM2_alg(user_id, perf_rating):
-    assert ((perf_rating >= 0) and (perf_rating <= 5))
 
-    fact = get_next_fact_to_study(user_id)
+def handle_message_events(messaging_events):
+    """
+    Handle the message events of one webhook payload. Facebook may batch
+    events from many senders into one POST; each sender's events are handled
+    in order by handle_sender_events, and different senders concurrently.
+    """
+    groups = group_by_sender(messaging_events)
+    if (len(groups) == 1):
+        # The common case, handled on the request thread.
+        handle_sender_events(*groups[0])
+        return
+
+    profiled_request = profiling.current_request()
+    futures = [batch_executor.submit(handle_sender_events_in_worker, sender_id, events, profiled_request)
+               for sender_id, events in groups]
+    for future in futures:
+        future.result()
+
+
+def handle_sender_events_in_worker(sender_id, messaging_events, profiled_request=None):
+    try:
+        with profiling.worker(profiled_request):
+            handle_sender_events(sender_id, messaging_events)
+    except Exception as e:
+        print("ERROR: Failed to handle events from %s" % sender_id)
+        print("ERROR: Reason: %s" % str(e))
+    finally:
+        db.session.remove()
+
+
+def handle_sender_events(sender_id, messaging_events):
+    """
+    Handle a sender's events in order, in a single transaction: the user row
+    and conversation state are loaded once, handlers only flush their
+    changes (see commit_changes), and the transaction is committed and the
+    conversation state stored once at the end.
+
+    Replies and cache updates (see after_commit) only go out once the commit
+    succeeded, so the transaction isn't held open while they are sent and
+    the user is never told about a change that was rolled back. Within the
+    batch, later events read the changes of earlier ones from the database
+    but not yet from the Redis caches.
+
+    When there are several events, each one runs in a savepoint so that an
+    event that fails doesn't undo the others. A failed event's conversation
+    state changes are undone with it, and the sender is told it failed.
+    """
+    batch = _SenderBatch(sender_id)
+    _batches.current = batch
+    current_user._set(None)
+    try:
+        for messaging_event in messaging_events:
+            savepoint = db.session.begin_nested() if len(messaging_events) > 1 else None
+            queued = len(batch.after_commit)
+            snapshot = _snapshot_convo_state(batch)
+            try:
+                handle_message_event(messaging_event)
+            except Exception as e:
+                print("ERROR: Failed to handle event from %s" % sender_id)
+                print("ERROR: Reason: %s" % str(e))
+                metrics.incr("webhook.failed_events")
+                if savepoint is None:
+                    db.session.rollback()
+                else:
+                    savepoint.rollback()
+                del batch.after_commit[queued:]
+                discard_cached_facts()
+                _restore_convo_state(batch, snapshot)
+                after_commit(deliver_message, sender_id, EVENT_FAILED_MESSAGE, True)
+            else:
+                if savepoint is None:
+                    pass
+                elif savepoint.is_active:
+                    savepoint.commit()
+                else:
+                    # A handler caught a failed flush; drop what it left behind.
+                    savepoint.rollback()
+            batch.events_handled += 1
+
+        committed = True
+        try:
+            if (batch.has_changes):
+                db.session.commit()
+        except Exception as e:
+            print("ERROR: Failed to commit events from %s" % sender_id)
+            print("ERROR: Reason: %s" % str(e))
+            metrics.incr("webhook.failed_batches")
+            db.session.rollback()
+            discard_cached_facts()
+            committed = False
+
+        if (committed):
+            if (batch.convo_state_changed):
+                store_convo_state(sender_id, current_user._get(), cache)
+            run_after_commit(batch)
+        else:
+            # Keep the previous conversation state so the user can try again.
+            deliver_message(sender_id, COMMIT_FAILED_MESSAGE, True)
+        metrics.observe("webhook.events_per_sender", len(messaging_events))
+    finally:
+        _batches.current = None
+        for indicator in batch.indicators:
+            typing_indicators.end(indicator)
+        for usage in batch.usages:
+            budgets.report(usage)
+
+
+def _snapshot_convo_state(batch):
+    convo_state = current_user._get()
+    return (batch.user, batch.convo_state_loaded, batch.convo_state_changed,
+            None if convo_state is None else json.dumps(convo_state.serialize))
+
+
+def _restore_convo_state(batch, snapshot):
+    batch.user, batch.convo_state_loaded, batch.convo_state_changed, convo_state = snapshot
+    current_user._set(None if convo_state is None else ConvoState.deserialize(convo_state))
+
+
+def next_due_fact(user_id):
+    """
+    get_next_due_fact, read from the database instead of the due queue once
+    earlier events of the sender's batch may have changed it, since the queue
+    is only updated after the batch is committed.
+    """
+    batch = current_batch()
+    return get_next_due_fact(user_id, cache, from_queue=(batch is None or batch.events_handled == 0))
+
 
-    # Update consecutive correct answers.
-    if (perf_rating >= 3):
-        fact.consecutive_correct_answers = fact.consecutive_correct_answers + 1
+def commit_changes():
+    """
+    Commit the session, or only flush it while a sender's events are being
+    handled (handle_sender_events commits once at the end).
+    """
+    batch = current_batch()
+    if (batch is None):
+        db.session.commit()
     else:
-        fact.consecutive_correct_answers = 0
+        db.session.flush()
+        batch.has_changes = True
 
-    # Update next due date.
-    if (fact.consecutive_correct_answers == 1):
-        interval = 1
-    elif (fact.consecutive_correct_answers == 2):
-        interval = 6
+
+def discard_cached_facts():
+    """
+    Rebuild the current user's due queue and cached facts from the database
+    after changes to them were rolled back.
+    """
+    if (current_user):
+        due_queue.drop(cache, current_user.user_id)
+        fact_cache.bump_versions([current_user.user_id], cache)
+
+
+def load_user(sender_id):
+    """get_user, loading the row only once per batch of the sender's events"""
+    batch = current_batch()
+    if (batch is None or batch.sender_id != sender_id):
+        return get_user(sender_id)
+    if (batch.user is _SenderBatch.NOT_LOADED):
+        batch.user = get_user(sender_id)
+    return batch.user
+
+
+def handle_message_event(messaging_event):
+    """
+    Note: The ID is a page-scoped ID (PSID). It is a unique
+    identifier for a given person interacting with a given page.
+    """
+    sender_id = messaging_event["sender"]["id"]
+    if messaging_event["message"].get("text"):
+        sender_msg = messaging_event["message"]["text"].encode('unicode_escape')
+    else:
+        sender_msg = "Not text"
+    if messaging_event["message"].get("nlp"):
+        nlp = messaging_event["message"]["nlp"]
+    else:
+        nlp = {"entities": {}}
+
+    image_url = attachments.image_url(messaging_event["message"])
+
+    print("DEBUG: Incoming from %s: %s" % (sender_id, sender_msg))
+    strongest_intent = get_strongest_intent(nlp["entities"], MIN_CONFIDENCE_THRESHOLD,
+                                            messaging_event["message"].get("text"))
+
+    batch = current_batch()
+    with tracing.trace("webhook_event", sender=sender_id, intent=strongest_intent):
+        # Note: In a batch, the replies are sent after the events are handled.
+        with budgets.track(strongest_intent, None if batch is None else batch.usages):
+            indicator = typing_indicators.begin(sender_id, strongest_intent)
+            try:
+                respond_to_message(sender_id, sender_msg, nlp, strongest_intent, image_url)
+            finally:
+                if (batch is None):
+                    typing_indicators.end(indicator)
+                else:
+                    batch.indicators.append(indicator)
+
+
+def respond_to_message(sender_id, sender_msg, nlp, strongest_intent, image_url=None):
+    bot_msg = ""
+
+    if (is_first_time_user(sender_id)):
+        create_user(sender_id)
+        send_welcome_message(sender_id)
+        set_convo_state(sender_id, State.DEFAULT)
     else:
-        interval = int(fact.consecutive_correct_answers * fact.easiness)
-    fact.next_due_date = fact.next_due_date + timedelta(days=interval)
+        restore_convo_state(sender_id)
+        print("DEBUG: current_user")
+        print(current_user.serialize)
+
+        convo_state = current_user.state
+
+        print("DEBUG: Conversation State: " + convo_state.name)
+        print("DEBUG: NLP intent: " + strongest_intent)
+        tracing.set_attribute("state", convo_state.name)
+        if (convo_state != State.DEFAULT):
+            budgets.set_flow(convo_state.name)
+
+        if (convo_state == State.DEFAULT):
+            if (msg_contains_greeting(nlp["entities"], MIN_CONFIDENCE_THRESHOLD)):
+                send_greeting_message(sender_id)
+            else:
+                if (strongest_intent == "add_fact"):
+                    bot_msg = "Ok, let's add that new fact. What is the question?"
+                    current_user.tmp_fact = Fact(user_id=current_user.user_id)
+                    set_convo_state(sender_id, State.EXPECTING_FACT_QUESTION)
+                elif (strongest_intent == "change_fact"):
+                    fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
+                    state = State.EXPECTING_FACT_ID_FOR_CHANGE
+                    if fact_id:
+                        tmp_fact = get_fact(fact_id)
+                        if tmp_fact:
+                            current_user.tmp_fact = tmp_fact
+                            bot_msg = "Ok, let's update that fact. What is the question?"
+                            state = State.EXPECTING_FACT_QUESTION
+                        else:
+                            bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                            state = State.DEFAULT
+                    else:
+                        bot_msg = "Ok, which fact do you want to change?"
+                    set_convo_state(sender_id, state)
+                elif (strongest_intent == "silence_studying"):
+                    duration_seconds = get_nlp_duration(nlp['entities'], MIN_CONFIDENCE_THRESHOLD)
+                    if (duration_seconds):
+                        target_datetime = set_silence_time(sender_id, duration_seconds)
+                        bot_msg = "Ok, silencing study notifications until " + str(target_datetime) + "."
+                    else:
+                        bot_msg = "Ok, how long do you want to silence notifications for?"
+                        set_convo_state(sender_id, State.EXPECTING_DURATION_FOR_SILENCE)
+                elif (strongest_intent == "view_facts"):
+                    user = load_user(sender_id)
+                    if (user.fact_count == 0):
+                        bot_msg = "Whoops! We don't have any facts for you try adding a new fact."
+                    else:
+                        # Note: The counts come from the counters and the due_counts rollup, not the deck.
+                        header = ("Ok, here are the %d facts we have, %d due now and %d never studied." %
+                                  (user.fact_count, count_due_facts(user.id), user.unstudied_fact_count))
+                        send_facts(sender_id, header, list_user_facts(sender_id))
+                elif (strongest_intent == "view_detailed_fact"):
+                    fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
+                    state = State.EXPECTING_FACT_ID_FOR_DISPLAY
+                    if fact_id:
+                        tmp_fact = get_fact(fact_id)
+                        if tmp_fact:
+                            send_facts(sender_id, "Here's the fact.", [tmp_fact], True)
+                        else:
+                            bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                        state = State.DEFAULT
+                    else:
+                        bot_msg = "Ok, which fact do you want details for?"
+                    set_convo_state(sender_id, state)
+                elif (strongest_intent == "reset_progress"):
+                    selection = parse_reset_selection(sender_msg.decode("unicode_escape"))
+                    if (selection is not None):
+                        bot_msg = confirm_bulk_operation(sender_id, "reset", selection)
+                    else:
+                        bot_msg = "Ok, which facts do you want to reset? Send an ID, \"facts 3-7\" or \"all facts\"."
+                        set_convo_state(sender_id, State.EXPECTING_FACT_IDS_FOR_RESET)
+                elif (strongest_intent == "delete_fact"):
+                    selection = parse_fact_selection(sender_msg.decode("unicode_escape"))
+                    if (selection is not None):
+                        bot_msg = confirm_bulk_operation(sender_id, "delete", selection)
+                    else:
+                        fact_id = extract_fact_id(sender_msg.decode("unicode_escape"))
+                        state = State.EXPECTING_FACT_ID_FOR_DELETE
+                        if fact_id:
+                            tmp_fact = get_fact(fact_id)
+                            if tmp_fact:
+                                current_user.tmp_fact = tmp_fact
+                                bot_msg = "Are you sure you want to delete this fact?\n"
+                                bot_msg += "Question: %s\n" % current_user.tmp_fact.question
+                                state = State.EXPECTING_CONFIRMATION_FOR_DELETE
+                            else:
+                                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                                state = State.DEFAULT
+                        else:
+                            bot_msg = "Ok, which fact do you want to delete?"
+                        set_convo_state(sender_id, state)
+                elif (strongest_intent == "study_next_fact"):
+                    fact = next_due_fact(current_user.user_id)
+                    if (fact):
+                        if (fact.attachment_id):
+                            send_image(sender_id, fact.attachment_id, is_response=True)
+                        bot_msg = "Ok, let's study!\n"
+                        bot_msg = bot_msg + fact.question
+                        set_convo_state(sender_id, State.EXPECTING_STUDY_ANSWER)
+                    else:
+                        bot_msg = "No studying needed! You're all caught up."
+                        set_convo_state(sender_id, State.DEFAULT)
+                elif (strongest_intent == "default_intent"):
+                    bot_msg = "I'm not sure what you mean."
+                    bot_msg = bot_msg + " " + USAGE_INSTRUCTIONS
+                    set_convo_state(sender_id, current_user.state)
+        elif (strongest_intent == "abort"):
+            bot_msg = "Ok, aborting that request."
+            set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_STUDY_ANSWER):
+            fact = next_due_fact(current_user.user_id)
+            bot_msg = "Here is the answer:\n"
+            bot_msg = bot_msg + fact.answer
+            bot_msg = bot_msg + "\nHow hard was that on a scale from 0 (impossible) to 5 (trivial)?"
+            set_convo_state(sender_id, State.EXPECTING_STUDY_PERF_RATING)
+
+        elif (convo_state == State.EXPECTING_STUDY_PERF_RATING):
+            # Get a valid integer from the string response.
+            valid_rating = False
+            try:
+                performance_rating = int(sender_msg)
+                if ((performance_rating >= 0) and (performance_rating <= 5)):
+                    valid_rating = True
+            except Exception:
+                pass # Error handled by "valid_rating" flag.
+
+            if (valid_rating):
+                update_next_fact_per_SM2_alg(sender_id, performance_rating)
+                bot_msg = "Got it, fact studied!"
+                set_convo_state(sender_id, State.DEFAULT)
+            else:
+                bot_msg = "I didn't get a number from that, can you try again on a scale from 0 to 5?"
+                set_convo_state(sender_id, State.EXPECTING_STUDY_PERF_RATING)
+
+        elif (convo_state == State.EXPECTING_FACT_ID_FOR_DISPLAY):
+            tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
+            if not tmp_fact:
+                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+            else:
+                current_user.tmp_fact = tmp_fact
+                send_facts(sender_id, "Here's the fact.", [tmp_fact], True)
+            set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_FACT_ID_FOR_CHANGE):
+            tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
+            if not tmp_fact:
+                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                state = State.DEFAULT
+            else:
+                current_user.tmp_fact = tmp_fact
+                bot_msg = "Ok, let's update that fact. What is the question?"
+                state = State.EXPECTING_FACT_QUESTION
+            set_convo_state(sender_id, state)
+
+        elif (convo_state == State.EXPECTING_FACT_ID_FOR_DELETE):
+            tmp_fact = get_fact(sender_msg.decode("unicode_escape"))
+            if not tmp_fact:
+                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                state = State.DEFAULT
+            else:
+                current_user.tmp_fact = tmp_fact
+                bot_msg = "Are you sure you want to delete this fact?\n"
+                bot_msg += "Question: %s\n" % current_user.tmp_fact.question
+                state = State.EXPECTING_CONFIRMATION_FOR_DELETE
+            set_convo_state(sender_id, state)
+
+        elif (convo_state == State.EXPECTING_CONFIRMATION_FOR_DELETE):
+            confirmed = strongest_intent == "confirmation"
+            if confirmed:
+                if delete_fact(current_user.tmp_fact.id):
+                    bot_msg = "Fact deleted successfully."
+                else:
+                    bot_msg = "Failed to delete fact."
+            else:
+                bot_msg = "Ok, I won't delete this fact."
+            current_user.tmp_fact = Fact(user_id=current_user.user_id)
+            set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_FACT_IDS_FOR_RESET):
+            selection = parse_reset_selection(sender_msg.decode("unicode_escape"))
+            if (selection is not None):
+                bot_msg = confirm_bulk_operation(sender_id, "reset", selection)
+            else:
+                bot_msg = "Whoops! We don't have a fact for you. Try viewing your facts to get the ID."
+                set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_CONFIRMATION_FOR_BULK):
+            action = current_user.bulk_operation["action"]
+            if (strongest_intent == "confirmation"):
+                count = run_bulk_operation(current_user.bulk_operation)
+                if (count is None):
+                    bot_msg = "We couldn't %s those facts." % action
+                elif (count == 0):
+                    bot_msg = "Whoops! We don't have any of those facts for you. Try viewing your facts to get the IDs."
+                elif (action == "delete"):
+                    bot_msg = "Ok, I deleted %d %s." % (count, "fact" if count == 1 else "facts")
+                else:
+                    bot_msg = "Ok, I reset your progress on %d %s." % (count, "fact" if count == 1 else "facts")
+            else:
+                bot_msg = "Ok, I won't change your facts."
+            current_user.bulk_operation = None
+            set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_FACT_QUESTION):
+            current_user.tmp_fact.user_id = current_user.user_id
+            if (image_url):
+                # Images come in their own message, the question follows.
+                if attachments.attach_image(current_user.tmp_fact, image_url, cache):
+                    bot_msg = "Got the image! What's the question that goes with it?"
+                else:
+                    bot_msg = "Sorry, we couldn't save that image. Try again, or send the question as text."
+                set_convo_state(sender_id, State.EXPECTING_FACT_QUESTION)
+            else:
+                current_user.tmp_fact.question = sender_msg.decode("unicode_escape")
+                set_convo_state(sender_id, State.EXPECTING_FACT_ANSWER)
+                bot_msg = "Thanks, what's the answer to that question?"
+
+        elif (convo_state == State.EXPECTING_FACT_ANSWER):
+            current_user.tmp_fact.answer = sender_msg.decode("unicode_escape")
+            added_update = "update" if current_user.tmp_fact.id else "create"
+            if upsert_fact(current_user.tmp_fact.id):
+                bot_msg = "Ok, I %sd the following question and answer:\n" % added_update
+                bot_msg += "Question: %s\n" % current_user.tmp_fact.question
+                bot_msg += "Answer: %s" % current_user.tmp_fact.answer
+            else:
+                bot_msg = "We couldn't %s that fact." % added_update
+            set_convo_state(sender_id, State.DEFAULT)
+
+        elif (convo_state == State.EXPECTING_DURATION_FOR_SILENCE):
+            duration_seconds = get_nlp_duration(nlp['entities'], MIN_CONFIDENCE_THRESHOLD)
+            if (duration_seconds):
+                target_datetime = set_silence_time(sender_id, duration_seconds)
+                bot_msg = "Ok, silencing study notifications until " + str(target_datetime) + "."
+            else:
+                bot_msg = "Sorry, I couldn't get a duration from that."
+            set_convo_state(sender_id, State.DEFAULT)
+
+        send_large_message(sender_id, bot_msg, is_response=True)
 
-    # Update easiness.
-    new_easiness = float(fact.easiness) + (0.1 - (5-perf_rating) * (0.8 + (5-perf_rating) * 0.2))
-    fact.easiness = max(1.3, new_easiness)
 
-    # Commit changes
-    db.session.commit()
+# ===============================================================================
+# Helper Routines
+# ===============================================================================
+def update_next_fact_per_SM2_alg(user_id, perf_rating):
+    global current_user
+    fact = next_due_fact(current_user.user_id)
+    if core.REVIEW_WRITE_BEHIND:
+        # The review flusher applies the result to the facts table later.
+        review_buffer.record_review(user_id, fact, perf_rating, cache)
+        after_commit(fact_cache.invalidate, current_user.user_id, fact.id, cache)
+    else:
+        previous_due_day, was_unstudied = fact.due_day, is_unstudied(fact)
+        log_reviews(db.session, [review_fact(fact, perf_rating)])
+        adjust_due_counts(db.session, [(fact.user_id, previous_due_day, fact.due_day)])
+        if (was_unstudied):
+            adjust_fact_counts(db.session, [(fact.user_id, 0, -1)])
+        # Note: Read before committing, which expires the fact.
+        fact_id, next_due_date = fact.id, fact.next_due_date
+
+        # Commit changes
+        commit_changes()
+        after_commit(fact_cache.invalidate, current_user.user_id, fact_id, cache)
+        after_commit(due_queue.schedule, cache, current_user.user_id, fact_id, next_due_date)
+    after_commit(reminders.reschedule, current_user.user_id, client=cache)
 
 def set_silence_time(sender_id, duration_seconds):
-    user = get_user(sender_id)
+    user = load_user(sender_id)
     print("DEBUG: Previous silence time: " + str(user.silence_end_time))
     print("DEBUG: Silence duration (sec) " + str(duration_seconds))
     now = time.time() # Unix timestamp
@@ -516,8 +751,10 @@ def set_silence_time(sender_id, duration_seconds):
     target_datetime = target_datetime.replace(tzinfo=pytz.utc)
     user.silence_end_time = target_datetime
     print("DEBUG: New silence time: " + str(user.silence_end_time))
-    db.session.commit()
-    return(user.silence_end_time)
+    commit_changes()
+    after_commit(reminders.reschedule, user.id, user.silence_end_time, cache)
+    # Note: Reply with the time as stored, the column doesn't keep the timezone.
+    return(target_datetime.replace(tzinfo=None))
 
 
 def get_nlp_duration(nlp_entities, min_conf_threshold):
@@ -539,50 +776,49 @@ def get_nlp_duration(nlp_entities, min_conf_threshold):
 
 
 def restore_convo_state(sender_id):
+    batch = current_batch()
+    if (batch and batch.convo_state_loaded):
+        # Still current_user from the sender's previous event.
+        return
+
     user_data = None
     try:
-        user_data = cache.get(sender_id)
+        user_data = load_convo_state(sender_id, cache)
     except Exception as e:
-        print("DEBUG: Cache not implemented")
-        print("DEBUG: %s" % str(e))
+        print("ERROR: Failed to load convo state, starting over")
+        print("ERROR: Reason: %s" % str(e))
 
     if not user_data:
         print("DEBUG: Cache miss. Building convo state.")
-        user_data = get_user(sender_id)
+        user_data = load_user(sender_id)
         user_data = ConvoState(user_data.id, State.DEFAULT)
     else:
-        print("DEBUG: Cache hit. Using cached convo state. %s", user_data)
         print("DEBUG: Cache hit. Using cached convo state.")
-        tmp = json.loads(user_data)
-        user_data = ConvoState(tmp["user_id"], State(tmp["state"]))
-        user_data.tmp_fact = Fact()
-        user_data.tmp_fact.id = tmp["tmp_fact"]["id"]
-        user_data.tmp_fact.user_id = tmp["tmp_fact"]["user_id"]
-        user_data.tmp_fact.question = tmp["tmp_fact"]["question"]
-        user_data.tmp_fact.answer = tmp["tmp_fact"]["answer"]
-        user_data.tmp_fact.easiness = tmp["tmp_fact"]["easiness"]
-        user_data.tmp_fact.consecutive_correct_answers = tmp["tmp_fact"]["consecutive_correct_answers"]
-        user_data.tmp_fact.next_due_date = parse_date_time(tmp["tmp_fact"]["next_due_date"])
-        user_data.tmp_fact.last_seen = parse_date_time(tmp["tmp_fact"]["last_seen"])
     set_user(user_data)
+    if (batch):
+        batch.convo_state_loaded = True
 
 def set_convo_state(sender_id, new_state):
-    global current_user
     if not current_user:
         print("DEBUG: New User Setup.")
-        user_data = get_user(sender_id)
-        current_user = ConvoState(user_data.id, State.DEFAULT)
+        user_data = load_user(sender_id)
+        set_user(ConvoState(user_data.id, State.DEFAULT))
     current_user.state = new_state
-    set_user(current_user)
+    print(current_user.serialize)
+
+    batch = current_batch()
+    if (batch and batch.sender_id == sender_id):
+        # Stored once after the sender's last event.
+        batch.convo_state_loaded = True
+        batch.convo_state_changed = True
+        return
     print("DEBUG: Cache set.")
-    cache.set(sender_id, json.dumps(current_user.serialize))
-    cache.expire(sender_id, CACHE_EXPIRATION_IN_SECONDS)
+    store_convo_state(sender_id, current_user._get(), cache)
 
 
 def set_user(user_data):
     print("DEBUG: Updating current_user.")
-    global current_user
-    current_user = user_data
+    current_user._set(user_data)
     print(current_user.serialize)
 
 
@@ -596,8 +832,8 @@ def msg_contains_greeting(nlp_entities, min_conf_threshold):
     return(return_val)
 
 
-def get_strongest_intent(nlp_entities, min_conf_threshold):
-    strongest_intent = "default_intent"
+def get_strongest_intent(nlp_entities, min_conf_threshold, msg_text=None):
+    strongest_intent = None
     highest_confidence_seen = min_conf_threshold
 
     for nlp_entity in nlp_entities:
@@ -607,6 +843,9 @@ def get_strongest_intent(nlp_entities, min_conf_threshold):
                 highest_confidence_seen = confidence
                 strongest_intent = nlp_entities[nlp_entity][0]['value']
 
+    if (strongest_intent is None):
+        # Messenger NLP is missing or unsure, fall back to the local classifier.
+        strongest_intent = intent_classifier.classify(msg_text) if msg_text else "default_intent"
     return(strongest_intent)
 
 
@@ -620,100 +859,36 @@ def get_verif_token():
     return(os.environ["VERIFY_TOKEN"])
 
 
-def get_page_access_token():
+def send_message(user_id, msg_text, is_response):
     """
-    This PAT (Page Access Token) is used to authenticate our requests/responses.
-    It was generated during the setup of our Facebook page and Facebook app.
-    It was set in our Heroku environment using the following command:
-       heroku config:add PAGE_ACCESS_TOKEN=your_token_here
+    Send the message msg_text to recipient once the changes it reports on are
+    committed (see after_commit).
     """
-    return(os.environ["PAGE_ACCESS_TOKEN"])
-
-
-def change_typing_indicator(enabled, user_id):
-    if(enabled):
-        action = "typing_on"
-    else:
-        action = "typing_off"
+    after_commit(deliver_message, user_id, msg_text, is_response)
 
-    headers = {
-        'Content-type': 'application/json'
-    }
-    params = {
-        "access_token": get_page_access_token()
-    }
-    data = json.dumps({
-        "recipient": {"id": user_id},
-        "sender_action": action
-    })
 
-    r = requests.post(url=SEND_API_URL, params=params, data=data, headers=headers)
+def send_image(user_id, attachment_id, is_response):
+    after_commit(core.send_image, user_id, attachment_id, is_response)
 
-    # Check the returned status code of the POST.
-    if r.status_code != requests.codes.ok:
-        print("DEBUG: " + r.text)
-
-
-def send_message(user_id, msg_text, is_response):
-
-    if msg_text == "":
-        return
 
+def deliver_message(user_id, msg_text, is_response):
     """
-    Send the message msg_text to recipient.
+    Send the message msg_text to recipient through the core messaging client.
     """
-    if (is_response):
-        msg_type = "RESPONSE"
-    else:
-        msg_type = "NON_PROMOTIONAL_SUBSCRIPTION"
-
-    headers = {
-        'Content-type': 'application/json'
-    }
-    params = {
-        "access_token": get_page_access_token()
-    }
-    data = json.dumps({
-        "message_type": msg_type,
-        "recipient": {"id": user_id},
-        "message": {"text": msg_text}
-    })
-
-    r = requests.post(url=SEND_API_URL, params=params, data=data, headers=headers)
-
-    # Check the returned status code of the POST.
-    if r.status_code != requests.codes.ok:
-        print("DEBUG: " + r.text)
-
-
-"""
-Explaination at https://developers.facebook.com/docs/messenger-platform/identity/user-profile
-"""
-def get_users_firstname(user_id):
-    url = "https://graph.facebook.com/v2.6/" + str(user_id)
-
-    params = {
-        "access_token": get_page_access_token(),
-        "fields": "first_name"
-    }
-
-    r = requests.get(url=url, params=params)
-    json_response = json.loads(r.text)
-    return (json_response["first_name"])
+    start = time.time()
+    delivered = core.send_message(user_id, msg_text, is_response)
+    if delivered:
+        typing_indicators.observe_graph_latency(time.time() - start)
+        # Delivering a message clears the typing indicator on its own.
+        typing_indicators.reply_sent(user_id)
+    return delivered
 
 
-def get_user(user_id):
-    return User.query.filter_by(fb_id=user_id).one_or_none()
-
-
-def get_all_users():
-    return User.query.all()
-
 def is_first_time_user(sender_id):
     print("DEBUG: Checking if user %s exists" % sender_id)
-    current_user = get_user(sender_id)
-    print("DEBUG: User %r" % current_user)
-    return True if (current_user is None) else False
+    user = load_user(sender_id)
+    print("DEBUG: User %r" % user)
+    return True if (user is None) else False
 
 
 def send_welcome_message(sender_id):
@@ -737,7 +912,10 @@ def create_user(sender_id):
     try:
         new_user = User(fb_id=sender_id)
         db.session.add(new_user)
-        db.session.commit()
+        commit_changes()
+        batch = current_batch()
+        if (batch and batch.sender_id == sender_id):
+            batch.user = new_user
     except Exception as e:
         print("ERROR: Failed to create user %s" % sender_id)
         print("ERROR: Reason: %s", str(e))
@@ -750,10 +928,18 @@ def create_fact():
     try:
         global current_user
         # Set the first study time 1 day from when the fact was added.
-        current_user.tmp_fact.next_due_date = datetime.now() + timedelta(days=1)
+        current_user.tmp_fact.next_due_date = datetime.utcnow() + timedelta(days=1)
         current_user.tmp_fact.easiness = DEFAULT_EASINESS
         db.session.add(current_user.tmp_fact)
-        db.session.commit()
+        db.session.flush()
+        # Note: Read before committing, which expires the fact.
+        fact_id, user_id = current_user.tmp_fact.id, current_user.tmp_fact.user_id
+        next_due_date = current_user.tmp_fact.next_due_date
+        adjust_due_counts(db.session, [(user_id, None, current_user.tmp_fact.due_day)])
+        adjust_fact_counts(db.session, [(user_id, 1, 1)])
+        commit_changes()
+        after_commit(due_queue.schedule, cache, user_id, fact_id, next_due_date)
+        after_commit(reminders.reschedule, user_id, client=cache)
     except Exception as e:
         print("ERROR: Failed to add fact %s" % current_user.tmp_fact)
         print("ERROR: Reason: %s", str(e))
@@ -772,10 +958,16 @@ def update_fact(fact_id):
     success = True
     try:
         global current_user
-        fact = Fact.query.filter_by(user_id=current_user.user_id, id=fact_id).one()
+        fact = (Fact.query.options(load_only("id", "user_id", "due_day"))
+                .filter_by(user_id=current_user.user_id, id=fact_id).one())
         fact.question = current_user.tmp_fact.question
         fact.answer = current_user.tmp_fact.answer
-        db.session.commit()
+        fact.attachment_id = current_user.tmp_fact.attachment_id
+        # Note: Read before committing, which expires the fact.
+        user_id, next_due_date = fact.user_id, fact.next_due_date
+        commit_changes()
+        after_commit(fact_cache.invalidate, user_id, fact_id, cache)
+        after_commit(due_queue.schedule, cache, user_id, fact_id, next_due_date)
     except Exception as e:
         print("ERROR: Failed to update fact %s" % current_user.tmp_fact)
         print("ERROR: Reason: %s" % str(e))
@@ -798,7 +990,7 @@ def get_fact_by_id(fact_id):
     global current_user
     print("DEBUG: Getting fact by ID: %d" % fact_id)
     try:
-        fact = Fact.query.filter_by(user_id=current_user.user_id, id=fact_id).one_or_none()
+        fact = fact_cache.get_user_fact(current_user.user_id, fact_id, cache)
         return fact
     except Exception as e:
         print("ERROR: Failed to retrieve fact: %s" % str(e))
@@ -809,7 +1001,7 @@ def get_fact_by_question(question):
     global current_user
     print("DEBUG: Getting fact by Question: %s" % question)
     try:
-        fact = Fact.query.filter_by(user_id=current_user.user_id, question=question).one_or_none()
+        fact = find_user_fact(current_user.user_id, question=question)
         return fact
     except Exception as e:
         print("ERROR: Failed to retrieve fact: %s" % str(e))
@@ -831,17 +1023,66 @@ def delete_fact(fact_id):
     success = True
     try:
         global current_user
-        fact = Fact.query.filter_by(user_id=current_user.user_id, id=fact_id).one()
+        fact = (Fact.query.options(load_only("id", "user_id", "due_day", "first_reviewed_at"))
+                .filter_by(user_id=current_user.user_id, id=fact_id).one())
         db.session.delete(fact)
-        db.session.commit()
+        adjust_due_counts(db.session, [(fact.user_id, fact.due_day, None)])
+        adjust_fact_counts(db.session, [(fact.user_id, -1, -int(is_unstudied(fact)))])
+        commit_changes()
+        after_commit(fact_cache.invalidate, current_user.user_id, fact_id, cache)
+        after_commit(due_queue.unschedule, cache, current_user.user_id, fact_id)
+        after_commit(reminders.reschedule, current_user.user_id, client=cache)
     except:
         print("ERROR: Failed to delete fact %s" % current_user.tmp_fact)
         success = False
     return success
 
 
-def get_user_facts(sender_id):
-    return get_user(sender_id).facts
+def confirm_bulk_operation(sender_id, action, selection):
+    """Remember a bulk delete or reset of the selected facts and ask to confirm it"""
+    global current_user
+    first_id, last_id = selection
+    current_user.bulk_operation = {"action": action, "first_id": first_id, "last_id": last_id}
+    set_convo_state(sender_id, State.EXPECTING_CONFIRMATION_FOR_BULK)
+    if (first_id is None):
+        facts = "all of your facts"
+    elif (first_id == last_id):
+        facts = "fact %d" % first_id
+    else:
+        facts = "facts %d to %d" % (first_id, last_id)
+    if (action == "delete"):
+        return "Are you sure you want to delete %s? This can't be undone." % facts
+    return "Are you sure you want to reset your progress on %s? They will be studied again from tomorrow." % facts
+
+
+def run_bulk_operation(bulk_operation):
+    """
+    Delete or reset the facts of a confirmed bulk operation with a single
+    statement, then bring the caches and queues in line. Returns the number of
+    facts changed, or None if it failed.
+    """
+    global current_user
+    user_id = current_user.user_id
+    try:
+        if (bulk_operation["action"] == "delete"):
+            fact_ids = delete_user_facts(user_id, bulk_operation["first_id"], bulk_operation["last_id"])
+        else:
+            fact_ids = reset_user_facts(user_id, bulk_operation["first_id"], bulk_operation["last_id"])
+        commit_changes()
+    except Exception as e:
+        print("ERROR: Failed to %s facts for user %s" % (bulk_operation["action"], user_id))
+        print("ERROR: Reason: %s" % str(e))
+        return None
+
+    if fact_ids:
+        after_commit(fact_cache.bump_versions, [user_id], cache)
+        if core.REVIEW_WRITE_BEHIND:
+            after_commit(review_buffer.discard_pending, user_id, fact_ids, cache)
+        # Cheaper to rebuild from the database than to update fact by fact.
+        after_commit(due_queue.drop, cache, user_id)
+        after_commit(reminders.reschedule, user_id, client=cache)
+    print("DEBUG: %s %d facts for user %s" % (bulk_operation["action"], len(fact_ids), user_id))
+    return len(fact_ids)
 
 
 def send_facts(sender_id, initial_bot_msg, facts, include_metadata=False):
@@ -849,6 +1090,8 @@ def send_facts(sender_id, initial_bot_msg, facts, include_metadata=False):
     for fact in facts:
         return_msg = "%d. %s\n" % (fact.id, fact.question)
         if include_metadata:
+            if (fact.attachment_id):
+                send_image(sender_id, fact.attachment_id, is_response=True)
             return_msg += "Answer: %s\n" % fact.answer
             return_msg += "Easiness: %s\n" % fact.easiness
             return_msg += "Consecutive Correct Answers: %s\n" % fact.consecutive_correct_answers
@@ -857,27 +1100,46 @@ def send_facts(sender_id, initial_bot_msg, facts, include_metadata=False):
         send_large_message(sender_id, return_msg)
 
 
-def send_facts_for_display(sender_id, initial_bot_msg, include_metadata=False):
-    send_facts(sender_id, initial_bot_msg, get_user_facts(sender_id), include_metadata)
-
-
 def send_large_message(sender_id, return_string, is_response=True):
     [send_message(sender_id, return_string[i: i + FB_MAX_MESSAGE_LENGTH], is_response)
      for i in range(0, len(return_string), FB_MAX_MESSAGE_LENGTH)]
 
 
-def format_date_time(date_time):
-    if isinstance(date_time, datetime):
-        return "{:%B %d, %Y}".format(date_time)
-    return None
+# Note: Only ranges of fact IDs, so "reset 2 to 3 days ago" isn't a range.
+_FACT_RANGE_PATTERN = re.compile(r"\b(?:facts?|ids?)\s+(?:from\s+)?#?(\d+)\s*(?:-|to|through|until)\s*#?(\d+)\b",
+                                 re.IGNORECASE)
+# Note: Only an explicit phrase, so "delete the fact about all presidents" isn't a bulk delete.
+_ALL_FACTS_PATTERN = re.compile(r"\b(?:all\s+(?:of\s+)?(?:my\s+|the\s+)?facts|every\s+(?:single\s+)?fact)\b",
+                                re.IGNORECASE)
 
 
-def parse_date_time(date_time):
-    if isinstance(date_time, str):
-        return parser.parse(date_time)
+def parse_fact_selection(msg_text):
+    """
+    Return the (first_id, last_id) range of facts a bulk command is about,
+    (None, None) for all facts, or None if it isn't a bulk command.
+    """
+    match = _FACT_RANGE_PATTERN.search(msg_text)
+    if match:
+        first_id, last_id = int(match.group(1)), int(match.group(2))
+        return (min(first_id, last_id), max(first_id, last_id))
+    if _ALL_FACTS_PATTERN.search(msg_text):
+        return (None, None)
     return None
 
 
+def parse_reset_selection(msg_text):
+    """
+    Like parse_fact_selection, but a single fact ID selects just that fact.
+    Returns None if no facts were named.
+    """
+    selection = parse_fact_selection(msg_text)
+    if (selection is None):
+        fact_id = extract_fact_id(msg_text)
+        if fact_id:
+            selection = (fact_id, fact_id)
+    return selection
+
+
 def extract_fact_id(fact_id_str):
     try:
         return [int(s) for s in fact_id_str.split() if s.isdigit()][0]
@@ -886,8 +1148,11 @@ def extract_fact_id(fact_id_str):
 # ===============================================================================
 # Main
 # ===============================================================================
+app = create_app()
+
 if __name__ == '__main__':
     """
     Start the Flask app, the app will start listening for requests on port 5000.
     """
+    warmup.warm_up()
     app.run()
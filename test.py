@@ -1,9 +1,42 @@
+import async_mode
+import attachments
+import budgets
+import convo_cache
+import core
+import due_queue
+import fact_cache
+import forecast
+import graph_delivery
+import gunicorn_config
+import intent_classifier
+import metrics
+import profiling
+import reminders
+import review_buffer
 import studybot
+import tracing
+import warmup
+import webhook_replay
 import unittest
+import copy
+import importlib
+import io
 import json
+import os
+import requests
+import tempfile
+import subprocess
+import sys
+import threading
+import time
+from typing_indicator import TypingIndicatorManager
 from unittest.mock import patch, Mock
+from sqlalchemy import event, inspect
 from fakeredis import FakeRedis
 
+# Most test cases replace studybot.send_message with a mock.
+QUEUED_SEND_MESSAGE = studybot.send_message
+
 RESPONSES = []
 DUMMY_SENDER_ID = "0000000000"
 DUMMY_SENDER_RECIPIENT_ID = "0000000000"
@@ -117,12 +150,16 @@ def mocked_send_request(*args, **kwargs):
         "message": {"text": msg_text}
     }
 
+    # Stands in for a Send API call.
+    budgets.count("graph")
     RESPONSES.append(data)
 
 
 def remove_test_data():
     test_user = studybot.User.query.filter_by(fb_id=DUMMY_SENDER_ID).one_or_none()
     if test_user:
+        core.Review.query.filter_by(user_id=test_user.id).delete()
+        core.DueCount.query.delete()
         if test_user.facts:
             for fact in test_user.facts:
                 studybot.db.session.delete(fact)
@@ -131,6 +168,7 @@ def remove_test_data():
     global RESPONSES
     RESPONSES = []
     FakeRedis().flushall()
+    convo_cache._entries.clear()
 
 
 def create_dummy_fact(question, answer):
@@ -557,7 +595,8 @@ class StudyBotTestCase(unittest.TestCase):
         bot_msg1 = "%d. %s\n" % (fact_id1, fact1.question)
         bot_msg2 = "%d. %s\n" % (fact_id2, fact2.question)
 
-        self.assertEqual(RESPONSES[0]["message"]["text"], "Ok, here are the facts we have.")
+        self.assertEqual(RESPONSES[0]["message"]["text"],
+                         "Ok, here are the 2 facts we have, 0 due now and 2 never studied.")
         self.assertEqual(RESPONSES[1]["message"]["text"], bot_msg1)
         self.assertEqual(RESPONSES[2]["message"]["text"], bot_msg2)
 
@@ -801,6 +840,32 @@ class StudyBotTestCase(unittest.TestCase):
         self.assertGreaterEqual(fact.easiness, fact1.easiness)
         self.assertGreater(fact.next_due_date, fact1.next_due_date)
 
+    @patch('studybot.cache', FakeRedis())
+    def test_study_fact_logs_review(self):
+        studybot.create_user(DUMMY_SENDER_ID)
+        fact1 = create_dummy_fact("Dummy Question 1", "Dummy Answer 1")
+        studybot.set_user(studybot.ConvoState(fact1.user_id, studybot.State.DEFAULT))
+        studybot.current_user.tmp_fact = fact1
+        studybot.create_fact()
+        fact1.next_due_date = studybot.datetime.utcnow()
+        studybot.db.session.commit()
+
+        for text in ["Study time!", "Dummy Answer 1", "4"]:
+            payload = get_payload(text, [get_intent_object("study_next_fact")])
+            headers = {
+                'Content-type': 'application/json'
+            }
+            response = self.app.post('/', data=json.dumps(payload), headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+        review = core.Review.query.filter_by(fact_id=fact1.id).one()
+        self.assertEqual(review.user_id, fact1.user_id)
+        self.assertEqual(review.rating, 4)
+        # New facts are first due a day after they were added.
+        self.assertEqual(review.previous_interval, 1)
+        self.assertEqual(review.new_interval, 1)
+        self.assertEqual(core.get_review_stats(user_id=fact1.user_id), (1, 4.0))
+
     @patch('studybot.cache', FakeRedis())
     def test_study_fact_low_perf(self):
         studybot.create_user(DUMMY_SENDER_ID)
@@ -919,5 +984,1632 @@ class StudyBotTestCase(unittest.TestCase):
         self.assertEqual(RESPONSES[0]["message"]["text"], "I'm not sure what you mean." + " " + studybot.USAGE_INSTRUCTIONS)
 
 
+class WriteBehindTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache),
+                        patch('core.REVIEW_WRITE_BEHIND', True)]
+        for p in self.patches:
+            p.start()
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        remove_test_data()
+
+    def study(self, rating):
+        for text in ["Study time!", "Dummy Answer 1", rating]:
+            payload = get_payload(text, [get_intent_object("study_next_fact")])
+            headers = {
+                'Content-type': 'application/json'
+            }
+            response = self.app.post('/', data=json.dumps(payload), headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+    def test_reviews_are_buffered_then_flushed_once(self):
+        studybot.create_user(DUMMY_SENDER_ID)
+        fact1 = create_dummy_fact("Dummy Question 1", "Dummy Answer 1")
+        studybot.set_user(studybot.ConvoState(fact1.user_id, studybot.State.DEFAULT))
+        studybot.current_user.tmp_fact = fact1
+        studybot.create_fact()
+        fact1.next_due_date = studybot.datetime.utcnow()
+        studybot.db.session.commit()
+        fact_id = fact1.id
+
+        self.study("5")
+        self.study("5")
+        self.assertEqual(RESPONSES[-1]["message"]["text"], "Got it, fact studied!")
+
+        # Nothing has been written to the facts table yet...
+        studybot.db.session.remove()
+        self.assertEqual(studybot.Fact.query.get(fact_id).consecutive_correct_answers, 0)
+        # ...but the user reads their own reviews.
+        self.assertEqual(core.get_next_fact_to_study(DUMMY_SENDER_ID).consecutive_correct_answers, 2)
+
+        self.assertEqual(review_buffer.flush(client=self.cache), 2)
+        studybot.db.session.remove()
+        self.assertEqual(studybot.Fact.query.get(fact_id).consecutive_correct_answers, 2)
+        self.assertEqual(core.get_review_stats(user_id=fact1.user_id)[0], 2)
+        self.assertEqual(self.cache.hgetall(review_buffer.PENDING_REVIEWS_KEY % fact1.user_id), {})
+
+        # Delivering the same reviews again doesn't apply them twice.
+        reviews = [review_buffer._decode(fields) for entry_id, fields in self.cache.xrange(review_buffer.REVIEW_STREAM)]
+        self.assertEqual(review_buffer.apply_reviews(studybot.db.session, reviews), 0)
+        studybot.db.session.commit()
+        self.assertEqual(studybot.Fact.query.get(fact_id).consecutive_correct_answers, 2)
+        self.assertEqual(core.get_review_stats(user_id=fact1.user_id)[0], 2)
+
+
+class TypingIndicatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.actions = []
+        self.manager = TypingIndicatorManager(lambda enabled, user_id: self.actions.append((enabled, user_id)), 0.05)
+
+    def test_fast_response_sends_no_indicator(self):
+        indicator = self.manager.begin(DUMMY_SENDER_ID, "add_fact")
+        self.manager.reply_sent(DUMMY_SENDER_ID)
+        self.manager.end(indicator)
+        self.manager.shutdown()
+        self.assertEqual(self.actions, [])
+
+    def test_slow_response_without_reply(self):
+        indicator = self.manager.begin(DUMMY_SENDER_ID, "add_fact")
+        time.sleep(0.1)
+        self.manager.end(indicator)
+        self.manager.shutdown()
+        self.assertEqual(self.actions, [(True, DUMMY_SENDER_ID), (False, DUMMY_SENDER_ID)])
+
+    def test_slow_response_with_reply_skips_typing_off(self):
+        indicator = self.manager.begin(DUMMY_SENDER_ID, "study_next_fact")
+        time.sleep(0.1)
+        self.manager.reply_sent(DUMMY_SENDER_ID)
+        self.manager.end(indicator)
+        self.assertGreaterEqual(self.manager.expected_duration("study_next_fact"), 0.05)
+
+        # The next event of the same kind is expected to be slow, so the
+        # indicator goes out immediately, unless the reply beats it.
+        indicator = self.manager.begin(DUMMY_SENDER_ID, "study_next_fact")
+        self.assertTrue(indicator.typing_on_sent)
+        self.manager.reply_sent(DUMMY_SENDER_ID)
+        self.manager.end(indicator)
+        self.manager.shutdown()
+        self.assertEqual(self.actions[0], (True, DUMMY_SENDER_ID))
+        self.assertIn(self.actions[1:], [[], [(True, DUMMY_SENDER_ID), (False, DUMMY_SENDER_ID)]])
+
+    def test_events_share_one_scheduler_thread(self):
+        manager = TypingIndicatorManager(lambda enabled, user_id: self.actions.append((enabled, user_id)), 0.05)
+        threads = threading.active_count()
+        indicators = [manager.begin("user%d" % i, "add_fact") for i in range(20)]
+        self.assertEqual(threading.active_count(), threads + 1)
+        for indicator in indicators[:10]:
+            manager.end(indicator)
+        time.sleep(0.1)
+        for indicator in indicators[10:]:
+            manager.end(indicator)
+        manager.shutdown()
+        self.assertEqual(sorted(user_id for enabled, user_id in self.actions if enabled),
+                         sorted("user%d" % i for i in range(10, 20)))
+
+
+    def test_typing_on_after_the_reply_is_turned_off(self):
+        delivered = threading.Event()
+        manager = TypingIndicatorManager(lambda enabled, user_id: (enabled and delivered.wait(1),
+                                                                   self.actions.append((enabled, user_id))), 0)
+        indicator = manager.begin(DUMMY_SENDER_ID, "study_next_fact")
+        manager.reply_sent(DUMMY_SENDER_ID)
+        manager.end(indicator)
+        delivered.set()
+        manager.shutdown()
+        self.assertEqual(self.actions, [(True, DUMMY_SENDER_ID), (False, DUMMY_SENDER_ID)])
+
+    def test_queued_typing_on_is_dropped_after_the_reply(self):
+        busy = threading.Event()
+        manager = TypingIndicatorManager(lambda enabled, user_id: (busy.wait(1),
+                                                                   self.actions.append((enabled, user_id))), 0,
+                                         max_workers=1)
+        other = manager.begin("other", "study_next_fact")
+        indicator = manager.begin(DUMMY_SENDER_ID, "study_next_fact")
+        manager.reply_sent(DUMMY_SENDER_ID)
+        manager.end(indicator)
+        busy.set()
+        manager.reply_sent("other")
+        manager.end(other)
+        manager.shutdown()
+        self.assertNotIn((True, DUMMY_SENDER_ID), self.actions)
+        self.assertNotIn((False, DUMMY_SENDER_ID), self.actions)
+
+
+class CoreModuleTestCase(unittest.TestCase):
+    def test_core_import_has_no_side_effects(self):
+        script = ("import sys, core; "
+                  "assert 'flask' not in sys.modules; "
+                  "assert core.db._engine is None; "
+                  "assert core.cache._client is None")
+        self.assertEqual(subprocess.call([sys.executable, "-c", script]), 0)
+
+
+class WarmupTestCase(unittest.TestCase):
+    def setUp(self):
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+
+    def tearDown(self):
+        warmup._status.clear()
+
+    @patch('core.cache', FakeRedis())
+    @patch('graph_delivery.breaker', graph_delivery.CircuitBreaker())
+    @patch('core.graph_session')
+    def test_ready_after_warm_up(self, graph_session):
+        graph_session.request.return_value = Mock(status_code=200)
+        warmup._ready.clear()
+        response = self.app.get('/ready')
+        self.assertEqual(response.status_code, 503)
+
+        warmup.warm_up()
+
+        response = self.app.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode()),
+                         {"imports": "ok", "intent_classifier": "ok", "database": "ok", "redis": "ok",
+                          "graph_api": "ok"})
+        self.assertEqual(warmup.GRAPH_API_HOST, "https://graph.facebook.com/")
+        graph_session.request.assert_called_once_with(
+            "HEAD", warmup.GRAPH_API_HOST,
+            timeout=(graph_delivery.GRAPH_CONNECT_TIMEOUT_SECONDS, graph_delivery.GRAPH_READ_TIMEOUT_SECONDS))
+
+    @patch('core.cache', FakeRedis())
+    @patch('graph_delivery.breaker', graph_delivery.CircuitBreaker())
+    @patch('core.graph_session')
+    def test_graph_api_failure_is_degraded(self, graph_session):
+        graph_session.request.side_effect = requests.Timeout()
+        warmup._ready.clear()
+        warmup.warm_up()
+        self.assertTrue(warmup.is_ready())
+        self.assertEqual(warmup.status()["graph_api"], "degraded")
+
+    @patch('core.graph_session')
+    def test_not_ready_when_redis_fails(self, graph_session):
+        graph_session.request.return_value = Mock(status_code=200)
+        warmup._ready.clear()
+        with patch('core.cache', Mock(ping=Mock(side_effect=ConnectionError()))):
+            warmup.warm_up()
+        self.assertFalse(warmup.is_ready())
+        self.assertEqual(warmup.status()["redis"], "failed")
+        self.assertEqual(self.app.get('/ready').status_code, 503)
+
+
+class ReadReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        # Start over like a new request, which hasn't written anything.
+        core.db.session.remove()
+
+    def tearDown(self):
+        core.db.session.remove()
+        core.db._replica_engine = None
+        core.db._replica_down_until = 0
+        remove_test_data()
+
+    def test_read_only_queries_use_replica(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), "replica.db")
+        with patch.dict(os.environ, {"DATABASE_REPLICA_URL": "sqlite:///" + replica_path}):
+            core.Model.metadata.create_all(bind=core.db.replica_engine)
+            # The replica is empty, so the user only exists on the primary.
+            self.assertEqual(core.get_all_users(), [])
+            self.assertIsNotNone(core.get_user(DUMMY_SENDER_ID))
+
+    @patch.dict(os.environ, {"DATABASE_REPLICA_URL": "sqlite:////nonexistent/replica.db"})
+    def test_falls_back_to_primary_when_replica_down(self):
+        user = core.get_user(DUMMY_SENDER_ID)
+        users = core.get_all_users()
+        self.assertIn(DUMMY_SENDER_ID, [user.fb_id for user in users])
+        self.assertFalse(core.db.replica_available())
+        # The caller's transaction wasn't rolled back.
+        self.assertFalse(inspect(user).expired_attributes)
+
+    def test_reads_after_writes_use_primary(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), "replica.db")
+        with patch.dict(os.environ, {"DATABASE_REPLICA_URL": "sqlite:///" + replica_path}):
+            core.Model.metadata.create_all(bind=core.db.replica_engine)
+            self.assertEqual(core.list_user_facts(DUMMY_SENDER_ID), [])
+
+            core.db.session.add(create_dummy_fact("Dummy Question", "Dummy Answer"))
+            core.db.session.flush()
+            self.assertEqual([fact.question for fact in core.list_user_facts(DUMMY_SENDER_ID)], ["Dummy Question"])
+            core.db.session.commit()
+            self.assertEqual(len(core.list_user_facts(DUMMY_SENDER_ID)), 1)
+
+            core.db.session.remove()
+            self.assertEqual(core.list_user_facts(DUMMY_SENDER_ID), [])
+
+
+class DueQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        self.statements = []
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        if event.contains(core.db.engine, "before_cursor_execute", self.count_statement):
+            event.remove(core.db.engine, "before_cursor_execute", self.count_statement)
+        remove_test_data()
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def add_fact(self, question, days_due):
+        fact = create_dummy_fact(question, "Dummy Answer")
+        studybot.current_user.tmp_fact = fact
+        self.assertTrue(studybot.create_fact())
+        fact.next_due_date = studybot.datetime.utcnow() + studybot.timedelta(days=days_due)
+        studybot.db.session.commit()
+        due_queue.schedule(self.cache, self.user_id, fact.id, fact.next_due_date)
+        return fact
+
+    def test_no_facts_is_answered_from_redis(self):
+        self.assertIsNone(core.get_next_due_fact(self.user_id))
+        event.listen(core.db.engine, "before_cursor_execute", self.count_statement)
+        self.assertIsNone(core.get_next_due_fact(self.user_id))
+        self.assertEqual(self.statements, [])
+
+    def test_queue_follows_fact_changes(self):
+        later = self.add_fact("Dummy Question 1", 2)
+        sooner = self.add_fact("Dummy Question 2", 0)
+        self.assertEqual(core.get_next_due_fact(self.user_id).id, sooner.id)
+
+        # New facts are due in a day, so this one is queued between the others.
+        newest = create_dummy_fact("Dummy Question 3", "Dummy Answer")
+        studybot.current_user.tmp_fact = newest
+        self.assertTrue(studybot.create_fact())
+
+        self.assertTrue(studybot.delete_fact(sooner.id))
+        self.assertEqual(core.get_next_due_fact(self.user_id).id, newest.id)
+        self.assertTrue(studybot.delete_fact(newest.id))
+        self.assertEqual(core.get_next_due_fact(self.user_id).id, later.id)
+        self.assertTrue(studybot.delete_fact(later.id))
+        self.assertIsNone(core.get_next_due_fact(self.user_id))
+
+    def test_falls_back_to_database_without_redis(self):
+        fact = self.add_fact("Dummy Question 1", 1)
+        broken = Mock()
+        broken.zrangebyscore.side_effect = ConnectionError("Redis is down")
+        self.assertEqual(core.get_next_due_fact(self.user_id, broken).id, fact.id)
+
+
+class ReminderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.sender = Mock()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache),
+                        patch('core.send_message', self.sender)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        self.fact = create_dummy_fact("Dummy Question 1", "Dummy Answer 1")
+        studybot.current_user.tmp_fact = self.fact
+        studybot.create_fact()
+        self.due_at = due_queue.due_score(self.fact.next_due_date)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        remove_test_data()
+
+    def reminder_time(self):
+        return self.cache.zscore(reminders.REMINDER_QUEUE_KEY, self.user_id)
+
+    def test_reminder_fires_when_due(self):
+        self.assertEqual(self.reminder_time(), self.due_at)
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at - 1), 0)
+        self.sender.assert_not_called()
+
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at), 1)
+        self.sender.assert_any_call(DUMMY_SENDER_ID, "Dummy Question 1", False)
+        self.assertEqual(self.reminder_time(), self.due_at + reminders.REMINDER_INTERVAL_SECONDS)
+        state = json.loads(self.cache.get(DUMMY_SENDER_ID))
+        self.assertEqual(state["state"], studybot.State.EXPECTING_STUDY_ANSWER.value)
+
+    def test_silenced_user_is_reminded_after_silence(self):
+        silence_end = studybot.set_silence_time(DUMMY_SENDER_ID, 3 * 24 * 3600)
+        self.assertEqual(self.reminder_time(), due_queue.due_score(silence_end))
+
+        # A review reschedules from the due date alone; firing checks silence.
+        reminders.schedule_reminder(self.cache, self.user_id, self.due_at)
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at), 1)
+        self.sender.assert_not_called()
+        self.assertEqual(self.reminder_time(), due_queue.due_score(silence_end))
+
+    def test_studying_overdue_facts_doesnt_remind_again(self):
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at), 1)
+        sends = self.sender.call_count
+        studybot.set_convo_state(DUMMY_SENDER_ID, studybot.State.DEFAULT)
+
+        # A failing rating makes the fact due again straight away.
+        with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(self.fact.id)):
+            studybot.update_next_fact_per_SM2_alg(self.user_id, 1)
+        self.assertEqual(self.reminder_time(), self.due_at + reminders.REMINDER_INTERVAL_SECONDS)
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at + 60), 0)
+        self.assertEqual(self.sender.call_count, sends)
+
+    def test_users_in_a_conversation_are_not_interrupted(self):
+        studybot.set_convo_state(DUMMY_SENDER_ID, studybot.State.EXPECTING_FACT_ANSWER)
+        self.assertEqual(reminders.fire_due_reminders(now=self.due_at), 1)
+        self.sender.assert_not_called()
+        self.assertEqual(self.reminder_time(), self.due_at + core.CACHE_EXPIRATION_IN_SECONDS)
+
+    def test_deleting_last_fact_cancels_reminder(self):
+        self.assertTrue(studybot.delete_fact(self.fact.id))
+        self.assertIsNone(self.reminder_time())
+
+    def test_most_overdue_users_are_reminded_first(self):
+        now = self.due_at
+        for user_id, overdue_seconds in [(101, 10), (102, 300), (103, 60)]:
+            reminders.schedule_reminder(self.cache, user_id, now - overdue_seconds)
+        with patch('reminders.remind') as remind:
+            reminders.fire_due_reminders(self.cache, now=now)
+        self.assertEqual([c[0][0] for c in remind.call_args_list], [102, 103, 101, self.user_id])
+        self.assertEqual(metrics.snapshot()["gauges"]["reminders.lag_seconds"], 300)
+        self.assertEqual(metrics.snapshot()["gauges"]["reminders.backlog"], 4)
+
+    def test_sends_are_paced(self):
+        clock = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        pacer = reminders.Pacer(clock=lambda: clock[0], sleep=sleep)
+        for i in range(3):
+            pacer.wait(4)
+        self.assertEqual(sleeps, [0.25, 0.25])
+        # The backlog is sent within the window even above the target rate.
+        self.assertEqual(reminders.send_rate(10, target_rate=1, window_seconds=60), 1)
+        self.assertEqual(reminders.send_rate(600, target_rate=1, window_seconds=60), 10)
+
+
+class IntentClassifierTestCase(unittest.TestCase):
+    def setUp(self):
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+
+    def tearDown(self):
+        remove_test_data()
+
+    def test_classifies_usage_instructions(self):
+        for line, intent in [("I want to add a fact.", "add_fact"),
+                             ("I want to view all facts.", "view_facts"),
+                             ("I want to change a fact.", "change_fact"),
+                             ("I want to delete a fact.", "delete_fact"),
+                             ("I want to study.", "study_next_fact"),
+                             ("I want to silence studying for x days.", "silence_studying")]:
+            self.assertEqual(intent_classifier.classify(line), intent)
+
+    def test_unsure_about_free_text(self):
+        for text in ["What is the capital of Spain?", "Madrid", "Dummy intent!"]:
+            self.assertEqual(intent_classifier.classify(text), "default_intent")
+
+    @patch('studybot.cache', FakeRedis())
+    def test_used_when_nlp_is_missing_or_unsure(self):
+        studybot.create_user(DUMMY_SENDER_ID)
+        for intents in [[], [get_intent_object("view_facts", confidence=0.2)]]:
+            payload = get_payload("I want to add a fact", intents)
+            headers = {
+                'Content-type': 'application/json'
+            }
+            response = self.app.post('/', data=json.dumps(payload), headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(RESPONSES[-1]["message"]["text"], "Ok, let's add that new fact. What is the question?")
+
+            payload = get_payload("never mind", [])
+            response = self.app.post('/', data=json.dumps(payload), headers=headers)
+            self.assertEqual(RESPONSES[-1]["message"]["text"], "Ok, aborting that request.")
+
+
+class WebhookReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+        self.recording = os.path.join(tempfile.mkdtemp(), "recording.jsonl")
+
+    def tearDown(self):
+        remove_test_data()
+
+    @patch('studybot.cache', FakeRedis())
+    def test_records_anonymized_payloads(self):
+        payload = get_payload("Study fact 12 now!", [get_intent_object("study_next_fact")])
+        with patch('studybot.recorder', webhook_replay.Recorder(self.recording, 1.0, salt="test")):
+            response = self.app.post('/', data=json.dumps(payload), headers={'Content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+        records = list(webhook_replay.load_recording(self.recording))
+        self.assertEqual(len(records), 1)
+        messaging_event = records[0][1]["entry"][0]["messaging"][0]
+        self.assertEqual(messaging_event["sender"]["id"], webhook_replay.anonymize_id(DUMMY_SENDER_ID, "test"))
+        self.assertNotEqual(messaging_event["sender"]["id"], DUMMY_SENDER_ID)
+        self.assertEqual(messaging_event["message"]["text"], "xxxxx xxxx 12 xxx!")
+        self.assertEqual(messaging_event["message"]["nlp"]["entities"]["intent"][0]["value"], "study_next_fact")
+
+    def test_doesnt_record_without_salt(self):
+        self.assertRaises(ValueError, webhook_replay.Recorder, self.recording, 1.0, "")
+        with patch('webhook_replay.RECORD_PATH', self.recording), patch('webhook_replay.RECORD_SALT', None):
+            self.assertIsNone(webhook_replay.recorder_from_env())
+        with patch('webhook_replay.RECORD_PATH', self.recording), patch('webhook_replay.RECORD_SALT', "secret"):
+            self.assertEqual(webhook_replay.recorder_from_env().salt, "secret")
+
+    def test_replays_at_speed(self):
+        records = [(100.0, {"n": 1}), (101.0, {"n": 2}), (105.0, {"n": 3})]
+        clock = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        session = Mock()
+        session.post.return_value.status_code = 200
+        stats = webhook_replay.replay(records, "http://localhost:5000/", speed=2, session=session,
+                                      clock=lambda: clock[0], sleep=sleep)
+        self.assertEqual(sleeps, [0.5, 2.0])
+        self.assertEqual(stats["sent"], 3)
+        self.assertEqual([c[1]["json"]["n"] for c in session.post.call_args_list], [1, 2, 3])
+
+    def test_graph_stub(self):
+        stub = webhook_replay.create_graph_stub().test_client()
+        response = stub.post('/me/messages', data=json.dumps({"recipient": {"id": "1"}, "message": {"text": "Hi"}}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode())["recipient_id"], "1")
+        response = stub.get('/1')
+        self.assertEqual(json.loads(response.data.decode())["first_name"], "Replay")
+
+
+class BudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = budgets.CountingRedis(FakeRedis())
+        self.patch = patch('studybot.cache', self.cache)
+        self.patch.start()
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+
+    def tearDown(self):
+        self.patch.stop()
+        remove_test_data()
+
+    def post_within_budget(self, text, intent, flow=None):
+        """Post a message and assert that handling it stayed within its flow's budget"""
+        payload = get_payload(text, [get_intent_object(intent)])
+        headers = {
+            'Content-type': 'application/json'
+        }
+        with budgets.capture() as usages:
+            response = self.app.post('/', data=json.dumps(payload), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(usages), 1)
+        usage = usages[0]
+        self.assertEqual(usage.flow, flow or intent)
+        self.assertEqual(usage.over_budget(), [], "%s\n%s" % (usage.serialize, "\n".join(usage.statements)))
+        return usage
+
+    def add_fact(self, question):
+        self.post_within_budget("Add a fact", "add_fact")
+        self.post_within_budget(question, "add_fact", "EXPECTING_FACT_QUESTION")
+        self.post_within_budget("Dummy Answer", "add_fact", "EXPECTING_FACT_ANSWER")
+
+    def test_flows_stay_within_budget(self):
+        self.add_fact("Dummy Question 1")
+        self.add_fact("Dummy Question 2")
+        self.post_within_budget("Study time!", "study_next_fact")
+        self.post_within_budget("Dummy Answer", "study_next_fact", "EXPECTING_STUDY_ANSWER")
+        self.post_within_budget("4", "study_next_fact", "EXPECTING_STUDY_PERF_RATING")
+
+    def test_view_facts_queries_do_not_grow_with_deck(self):
+        self.add_fact("Dummy Question 1")
+        small_deck = self.post_within_budget("Show my facts", "view_facts")
+        for i in range(2, 6):
+            self.add_fact("Dummy Question %d" % i)
+        large_deck = self.post_within_budget("Show my facts", "view_facts")
+        self.assertEqual(large_deck.sql, small_deck.sql)
+        self.assertEqual(large_deck.graph, 6)
+
+    def test_counts_redis_round_trips(self):
+        with budgets.track("test") as usage:
+            self.cache.get("key")
+            pipe = self.cache.pipeline()
+            pipe.set("key", 1)
+            pipe.expire("key", 10)
+            pipe.execute()
+        self.assertEqual(usage.redis, 2)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patch = patch('studybot.cache', FakeRedis())
+        self.patch.start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.wsgi_app = studybot.app.wsgi_app
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+
+    def tearDown(self):
+        studybot.app.wsgi_app = self.wsgi_app
+        self.directory.cleanup()
+        self.patch.stop()
+        remove_test_data()
+
+    def post(self, text, intent, headers=None, environ=None):
+        payload = get_payload(text, [get_intent_object(intent)])
+        headers = dict(headers or {}, **{'Content-type': 'application/json'})
+        response = self.app.post('/', data=json.dumps(payload), headers=headers, environ_base=environ or {})
+        self.assertEqual(response.status_code, 200)
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_samples_every_nth_request(self):
+        studybot.app.wsgi_app = profiling.ProfilingMiddleware(self.wsgi_app, 2, [], self.directory.name)
+        self.post("Add a fact", "add_fact")
+        self.assertEqual(self.profiles(), [])
+        self.post("Dummy Question", "add_fact")
+        self.assertEqual(len(self.profiles()), 2)
+
+        with open(os.path.join(self.directory.name, self.profiles()[0])) as metadata:
+            events = json.load(metadata)["events"]
+        self.assertEqual(events, [{"intent": "add_fact", "state": "EXPECTING_FACT_QUESTION"}])
+        report = profiling.report(self.directory.name, intent="add_fact")
+        self.assertIn("1 profiled requests", report)
+        self.assertIn("respond_to_message", report)
+        self.assertEqual(profiling.report(self.directory.name, intent="view_facts"), "No profiles found.")
+
+    def test_header_only_honoured_from_allowed_sources(self):
+        studybot.app.wsgi_app = profiling.ProfilingMiddleware(self.wsgi_app, 0, ["10.0.0.1"], self.directory.name)
+        header = {profiling.PROFILE_HEADER: "1"}
+        self.post("Show my facts", "view_facts", header, {'REMOTE_ADDR': "10.0.0.2"})
+        self.post("Show my facts", "view_facts", header, {'REMOTE_ADDR': "10.0.0.2",
+                                                          'HTTP_X_FORWARDED_FOR': "10.0.0.1, 10.0.0.2"})
+        self.post("Show my facts", "view_facts", None, {'REMOTE_ADDR': "10.0.0.1"})
+        self.assertEqual(self.profiles(), [])
+        self.post("Show my facts", "view_facts", header, {'REMOTE_ADDR': "10.0.0.1"})
+        self.assertEqual(len(self.profiles()), 2)
+
+    def test_worker_threads_are_profiled(self):
+        other_sender_id = "0000000002"
+        studybot.app.wsgi_app = profiling.ProfilingMiddleware(self.wsgi_app, 1, [], self.directory.name)
+        payload = copy.deepcopy(get_payload("Show my facts", [get_intent_object("view_facts")]))
+        other_event = copy.deepcopy(payload["entry"][0]["messaging"][0])
+        other_event["sender"]["id"] = other_sender_id
+        payload["entry"][0]["messaging"].append(other_event)
+        try:
+            self.app.post('/', data=json.dumps(payload), headers={'Content-type': 'application/json'})
+        finally:
+            other_user = studybot.get_user(other_sender_id)
+            studybot.db.session.delete(other_user)
+            studybot.db.session.commit()
+
+        metadata_file, _ = self.profiles()
+        with open(os.path.join(self.directory.name, metadata_file)) as metadata:
+            events = json.load(metadata)["events"]
+        self.assertEqual(len(events), 2)
+        # Note: Look past the top 20, the order of the worker's frames varies with timing.
+        self.assertIn("respond_to_message", profiling.report(self.directory.name, limit=None))
+
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+class TracingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.exporter = ListExporter()
+        self.previous_exporter = tracing.set_exporter(self.exporter)
+        self.patch = patch('studybot.cache', budgets.CountingRedis(FakeRedis()))
+        self.patch.start()
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+
+    def tearDown(self):
+        tracing.set_exporter(self.previous_exporter)
+        self.patch.stop()
+        remove_test_data()
+
+    def post(self, text, intent):
+        payload = get_payload(text, [get_intent_object(intent)])
+        headers = {
+            'Content-type': 'application/json'
+        }
+        response = self.app.post('/', data=json.dumps(payload), headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_one_trace_per_event(self):
+        self.post("Add a fact", "add_fact")
+        self.post("Dummy Question", "add_fact")
+        self.assertEqual(len(self.exporter.traces), 2)
+
+        spans = self.exporter.traces[1]
+        root = spans[-1]
+        self.assertEqual(root.name, "webhook_event")
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(root.attributes, {"sender": DUMMY_SENDER_ID, "intent": "add_fact",
+                                           "state": "EXPECTING_FACT_QUESTION"})
+        children = spans[:-1]
+        self.assertTrue(any(span.name == "sql" for span in children))
+        self.assertTrue(any(span.name.startswith("redis ") for span in children))
+        for span in children:
+            self.assertEqual(span.trace_id, root.trace_id)
+            self.assertEqual(span.parent_id, root.span_id)
+            self.assertTrue(root.start <= span.start <= span.end <= root.end)
+
+    def test_nothing_traced_outside_events_or_when_off(self):
+        self.assertIsNone(tracing.start_span("sql"))
+        studybot.User.query.all()
+        self.assertEqual(self.exporter.traces, [])
+
+        tracing.set_exporter(None)
+        self.post("Show my facts", "view_facts")
+        self.assertEqual(self.exporter.traces, [])
+
+    def test_file_exporter_writes_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "traces.jsonl")
+            tracing.set_exporter(tracing.FileExporter(path))
+            with tracing.trace("event", sender="1"):
+                with tracing.span("child"):
+                    pass
+            with open(path) as trace_file:
+                spans = [json.loads(line) for line in trace_file]
+        self.assertEqual([span["name"] for span in spans], ["child", "event"])
+        self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+
+    def test_otlp_exporter_encoding(self):
+        with self.assertRaises(ValueError):
+            with tracing.trace("event", sender="1"):
+                with tracing.span("redis get", attempt=1):
+                    raise ValueError("boom")
+        exporter = tracing.OTLPExporter("http://collector/v1/traces", session=Mock())
+        encoded = exporter.encode(self.exporter.traces[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        self.assertEqual(encoded[0]["parentSpanId"], encoded[1]["spanId"])
+        self.assertEqual(encoded[0]["attributes"], [{"key": "attempt", "value": {"intValue": "1"}}])
+        self.assertEqual(encoded[0]["status"], {"code": 2, "message": "ValueError: boom"})
+        self.assertEqual(encoded[1]["kind"], 2)
+
+
+class FactCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        studybot.current_user.tmp_fact = create_dummy_fact("Dummy Question", "Dummy Answer")
+        self.assertTrue(studybot.create_fact())
+        self.fact_id = studybot.get_user(DUMMY_SENDER_ID).facts[0].id
+        fact_cache._facts.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        fact_cache._facts.clear()
+        remove_test_data()
+
+    def lookup(self):
+        with budgets.track("test") as usage:
+            fact = studybot.get_fact(self.fact_id)
+        return fact, usage.sql
+
+    def test_repeated_lookups_are_cached(self):
+        fact, queries = self.lookup()
+        self.assertEqual(queries, 1)
+        fact, queries = self.lookup()
+        self.assertEqual(queries, 0)
+        self.assertEqual(fact.question, "Dummy Question")
+        self.assertEqual(metrics.get_counter("fact_cache.hits"), 1)
+        self.assertEqual(metrics.get_counter("fact_cache.misses"), 1)
+
+    def test_update_delete_and_review_invalidate(self):
+        self.lookup()
+        studybot.current_user.tmp_fact = studybot.Fact(id=self.fact_id, question="New Question", answer="New Answer")
+        self.assertTrue(studybot.update_fact(self.fact_id))
+        fact, queries = self.lookup()
+        self.assertEqual(queries, 1)
+        self.assertEqual(fact.question, "New Question")
+
+        studybot.update_next_fact_per_SM2_alg(DUMMY_SENDER_ID, 5)
+        fact, queries = self.lookup()
+        self.assertEqual(queries, 1)
+        self.assertEqual(fact.consecutive_correct_answers, 1)
+
+        self.assertTrue(studybot.delete_fact(self.fact_id))
+        fact, queries = self.lookup()
+        self.assertIsNone(fact)
+
+    def test_change_in_another_process_bumps_version(self):
+        self.lookup()
+        fact_cache.bump_versions([self.user_id], self.cache)
+        fact, queries = self.lookup()
+        self.assertEqual(queries, 1)
+
+    def test_lru_and_ttl(self):
+        now = [0]
+        facts = fact_cache.FactCache(size=2, ttl_seconds=10, clock=lambda: now[0])
+        for fact_id in (1, 2, 3):
+            facts.put(studybot.Fact(id=fact_id, user_id=1, question="Q%d" % fact_id), 7)
+        self.assertEqual(len(facts), 2)
+        self.assertIsNone(facts.get(1, 1, 7))
+        self.assertEqual(facts.get(1, 2, 7).question, "Q2")
+        self.assertIsNone(facts.get(1, 3, 8))
+        now[0] = 10
+        self.assertIsNone(facts.get(1, 2, 7))
+
+
+class WebhookBatchTestCase(unittest.TestCase):
+    OTHER_SENDER_ID = "0000000001"
+
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.change_typing_indicator = Mock()
+        studybot.get_users_firstname = Mock(return_value=DUMMY_FIRST_NAME)
+        studybot.send_message = Mock(side_effect=mocked_send_request)
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.commits = 0
+        event.listen(core.db.engine, "commit", self.count_commit)
+
+    def tearDown(self):
+        event.remove(core.db.engine, "commit", self.count_commit)
+        for p in self.patches:
+            p.stop()
+        other_user = studybot.get_user(self.OTHER_SENDER_ID)
+        if other_user:
+            for fact in other_user.facts:
+                studybot.db.session.delete(fact)
+            studybot.db.session.delete(other_user)
+            studybot.db.session.commit()
+        remove_test_data()
+
+    def count_commit(self, conn):
+        self.commits += 1
+
+    def post(self, messages):
+        """Post one payload holding a messaging event per (sender, text, intent)"""
+        payload = copy.deepcopy(DUMMY_PAYLOAD)
+        events = []
+        for sender_id, text, intent in messages:
+            messaging_event = copy.deepcopy(get_payload(text, [get_intent_object(intent)])["entry"][0]["messaging"][0])
+            messaging_event["sender"]["id"] = sender_id
+            events.append(messaging_event)
+        payload["entry"][0]["messaging"] = events
+        headers = {
+            'Content-type': 'application/json'
+        }
+        response = self.app.post('/', data=json.dumps(payload), headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def add_fact_messages(self, sender_id, question):
+        return [(sender_id, "Add a fact", "add_fact"),
+                (sender_id, question, "add_fact"),
+                (sender_id, "Dummy Answer", "add_fact")]
+
+    def questions(self, sender_id):
+        return sorted(fact.question for fact in studybot.get_user(sender_id).facts)
+
+    def test_sender_events_share_one_transaction(self):
+        self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1") +
+                  self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 2"))
+        self.assertEqual(self.questions(DUMMY_SENDER_ID), ["Dummy Question 1", "Dummy Question 2"])
+        self.assertEqual(self.commits, 1)
+        self.assertEqual(len(RESPONSES), 6)
+        self.assertEqual(RESPONSES[0]["message"]["text"], "Ok, let's add that new fact. What is the question?")
+
+        state = core.ConvoState.deserialize(self.cache.get(DUMMY_SENDER_ID))
+        self.assertEqual(state.state, studybot.State.DEFAULT)
+
+    def test_state_is_loaded_and_stored_once(self):
+        with patch.object(self.cache, 'get', wraps=self.cache.get) as cache_get, \
+                patch('convo_cache.store', wraps=convo_cache.store) as store:
+            self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question"))
+        self.assertEqual(len([c for c in cache_get.call_args_list if c[0][0] == DUMMY_SENDER_ID]), 1)
+        self.assertEqual(len([c for c in store.call_args_list if c[0][1] == DUMMY_SENDER_ID]), 1)
+
+    def test_senders_are_handled_separately(self):
+        self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1")[:2] +
+                  [(self.OTHER_SENDER_ID, "Hello", "default_intent")] +
+                  self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1")[2:])
+        self.assertEqual(self.questions(DUMMY_SENDER_ID), ["Dummy Question 1"])
+        self.assertIsNotNone(studybot.get_user(self.OTHER_SENDER_ID))
+        replies = [r["message"]["text"] for r in RESPONSES if r["recipient"]["id"] == self.OTHER_SENDER_ID]
+        self.assertEqual(replies, [get_welcome_message()])
+
+    def test_failed_event_does_not_undo_others(self):
+        metrics.reset()
+        with patch('studybot.get_nlp_duration', side_effect=RuntimeError("boom")):
+            self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1") +
+                      [(DUMMY_SENDER_ID, "Silence studying for a day", "silence_studying")] +
+                      self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 2"))
+        self.assertEqual(self.questions(DUMMY_SENDER_ID), ["Dummy Question 1", "Dummy Question 2"])
+        self.assertEqual(metrics.get_counter("webhook.failed_events"), 1)
+        self.assertEqual(self.commits, 1)
+
+    def test_failed_event_state_is_rolled_back_and_reported(self):
+        def send_message(sender_id, text, is_response=True):
+            if text.startswith("Thanks") and not failed:
+                failed.append(text)
+                raise RuntimeError("boom")
+            return mocked_send_request(sender_id, text, is_response)
+        failed = []
+        with patch('studybot.send_message', Mock(side_effect=send_message)), \
+                patch('studybot.deliver_message') as deliver:
+            self.post([(DUMMY_SENDER_ID, "Add a fact", "add_fact"),
+                       (DUMMY_SENDER_ID, "Dummy Question 1", "add_fact"),
+                       (DUMMY_SENDER_ID, "Dummy Question 2", "add_fact")])
+        deliver.assert_called_once_with(DUMMY_SENDER_ID, studybot.EVENT_FAILED_MESSAGE, True)
+        self.assertEqual(self.questions(DUMMY_SENDER_ID), [])
+        state = core.ConvoState.deserialize(self.cache.get(DUMMY_SENDER_ID))
+        self.assertEqual(state.state, studybot.State.EXPECTING_FACT_ANSWER)
+        self.assertEqual(state.tmp_fact.question, "Dummy Question 2")
+
+    def test_later_events_study_the_next_fact(self):
+        self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1") +
+                  self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 2"))
+        study = [(DUMMY_SENDER_ID, "Study", "study_next_fact"),
+                 (DUMMY_SENDER_ID, "Dummy Answer", "default_intent"),
+                 (DUMMY_SENDER_ID, "5", "default_intent")]
+        self.post(study + study)
+        facts = studybot.get_user(DUMMY_SENDER_ID).facts
+        self.assertEqual([fact.consecutive_correct_answers for fact in facts], [1, 1])
+
+    def test_replies_and_cache_updates_wait_for_the_commit(self):
+        calls = []
+        with patch('studybot.send_message', QUEUED_SEND_MESSAGE), \
+                patch('studybot.deliver_message', side_effect=lambda *args: calls.append(("reply", self.commits))), \
+                patch('due_queue.schedule', side_effect=lambda *args: calls.append(("schedule", self.commits))):
+            self.post(self.add_fact_messages(DUMMY_SENDER_ID, "Dummy Question 1"))
+        self.assertEqual(calls, [("reply", 1)] * 2 + [("schedule", 1), ("reply", 1)])
+
+    def test_nothing_is_reported_when_the_commit_fails(self):
+        # Note: A single event, pysqlite commits when a savepoint is released.
+        convo_state = core.ConvoState(studybot.get_user(DUMMY_SENDER_ID).id, studybot.State.EXPECTING_FACT_ANSWER)
+        convo_state.tmp_fact.question = "Dummy Question 1"
+        core.store_convo_state(DUMMY_SENDER_ID, convo_state, self.cache)
+        with patch('studybot.send_message', QUEUED_SEND_MESSAGE), \
+                patch('studybot.deliver_message') as deliver, \
+                patch('due_queue.schedule') as schedule, \
+                patch.object(studybot.db.session, 'commit', side_effect=RuntimeError("boom")):
+            self.post([(DUMMY_SENDER_ID, "Dummy Answer", "add_fact")])
+        deliver.assert_called_once_with(DUMMY_SENDER_ID, studybot.COMMIT_FAILED_MESSAGE, True)
+        schedule.assert_not_called()
+        self.assertEqual(self.questions(DUMMY_SENDER_ID), [])
+        # The user can send the answer again.
+        state = core.ConvoState.deserialize(self.cache.get(DUMMY_SENDER_ID))
+        self.assertEqual(state.state, studybot.State.EXPECTING_FACT_ANSWER)
+
+class CompactScheduleTestCase(unittest.TestCase):
+    def test_easiness_and_due_date_properties(self):
+        fact = studybot.Fact(easiness=2.36, next_due_date=studybot.datetime(2018, 1, 2, 13, 30))
+        self.assertEqual(fact.easiness_hundredths, 236)
+        self.assertEqual(fact.easiness, 2.36)
+        self.assertEqual(fact.due_day, 17533)
+        self.assertEqual(fact.next_due_date, studybot.datetime(2018, 1, 2))
+        aware = studybot.datetime(2018, 1, 2, 23, 30, tzinfo=studybot.pytz.timezone("US/Eastern"))
+        self.assertEqual(core.to_due_day(aware), 17534)
+        self.assertEqual(fact.serialize["easiness"], 2.36)
+
+    def test_sm2_arithmetic_stays_exact(self):
+        fact = studybot.Fact(easiness=studybot.DEFAULT_EASINESS, consecutive_correct_answers=0, due_day=100)
+        for rating in (5, 5, 5, 4, 3):
+            core.apply_sm2_rating(fact, rating)
+        self.assertEqual(fact.easiness_hundredths, 130)
+        self.assertEqual(fact.consecutive_correct_answers, 5)
+        self.assertEqual(fact.due_day, 100 + 1 + 6 + 8 + 11 + 9)
+
+    def test_review_log_has_the_intervals_used(self):
+        fact = studybot.Fact(easiness=studybot.DEFAULT_EASINESS, consecutive_correct_answers=0, due_day=100,
+                             interval_days=1)
+        rows = [core.review_fact(fact, rating) for rating in (5, 5, 5, 3, 3)]
+        self.assertEqual(rows[0]["previous_interval"], 1)
+        for previous, row in zip(rows, rows[1:]):
+            self.assertEqual(row["previous_interval"], previous["new_interval"])
+
+    def test_buffered_schedules_round_trip(self):
+        schedule = review_buffer._Schedule(250, 2, 17533, studybot.datetime(2018, 1, 1, 13, 30), 6,
+                                           studybot.datetime(2017, 12, 26, 9, 0))
+        restored = review_buffer._Schedule.deserialize(json.loads(json.dumps(schedule.serialize)))
+        for column in review_buffer._Schedule.COLUMNS:
+            self.assertEqual(getattr(restored, column), getattr(schedule, column), column)
+        self.assertIsNone(review_buffer._Schedule.deserialize(
+            review_buffer._Schedule(250, 0, 17533, studybot.datetime(2018, 1, 1)).serialize).first_reviewed_at)
+
+    def test_new_fact_is_due_tomorrow_utc(self):
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        try:
+            studybot.set_user(studybot.ConvoState(studybot.get_user(DUMMY_SENDER_ID).id, studybot.State.DEFAULT))
+            studybot.current_user.tmp_fact = create_dummy_fact("Dummy Question", "Dummy Answer")
+            with patch('studybot.cache', FakeRedis()), patch('core.cache', FakeRedis()):
+                self.assertTrue(studybot.create_fact())
+            fact = studybot.find_user_fact(studybot.get_user(DUMMY_SENDER_ID).id, question="Dummy Question")
+            self.assertEqual(fact.due_day, core.to_due_day(studybot.datetime.utcnow()) + 1)
+        finally:
+            remove_test_data()
+
+
+class AsyncModeTestCase(unittest.TestCase):
+    def tearDown(self):
+        importlib.reload(gunicorn_config)
+
+    def test_gunicorn_uses_gevent_workers_in_async_mode(self):
+        self.assertFalse(hasattr(gunicorn_config, "worker_class"))
+        with patch('async_mode.SERVER_MODE', "async"):
+            importlib.reload(gunicorn_config)
+        self.assertEqual(gunicorn_config.worker_class, "gevent")
+        self.assertEqual(gunicorn_config.worker_connections, async_mode.ASYNC_WORKER_CONNECTIONS)
+
+
+class GraphDeliveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = FakeRedis()
+        self.cache.flushall()
+        self.breaker = graph_delivery.CircuitBreaker(failure_threshold=2, reset_seconds=30, clock=lambda: self.now)
+        self.session = Mock()
+        self.patches = [patch('core.cache', self.cache), patch('core.graph_session', self.session),
+                        patch('graph_delivery.breaker', self.breaker),
+                        patch.dict(os.environ, {"PAGE_ACCESS_TOKEN": "token"})]
+        for p in self.patches:
+            p.start()
+        metrics.reset()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def dead_letters(self):
+        return [(json.loads(member), score) for member, score in
+                self.cache.zrange(graph_delivery.DEAD_LETTER_KEY, 0, -1, withscores=True)]
+
+    def test_circuit_opens_and_probes_after_reset(self):
+        self.session.request.side_effect = requests.Timeout()
+        for _ in range(2):
+            self.assertRaises(graph_delivery.GraphUnavailable, graph_delivery.request, self.session, "GET", "url")
+        self.assertEqual(self.breaker.state, graph_delivery.CircuitBreaker.OPEN)
+
+        # Fails fast while open.
+        self.assertRaises(graph_delivery.GraphUnavailable, graph_delivery.request, self.session, "GET", "url")
+        self.assertEqual(self.session.request.call_count, 2)
+
+        # A single trial call after the reset period, which closes the circuit.
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, graph_delivery.CircuitBreaker.CLOSED)
+        self.assertEqual(metrics.get_counter("graph.circuit_opened"), 1)
+
+    def test_unexpected_trial_error_reopens_the_circuit(self):
+        self.breaker.state, self.breaker.opened_at = graph_delivery.CircuitBreaker.OPEN, self.now - 30
+        self.session.request.side_effect = ValueError("unexpected")
+        self.assertRaises(ValueError, graph_delivery.request, self.session, "GET", "url")
+        self.assertEqual(self.breaker.state, graph_delivery.CircuitBreaker.OPEN)
+
+        self.now += 30
+        self.session.request.side_effect = None
+        self.session.request.return_value = Mock(status_code=200)
+        self.assertEqual(graph_delivery.request(self.session, "GET", "url").status_code, 200)
+        self.assertEqual(self.breaker.state, graph_delivery.CircuitBreaker.CLOSED)
+
+    def test_client_errors_dont_trip_the_circuit(self):
+        self.session.request.return_value = Mock(status_code=400, text="bad request")
+        for _ in range(3):
+            self.assertEqual(graph_delivery.request(self.session, "GET", "url").status_code, 400)
+        self.assertEqual(self.breaker.state, graph_delivery.CircuitBreaker.CLOSED)
+        self.assertEqual(self.session.request.call_args[1]["timeout"],
+                         (graph_delivery.GRAPH_CONNECT_TIMEOUT_SECONDS, graph_delivery.GRAPH_READ_TIMEOUT_SECONDS))
+
+    def test_undeliverable_message_is_dead_lettered(self):
+        self.session.request.side_effect = requests.ConnectionError()
+        self.assertFalse(core.send_message(DUMMY_SENDER_ID, "Hello", True))
+        (letter, score), = self.dead_letters()
+        self.assertEqual(letter["message"]["message"], {"text": "Hello"})
+        self.assertEqual(letter["attempts"], 0)
+        self.assertNotIn("token", json.dumps(letter))
+
+        # Typing indicators and profile lookups aren't queued.
+        core.change_typing_indicator(True, DUMMY_SENDER_ID)
+        self.assertEqual(core.get_users_firstname(DUMMY_SENDER_ID), core.FALLBACK_FIRSTNAME)
+        self.assertEqual(len(self.dead_letters()), 1)
+
+    def test_redelivery_backs_off_until_delivered(self):
+        graph_delivery.dead_letter(self.cache, {"recipient": {"id": DUMMY_SENDER_ID}}, "test", now=self.now)
+        self.assertEqual(graph_delivery.redeliver_due(circuit=self.breaker, now=self.now), 0)
+        self.session.request.assert_not_called()
+
+        self.now += graph_delivery.retry_delay(0)
+        self.session.request.return_value = Mock(status_code=503, text="unavailable")
+        self.assertEqual(graph_delivery.redeliver_due(circuit=self.breaker, now=self.now), 0)
+        (letter, score), = self.dead_letters()
+        self.assertEqual(letter["attempts"], 1)
+        self.assertEqual(score, self.now + graph_delivery.retry_delay(1))
+
+        self.now = score
+        self.session.request.return_value = Mock(status_code=200, text="{}")
+        self.assertEqual(graph_delivery.redeliver_due(circuit=self.breaker, now=self.now), 1)
+        self.assertEqual(self.dead_letters(), [])
+        self.assertEqual(metrics.get_counter("graph.dead_letters.redelivered"), 1)
+
+    def test_unexpected_redelivery_error_keeps_the_letter(self):
+        graph_delivery.dead_letter(self.cache, {"recipient": {"id": DUMMY_SENDER_ID}}, "test", now=self.now)
+        self.now += graph_delivery.retry_delay(0)
+        self.session.request.side_effect = ValueError("bad payload")
+        self.assertEqual(graph_delivery.redeliver_due(circuit=self.breaker, now=self.now), 0)
+        (letter, score), = self.dead_letters()
+        self.assertEqual(letter["attempts"], 1)
+        self.assertEqual(score, self.now + graph_delivery.retry_delay(1))
+
+    def test_expired_dead_letters_are_dropped(self):
+        graph_delivery.dead_letter(self.cache, {"recipient": {"id": DUMMY_SENDER_ID}}, "test", now=self.now)
+        self.now += graph_delivery.GRAPH_DEAD_LETTER_MAX_AGE_SECONDS + 1
+        self.assertEqual(graph_delivery.redeliver_due(circuit=self.breaker, now=self.now), 0)
+        self.session.request.assert_not_called()
+        self.assertEqual(self.dead_letters(), [])
+
+
+class FactLoadingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        studybot.current_user.tmp_fact = create_dummy_fact("Dummy Question", "Dummy Answer")
+        self.assertTrue(studybot.create_fact())
+        self.fact_id = studybot.get_user(DUMMY_SENDER_ID).facts[0].id
+        fact_cache._facts.clear()
+        studybot.db.session.expunge_all()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        fact_cache._facts.clear()
+        remove_test_data()
+
+    def statements(self, func, *args):
+        with budgets.track("test") as usage:
+            result = func(*args)
+        return result, [" ".join(statement.split()) for statement in usage.statements]
+
+    def test_fact_lookups_dont_join_users(self):
+        for func, arg in [(studybot.get_fact_by_id, self.fact_id), (studybot.get_fact_by_question, "Dummy Question")]:
+            fact, statements = self.statements(func, arg)
+            self.assertEqual(fact.answer, "Dummy Answer")
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn("users", statements[0])
+
+    def test_listing_loads_only_displayed_columns(self):
+        facts, statements = self.statements(core.list_user_facts, DUMMY_SENDER_ID)
+        self.assertEqual([fact.question for fact in facts], ["Dummy Question"])
+        select, = statements
+        columns = select[len("SELECT "):select.index(" FROM ")]
+        self.assertEqual(columns, "facts.id AS facts_id, facts.question AS facts_question")
+
+    def test_update_and_delete_dont_load_fact_contents(self):
+        studybot.current_user.tmp_fact = core.Fact(question="New Question", answer="New Answer")
+        for func in [studybot.update_fact, studybot.delete_fact]:
+            success, statements = self.statements(func, self.fact_id)
+            self.assertTrue(success)
+            select = statements[0]
+            self.assertTrue(select.startswith("SELECT "))
+            self.assertNotIn("users", select)
+            self.assertNotIn("facts.answer", select)
+            self.assertNotIn("facts.question", select)
+        self.assertEqual(studybot.get_user(DUMMY_SENDER_ID).facts, [])
+
+
+class ConvoCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = FakeRedis()
+        self.cache.flushall()
+        self.patches = [patch('convo_cache._entries', convo_cache.LocalCache(clock=lambda: self.now)),
+                        patch('convo_cache._subscribed', threading.Event())]
+        for p in self.patches:
+            p.start()
+        convo_cache._subscribed.set()
+        metrics.reset()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_own_writes_are_served_locally(self):
+        convo_cache.store(self.cache, DUMMY_SENDER_ID, "state", 300)
+        self.assertEqual(self.cache.get(DUMMY_SENDER_ID), b"state")
+        with patch.object(self.cache, 'get') as cache_get:
+            self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), "state")
+        cache_get.assert_not_called()
+
+        # Writes announced by other processes, and old entries, go to Redis.
+        self.cache.set(DUMMY_SENDER_ID, "other")
+        convo_cache.handle_invalidation(("other-process %s" % DUMMY_SENDER_ID).encode())
+        self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), b"other")
+        self.cache.set(DUMMY_SENDER_ID, "newer")
+        self.now += convo_cache.CONVO_CACHE_TTL_SECONDS
+        self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), b"newer")
+        self.assertEqual(metrics.get_counter("convo_cache.hits"), 1)
+
+        # Its own invalidations are ignored.
+        convo_cache.handle_invalidation("%s %s" % (convo_cache.origin(), DUMMY_SENDER_ID))
+        self.assertEqual(len(convo_cache._entries), 1)
+
+    def test_state_survives_redis_outage(self):
+        convo_cache.store(self.cache, DUMMY_SENDER_ID, "state", 300)
+        convo_cache._subscribed.clear()
+        with patch.object(self.cache, 'get', side_effect=ConnectionError()), \
+                patch.object(self.cache, 'pipeline', side_effect=ConnectionError()):
+            self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), "state")
+            convo_cache.store(self.cache, DUMMY_SENDER_ID, "changed", 300)
+            self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), "changed")
+            self.assertRaises(ConnectionError, convo_cache.load, self.cache, "unknown", 300)
+
+        # Written back once Redis is reachable again.
+        self.assertEqual(convo_cache.load(self.cache, DUMMY_SENDER_ID, 300), "changed")
+        self.assertEqual(self.cache.get(DUMMY_SENDER_ID), b"changed")
+        self.assertFalse(convo_cache._entries.get(DUMMY_SENDER_ID).dirty)
+
+    def test_entries_expire_like_redis(self):
+        convo_cache.store(self.cache, DUMMY_SENDER_ID, "state", 300)
+        self.now += 300
+        self.assertIsNone(convo_cache._entries.get(DUMMY_SENDER_ID))
+
+
+class ForecastTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        self.today = core.to_due_day(studybot.datetime.utcnow())
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        remove_test_data()
+
+    def add_fact(self, question):
+        studybot.current_user.tmp_fact = create_dummy_fact(question, "Dummy Answer")
+        self.assertTrue(studybot.create_fact())
+        return studybot.find_user_fact(self.user_id, question=question).id
+
+    def reviews(self, user_id=core.GLOBAL_USER_ID):
+        return [day['reviews'] for day in forecast.forecast(3, user_id, today=self.today, client=self.cache)['days']]
+
+    def test_counts_follow_fact_changes(self):
+        first = self.add_fact("Dummy Question 1")
+        self.add_fact("Dummy Question 2")
+        self.assertEqual(self.reviews(), [0, 2, 0])
+        self.assertEqual(self.reviews(self.user_id), [0, 2, 0])
+
+        # Rated 5 on its first review, so it moves on by a day.
+        with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(first)):
+            studybot.update_next_fact_per_SM2_alg(self.user_id, 5)
+        self.assertEqual(self.reviews(), [0, 1, 1])
+
+        self.assertTrue(studybot.delete_fact(first))
+        self.assertEqual(self.reviews(self.user_id), [0, 1, 0])
+
+        # The rollup matches one rebuilt from the facts table.
+        counts = studybot.db.session.query(core.DueCount.user_id, core.DueCount.due_day, core.DueCount.facts)
+        incremental = set(row for row in counts.all() if row[2])
+        studybot.db.session.commit()
+        forecast.rebuild()
+        self.assertEqual(set(counts.all()), incremental)
+
+    def test_empty_days_are_deleted(self):
+        first = self.add_fact("Dummy Question 1")
+        self.add_fact("Dummy Question 2")
+        with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(first)):
+            studybot.update_next_fact_per_SM2_alg(self.user_id, 5)
+        self.assertEqual(sorted((count.user_id, count.due_day, count.facts) for count in core.DueCount.query),
+                         [(core.GLOBAL_USER_ID, self.today + 1, 1), (core.GLOBAL_USER_ID, self.today + 2, 1),
+                          (self.user_id, self.today + 1, 1), (self.user_id, self.today + 2, 1)])
+
+        core.delete_user_facts(self.user_id)
+        studybot.db.session.commit()
+        self.assertEqual(core.DueCount.query.count(), 0)
+
+    def test_forecast_doesnt_scan_facts(self):
+        self.add_fact("Dummy Question 1")
+        reminders.schedule_reminder(self.cache, self.user_id, (self.today + 1) * 86400 + 60)
+        with budgets.track("test") as usage:
+            result = forecast.forecast(3, today=self.today, client=self.cache)
+        self.assertEqual([day['reminders'] for day in result['days']], [0, 1, 0])
+        self.assertEqual(result['overdue_reviews'], 0)
+        self.assertEqual(usage.sql, 2)
+        self.assertFalse(any("facts" in statement.split("FROM")[1].split()[0] for statement in usage.statements))
+
+
+class FactCountersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        remove_test_data()
+
+    def add_fact(self, question):
+        studybot.current_user.tmp_fact = create_dummy_fact(question, "Dummy Answer")
+        self.assertTrue(studybot.create_fact())
+        return studybot.find_user_fact(self.user_id, question=question).id
+
+    def counters(self):
+        user = studybot.get_user(DUMMY_SENDER_ID)
+        return (user.fact_count, user.unstudied_fact_count)
+
+    def test_counters_follow_creates_reviews_and_deletes(self):
+        first = self.add_fact("Dummy Question 1")
+        second = self.add_fact("Dummy Question 2")
+        self.assertEqual(self.counters(), (2, 2))
+
+        for rating in [5, 1]:
+            with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(first)):
+                studybot.update_next_fact_per_SM2_alg(self.user_id, rating)
+        self.assertEqual(self.counters(), (2, 1))
+
+        self.assertTrue(studybot.delete_fact(second))
+        self.assertEqual(self.counters(), (1, 0))
+        self.assertTrue(studybot.delete_fact(first))
+        self.assertEqual(self.counters(), (0, 0))
+
+    def test_due_facts_are_counted_from_the_rollup(self):
+        self.add_fact("Dummy Question 1")
+        today = core.to_due_day(studybot.datetime.utcnow())
+        self.assertEqual(core.count_due_facts(self.user_id, today), 0)
+        self.assertEqual(core.count_due_facts(self.user_id, today + 1), 1)
+
+    def test_only_new_facts_are_unstudied(self):
+        schedule = review_buffer._Schedule(250, 0, 100, None)
+        self.assertTrue(core.is_unstudied(schedule))
+        for rating in [0, 5, 5, 2, 5, 3, 1]:
+            core.apply_sm2_rating(schedule, rating)
+            self.assertFalse(core.is_unstudied(schedule), rating)
+
+    def test_studied_fact_back_at_default_easiness_is_not_unstudied(self):
+        fact_id = self.add_fact("Dummy Question 1")
+        for rating in [5] * 41 + [2]:
+            with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(fact_id)):
+                studybot.update_next_fact_per_SM2_alg(self.user_id, rating)
+        fact = studybot.Fact.query.get(fact_id)
+        self.assertEqual((fact.easiness_hundredths, fact.consecutive_correct_answers), (250, 0))
+        self.assertFalse(core.is_unstudied(fact))
+        self.assertEqual(self.counters(), (1, 0))
+
+        self.assertTrue(studybot.delete_fact(fact_id))
+        self.assertEqual(self.counters(), (0, 0))
+
+    def test_empty_deck_is_not_listed(self):
+        with patch('studybot.list_user_facts') as list_user_facts, \
+                patch('studybot.send_message', Mock(side_effect=mocked_send_request)), \
+                patch('studybot.change_typing_indicator'):
+            studybot.app.test_client().post('/', data=json.dumps(get_payload("View facts", [
+                get_intent_object("view_facts")])), headers={'Content-type': 'application/json'})
+        list_user_facts.assert_not_called()
+        self.assertEqual(RESPONSES[-1]["message"]["text"],
+                         "Whoops! We don't have any facts for you try adding a new fact.")
+
+
+class BulkFactOperationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+        self.user_id = studybot.get_user(DUMMY_SENDER_ID).id
+        studybot.set_user(studybot.ConvoState(self.user_id, studybot.State.DEFAULT))
+        self.fact_ids = []
+        for i in range(4):
+            studybot.current_user.tmp_fact = create_dummy_fact("Dummy Question %d" % i, "Dummy Answer")
+            self.assertTrue(studybot.create_fact())
+            self.fact_ids.append(studybot.find_user_fact(self.user_id, question="Dummy Question %d" % i).id)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        fact_cache._facts.clear()
+        remove_test_data()
+
+    def counters(self):
+        user = studybot.get_user(DUMMY_SENDER_ID)
+        return (user.fact_count, user.unstudied_fact_count)
+
+    def due_counts(self, user_id):
+        return sum(count.facts for count in core.DueCount.query.filter_by(user_id=user_id))
+
+    def post(self, text, intent):
+        with patch('studybot.send_message', Mock(side_effect=mocked_send_request)), \
+                patch('studybot.change_typing_indicator'):
+            studybot.app.test_client().post('/', data=json.dumps(get_payload(text, [
+                get_intent_object(intent)])), headers={'Content-type': 'application/json'})
+        return RESPONSES[-1]["message"]["text"]
+
+    def test_range_delete_is_a_single_statement(self):
+        first, last = self.fact_ids[1], self.fact_ids[2]
+        with budgets.track("test") as usage:
+            deleted = core.delete_user_facts(self.user_id, first, last)
+        studybot.db.session.commit()
+        self.assertEqual(deleted, [first, last])
+        self.assertEqual(len([s for s in usage.statements if s.startswith("DELETE FROM facts")]), 1)
+        self.assertEqual(sorted(fact.id for fact in core.get_user_facts(DUMMY_SENDER_ID)),
+                         [self.fact_ids[0], self.fact_ids[3]])
+        self.assertEqual(self.counters(), (2, 2))
+        self.assertEqual(self.due_counts(self.user_id), 2)
+        self.assertEqual(self.due_counts(core.GLOBAL_USER_ID), 2)
+
+    def test_reset_makes_facts_new_again(self):
+        for fact_id in self.fact_ids[:2]:
+            with patch('studybot.get_next_due_fact', return_value=studybot.Fact.query.get(fact_id)):
+                studybot.update_next_fact_per_SM2_alg(self.user_id, 5)
+        studybot.db.session.commit()
+        self.assertEqual(self.counters(), (4, 2))
+
+        reset = core.reset_user_facts(self.user_id)
+        studybot.db.session.commit()
+        self.assertEqual(sorted(reset), self.fact_ids)
+        self.assertEqual(self.counters(), (4, 4))
+        tomorrow = core.to_due_day(studybot.datetime.utcnow()) + 1
+        self.assertEqual([count.due_day for count in core.DueCount.query.filter_by(user_id=self.user_id)],
+                         [tomorrow])
+        self.assertTrue(all(core.is_unstudied(fact) for fact in core.get_user_facts(DUMMY_SENDER_ID)))
+
+    def test_bulk_delete_is_confirmed_once(self):
+        self.assertEqual(self.post("Delete all facts", "delete_fact"),
+                         "Are you sure you want to delete all of your facts? This can't be undone.")
+        self.assertEqual(self.post("No", "default_intent"), "Ok, I won't change your facts.")
+        self.assertEqual(self.counters(), (4, 4))
+
+        self.post("Delete facts %d-%d" % (self.fact_ids[0], self.fact_ids[2]), "delete_fact")
+        self.assertEqual(self.post("Yes", "confirmation"), "Ok, I deleted 3 facts.")
+        self.assertEqual(self.counters(), (1, 1))
+        self.assertEqual(studybot.current_user.state, studybot.State.DEFAULT)
+        self.assertIsNone(studybot.current_user.bulk_operation)
+
+    def test_fact_selection_parsing(self):
+        self.assertEqual(studybot.parse_fact_selection("delete facts 10-200"), (10, 200))
+        self.assertEqual(studybot.parse_fact_selection("reset facts 20 to 3"), (3, 20))
+        self.assertEqual(studybot.parse_fact_selection("Delete ALL facts"), (None, None))
+        self.assertIsNone(studybot.parse_fact_selection("delete fact 4"))
+        self.assertIsNone(studybot.parse_fact_selection("delete a fact"))
+        self.assertEqual(studybot.parse_fact_selection("delete all of my facts"), (None, None))
+        self.assertEqual(studybot.parse_fact_selection("reset every fact"), (None, None))
+        self.assertIsNone(studybot.parse_fact_selection("delete the fact about all presidents"))
+        self.assertIsNone(studybot.parse_fact_selection("delete the fact about everything"))
+        self.assertEqual(studybot.parse_fact_selection("reset facts from 3 to 7"), (3, 7))
+        self.assertIsNone(studybot.parse_fact_selection("reset 2 to 3 days ago"))
+
+    def test_reset_needs_the_facts_named(self):
+        fact_id = self.fact_ids[1]
+        self.assertEqual(self.post("Reset progress on fact %d" % fact_id, "reset_progress"),
+                         "Are you sure you want to reset your progress on fact %d? "
+                         "They will be studied again from tomorrow." % fact_id)
+        self.assertEqual(studybot.current_user.bulk_operation,
+                         {"action": "reset", "first_id": fact_id, "last_id": fact_id})
+        self.post("No", "default_intent")
+
+        self.assertEqual(self.post("Reset my progress", "reset_progress"),
+                         "Ok, which facts do you want to reset? Send an ID, \"facts 3-7\" or \"all facts\".")
+        self.assertEqual(self.post("All facts", "default_intent"),
+                         "Are you sure you want to reset your progress on all of your facts? "
+                         "They will be studied again from tomorrow.")
+        self.post("No", "default_intent")
+
+        self.post("Reset my progress", "reset_progress")
+        self.assertEqual(self.post("Never mind", "default_intent"),
+                         "Whoops! We don't have a fact for you. Try viewing your facts to get the ID.")
+        self.assertEqual(studybot.current_user.state, studybot.State.DEFAULT)
+
+
+class GraphStubAdapter(requests.adapters.BaseAdapter):
+    """Sends Graph API requests to webhook_replay's stub, and serves test images"""
+    def __init__(self, images):
+        super(GraphStubAdapter, self).__init__()
+        self.stub = webhook_replay.create_graph_stub().test_client()
+        self.images = images
+        self.uploads = 0
+        self.fetched = []
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if request.url in self.images and self.images[request.url] is None:
+            # Redirects anywhere, e.g. to an internal address.
+            self.fetched.append(request.url)
+            response.status_code = 302
+            response.headers["Location"] = "http://169.254.169.254/latest/meta-data/"
+            response.raw = io.BytesIO(b"")
+            return response
+        if request.url in self.images:
+            self.fetched.append(request.url)
+            response.status_code = 200
+            response.headers["Content-Type"] = "image/png"
+            response.raw = io.BytesIO(self.images[request.url])
+            return response
+
+        if not request.url.startswith(core.GRAPH_API_URL):
+            response.status_code = 404
+            response.raw = io.BytesIO(b"")
+            return response
+        path = request.url[len(core.GRAPH_API_URL) - 1:]
+        if path.startswith("/me/message_attachments"):
+            self.uploads += 1
+        stub_response = self.stub.open(path, method=request.method, data=request.body,
+                                       headers=dict(request.headers))
+        response.status_code = stub_response.status_code
+        response.raw = io.BytesIO(stub_response.get_data())
+        return response
+
+    def close(self):
+        pass
+
+
+class AttachmentTestCase(unittest.TestCase):
+    IMAGE_URL = "https://scontent.xx.fbcdn.net/image.png"
+    OTHER_IMAGE_URL = "https://cdn.fbsbx.com/same-image.png"
+
+    def setUp(self):
+        self.cache = FakeRedis()
+        self.cache.flushall()
+        self.adapter = GraphStubAdapter({self.IMAGE_URL: b"\x89PNG image", self.OTHER_IMAGE_URL: b"\x89PNG image"})
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.send_image = Mock(return_value=True)
+        self.patches = [patch('studybot.cache', self.cache), patch('core.cache', self.cache),
+                        patch('core.graph_session', self.session),
+                        patch('graph_delivery.breaker', graph_delivery.CircuitBreaker()),
+                        patch('studybot.send_message', Mock(side_effect=mocked_send_request)),
+                        patch('studybot.send_image', self.send_image),
+                        patch('studybot.change_typing_indicator', Mock()),
+                        patch.dict(os.environ, {"PAGE_ACCESS_TOKEN": "token"})]
+        for p in self.patches:
+            p.start()
+        studybot.app.testing = True
+        self.app = studybot.app.test_client()
+        studybot.db.create_all()
+        studybot.create_user(DUMMY_SENDER_ID)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        remove_test_data()
+
+    def post(self, text, intent, image_url=None):
+        payload = copy.deepcopy(get_payload(text, [get_intent_object(intent)]))
+        if image_url:
+            message = payload["entry"][0]["messaging"][0]["message"]
+            del message["text"]
+            message["attachments"] = [{"type": "image", "payload": {"url": image_url}}]
+        response = self.app.post('/', data=json.dumps(payload), headers={'Content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+        return RESPONSES[-1]["message"]["text"]
+
+    def test_image_is_uploaded_once_per_content(self):
+        facts = [core.Fact(), core.Fact()]
+        self.assertTrue(attachments.attach_image(facts[0], self.IMAGE_URL))
+        self.assertTrue(attachments.attach_image(facts[1], self.OTHER_IMAGE_URL))
+        self.assertEqual(facts[0].attachment_id, "attachment.stub.1")
+        self.assertEqual(facts[1].attachment_id, facts[0].attachment_id)
+        self.assertEqual(self.adapter.uploads, 1)
+
+    def test_remembered_uploads_expire(self):
+        fact = core.Fact()
+        self.assertTrue(attachments.attach_image(fact, self.IMAGE_URL))
+        key, = self.cache.keys(attachments.ATTACHMENT_KEY % "*")
+        self.assertEqual(self.cache.get(key), fact.attachment_id.encode("utf-8"))
+        self.assertLessEqual(self.cache.ttl(key), attachments.ATTACHMENT_EXPIRATION_IN_SECONDS)
+        self.assertGreater(self.cache.ttl(key), 0)
+
+    def test_large_image_is_fetched_in_chunks(self):
+        image = bytes(range(256)) * 1024
+        self.adapter.images[self.IMAGE_URL] = image
+        content, content_type = attachments.fetch_image(self.IMAGE_URL, self.session)
+        self.assertEqual(content, image)
+        with patch('attachments.ATTACHMENT_MAX_BYTES', len(image) - 1):
+            self.assertRaises(attachments.AttachmentError, attachments.fetch_image, self.IMAGE_URL, self.session)
+
+    def test_failed_upload_leaves_fact_without_image(self):
+        fact = core.Fact()
+        self.assertFalse(attachments.attach_image(fact, "https://scontent.xx.fbcdn.net/missing.png"))
+        self.assertIsNone(fact.attachment_id)
+
+    def test_only_facebook_cdn_images_are_fetched(self):
+        self.adapter.images["https://scontent.xx.fbcdn.net/moved.png"] = None
+        for url in ["http://scontent.xx.fbcdn.net/image.png", "https://fbcdn.net.attacker.test/image.png",
+                    "https://169.254.169.254/latest/meta-data/", "https://localhost/image.png",
+                    "file:///etc/passwd", "https://scontent.xx.fbcdn.net/moved.png"]:
+            fact = core.Fact()
+            self.assertFalse(attachments.attach_image(fact, url), url)
+            self.assertIsNone(fact.attachment_id)
+        self.assertEqual(self.adapter.fetched, ["https://scontent.xx.fbcdn.net/moved.png"])
+
+    def test_image_fact_is_studied_with_its_attachment(self):
+        self.post("Add a fact", "add_fact")
+        self.assertEqual(self.post("", "add_fact", self.IMAGE_URL),
+                         "Got the image! What's the question that goes with it?")
+        self.post("What is this?", "add_fact")
+        self.post("A test image", "add_fact")
+        fact = studybot.get_user(DUMMY_SENDER_ID).facts[0]
+        self.assertEqual(fact.attachment_id, "attachment.stub.1")
+
+        self.assertEqual(self.post("Study time!", "study_next_fact"), "Ok, let's study!\nWhat is this?")
+        self.send_image.assert_called_once_with(DUMMY_SENDER_ID, "attachment.stub.1", is_response=True)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,282 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import binascii
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+import requests
+
+
+"""
+Lightweight tracing of webhook events.
+
+Tracing is opt-in. When TRACE_PATH or TRACE_OTLP_ENDPOINT is set, every
+webhook event gets a root span, tagged with the sender, intent and
+conversation state, and every SQL statement, Redis round trip and Graph API
+call made while handling it gets a child span. SQL statements are timed
+through SQLAlchemy engine events; Redis and Graph calls through the wrappers
+in budgets.py.
+
+When an event finishes its spans are exported together, either appended to
+TRACE_PATH as JSON lines or sent to an OpenTelemetry collector's OTLP/HTTP
+JSON endpoint (e.g. http://localhost:4318/v1/traces) from a background
+thread. Calls made outside of an event (e.g. by the reminder scheduler) are
+not traced.
+"""
+TRACE_PATH = os.environ.get("TRACE_PATH")
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "studybot")
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get("TRACE_EXPORT_QUEUE_SIZE", 1000))
+
+MAX_STATEMENT_LENGTH = 500
+
+_local = threading.local()
+
+
+def _random_id(num_bytes):
+    return binascii.hexlify(os.urandom(num_bytes)).decode()
+
+
+class Span:
+    """A timed operation within a trace"""
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': (self.end - self.start) * 1000 if self.end is not None else None,
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class FileExporter:
+    """Appends finished traces to a JSON lines file, one span per line"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span.serialize) + "\n" for span in spans)
+        with self.lock:
+            with open(self.path, "a") as trace_file:
+                trace_file.write(lines)
+
+
+class OTLPExporter:
+    """
+    Sends finished traces to an OTLP/HTTP JSON endpoint from a background
+    thread, so a slow collector doesn't hold up webhook responses. Traces are
+    dropped when the queue is full.
+    """
+    def __init__(self, endpoint, service_name=TRACE_SERVICE_NAME, queue_size=TRACE_EXPORT_QUEUE_SIZE,
+                 session=None):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        # Note: A plain session, so exports aren't counted or traced themselves.
+        self.session = requests.Session() if session is None else session
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.worker = threading.Thread(target=self.run, name="trace-exporter")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def export(self, spans):
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            print("ERROR: Trace export queue is full, dropping trace %s" % spans[0].trace_id)
+
+    def run(self):
+        while True:
+            spans = self.queue.get()
+            try:
+                self.session.post(self.endpoint, json=self.encode(spans), timeout=5)
+            except Exception as e:
+                print("ERROR: Failed to export trace to %s" % self.endpoint)
+                print("ERROR: Reason: %s" % str(e))
+
+    def encode(self, spans):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "studybot.tracing"},
+                    "spans": [_otlp_span(span) for span in spans]
+                }]
+            }]
+        }
+
+
+def _otlp_span(span):
+    encoded = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SPAN_KIND_SERVER for events, SPAN_KIND_CLIENT for the calls they make
+        "kind": 2 if span.parent_id is None else 3,
+        "startTimeUnixNano": str(int(span.start * 1e9)),
+        "endTimeUnixNano": str(int(span.end * 1e9)),
+        "attributes": _otlp_attributes(span.attributes)
+    }
+    if span.parent_id is not None:
+        encoded["parentSpanId"] = span.parent_id
+    if span.error is not None:
+        encoded["status"] = {"code": 2, "message": span.error}
+    return encoded
+
+
+def _otlp_attributes(attributes):
+    encoded = []
+    for key, value in sorted(attributes.items()):
+        if isinstance(value, bool):
+            encoded.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            encoded.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            encoded.append({"key": key, "value": {"stringValue": str(value)}})
+    return encoded
+
+
+def exporter_from_env():
+    """Return the exporter configured by the environment, or None"""
+    if TRACE_OTLP_ENDPOINT:
+        print("DEBUG: Exporting traces to %s" % TRACE_OTLP_ENDPOINT)
+        return OTLPExporter(TRACE_OTLP_ENDPOINT)
+    if TRACE_PATH:
+        print("DEBUG: Writing traces to %s" % TRACE_PATH)
+        return FileExporter(TRACE_PATH)
+    return None
+
+
+_exporter = exporter_from_env()
+
+
+def set_exporter(exporter):
+    """Replace the exporter, or turn tracing off with None. Returns the previous one."""
+    global _exporter
+    previous, _exporter = _exporter, exporter
+    return previous
+
+
+#===============================================================================
+# Spans
+#===============================================================================
+def start_span(name, **attributes):
+    """
+    Start a child of the current span. Returns None, and costs nothing else,
+    if no trace is active on this thread.
+    """
+    stack = getattr(_local, "stack", None)
+    if not stack:
+        return None
+    span = Span(name, stack[0].trace_id, stack[-1].span_id, attributes)
+    stack.append(span)
+    return span
+
+
+def end_span(span, error=None):
+    stack = getattr(_local, "stack", None)
+    if span is None or span.end is not None or not stack or span not in stack:
+        return
+    span.end = time.time()
+    if error is not None:
+        span.error = "%s: %s" % (type(error).__name__, error)
+    # Spans normally end in order, but a failed statement may leave one open.
+    while stack and stack[-1] is not span:
+        end_span(stack[-1])
+    stack.pop()
+    _local.finished.append(span)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time the block as a child of the current span, if there is one"""
+    current = start_span(name, **attributes)
+    try:
+        yield current
+    except Exception as e:
+        end_span(current, e)
+        raise
+    else:
+        end_span(current)
+
+
+@contextlib.contextmanager
+def trace(name, **attributes):
+    """
+    Time the block as the root span of a new trace and export the trace when
+    it exits. Does nothing when tracing is off.
+    """
+    exporter = _exporter
+    if exporter is None or getattr(_local, "stack", None):
+        with span(name, **attributes) as current:
+            yield current
+        return
+
+    root = Span(name, _random_id(16), None, attributes)
+    _local.stack = [root]
+    _local.finished = []
+    try:
+        yield root
+    except Exception as e:
+        root.error = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        root.end = time.time()
+        spans = _local.finished + [root]
+        _local.stack = None
+        _local.finished = None
+        try:
+            exporter.export(spans)
+        except Exception as e:
+            print("ERROR: Failed to export trace %s" % root.trace_id)
+            print("ERROR: Reason: %s" % str(e))
+
+
+def set_attribute(key, value):
+    """Tag the root span of the current trace"""
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[0].attributes[key] = value
+
+
+#===============================================================================
+# SQL
+#===============================================================================
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._trace_span = start_span("sql", statement=statement[:MAX_STATEMENT_LENGTH])
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        end_span(getattr(context, "_trace_span", None))
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_statement(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        end_span(getattr(context, "_trace_span", None), exception_context.original_exception)
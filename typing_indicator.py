@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+
+# Weight given to the newest sample when updating the moving averages.
+EWMA_ALPHA = 0.2
+
+# Number of sender actions that used to block every incoming message
+# ("typing_on" before processing and "typing_off" after).
+BLOCKING_ACTIONS_PER_EVENT = 2
+
+
+class _Indicator:
+    def __init__(self, user_id, key):
+        self.user_id = user_id
+        self.key = key
+        self.started = time.time()
+        self.typing_on_sent = False
+        self.typing_on_delivered = False
+        self.reply_sent = False
+        self.finished = False
+
+
+class TypingIndicatorManager:
+    """
+    Sends Messenger typing indicators off the request thread.
+
+    "typing_on" is only sent once an event has been processing for longer than
+    threshold_seconds, or immediately when the moving average for events of the
+    same kind already exceeds the threshold. "typing_off" is skipped whenever a
+    reply was sent, since Messenger clears the indicator on delivery. As
+    "typing_on" is sent asynchronously, it's dropped if the reply went out
+    while it was queued, and followed by "typing_off" if it only got through
+    after the reply (or after the event was handled).
+
+    The delayed "typing_on"s are all scheduled on one thread, started with the
+    first of them, rather than a timer thread per event.
+    """
+    def __init__(self, send_action, threshold_seconds, max_workers=2):
+        self._send_action = send_action
+        self.threshold_seconds = threshold_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._active = {}
+        self._expected_seconds = {}
+        self._graph_latency = None
+        self._scheduled = []
+        self._sequence = itertools.count()
+        self._scheduler = None
+        self._stopping = False
+        self._wakeup = threading.Condition(self._lock)
+
+    def expected_duration(self, key):
+        with self._lock:
+            return self._expected_seconds.get(key, 0.0)
+
+    def graph_latency(self):
+        with self._lock:
+            return self._graph_latency
+
+    def observe_graph_latency(self, seconds):
+        with self._lock:
+            self._graph_latency = _ewma(self._graph_latency, seconds)
+
+    def begin(self, user_id, key):
+        indicator = _Indicator(user_id, key)
+        with self._lock:
+            self._active.setdefault(user_id, []).append(indicator)
+
+        if self.expected_duration(key) >= self.threshold_seconds:
+            self._fire(indicator)
+        else:
+            self._schedule(indicator, indicator.started + self.threshold_seconds)
+        return indicator
+
+    def reply_sent(self, user_id):
+        with self._lock:
+            for indicator in self._active.get(user_id, []):
+                indicator.reply_sent = True
+
+    def end(self, indicator):
+        # Note: A scheduled "typing_on" isn't sent once the indicator is finished.
+        with self._lock:
+            indicator.finished = True
+            active = self._active.get(indicator.user_id, [])
+            if indicator in active:
+                active.remove(indicator)
+            if not active:
+                self._active.pop(indicator.user_id, None)
+            elapsed = time.time() - indicator.started
+            self._expected_seconds[indicator.key] = _ewma(self._expected_seconds.get(indicator.key), elapsed)
+            graph_latency = self._graph_latency
+            # Note: A "typing_on" that is still in flight sends its own "typing_off".
+            send_typing_off = indicator.typing_on_delivered and not indicator.reply_sent
+
+        if send_typing_off:
+            self._submit(False, indicator.user_id)
+            metrics.incr("typing_indicator.typing_off_sent")
+        else:
+            metrics.incr("typing_indicator.typing_off_skipped")
+        if not indicator.typing_on_sent:
+            metrics.incr("typing_indicator.typing_on_skipped")
+
+        # None of the sender actions block the request thread anymore.
+        if graph_latency is not None:
+            metrics.observe("typing_indicator.saved_seconds", BLOCKING_ACTIONS_PER_EVENT * graph_latency)
+
+    def shutdown(self):
+        with self._lock:
+            self._stopping = True
+            scheduler = self._scheduler
+            self._wakeup.notify()
+        if scheduler:
+            scheduler.join()
+        self._executor.shutdown(wait=True)
+
+    def _schedule(self, indicator, deadline):
+        with self._lock:
+            if self._stopping:
+                return
+            heapq.heappush(self._scheduled, (deadline, next(self._sequence), indicator))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._run_scheduler, name="typing-indicator-scheduler")
+                self._scheduler.daemon = True
+                self._scheduler.start()
+            self._wakeup.notify()
+
+    def _run_scheduler(self):
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    if self._scheduled:
+                        delay = self._scheduled[0][0] - time.time()
+                        if delay <= 0:
+                            break
+                        self._wakeup.wait(delay)
+                    else:
+                        self._wakeup.wait()
+                if self._stopping:
+                    return
+                deadline, _, indicator = heapq.heappop(self._scheduled)
+            self._fire(indicator)
+
+    def _fire(self, indicator):
+        with self._lock:
+            if indicator.finished:
+                return
+            indicator.typing_on_sent = True
+        self._executor.submit(self._send_typing_on, indicator)
+
+    def _send_typing_on(self, indicator):
+        with self._lock:
+            if indicator.reply_sent:
+                metrics.incr("typing_indicator.typing_on_skipped")
+                return
+        self._send(True, indicator.user_id)
+        metrics.incr("typing_indicator.typing_on_sent")
+
+        with self._lock:
+            indicator.typing_on_delivered = True
+            late = indicator.reply_sent or indicator.finished
+        if late:
+            # It may have arrived after the reply, which would leave it on.
+            self._send(False, indicator.user_id)
+            metrics.incr("typing_indicator.typing_off_sent")
+
+    def _submit(self, enabled, user_id):
+        self._executor.submit(self._send, enabled, user_id)
+
+    def _send(self, enabled, user_id):
+        start = time.time()
+        try:
+            self._send_action(enabled, user_id)
+        except Exception as e:
+            print("ERROR: Failed to change typing indicator for %s" % user_id)
+            print("ERROR: Reason: %s" % str(e))
+            return
+        latency = time.time() - start
+        self.observe_graph_latency(latency)
+        metrics.observe("graph.sender_action_seconds", latency)
+
+
+def _ewma(previous, sample):
+    if previous is None:
+        return sample
+    return (EWMA_ALPHA * sample) + ((1 - EWMA_ALPHA) * previous)
@@ -0,0 +1,103 @@
+from sqlalchemy import text
+
+import importlib
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import core
+import graph_delivery
+import intent_classifier
+import metrics
+
+
+"""
+Per-worker warm-up.
+
+Runs once in every gunicorn worker after it has loaded the app (see
+gunicorn_config.py) so the first real requests don't pay for connecting to
+Postgres and Redis, the TLS handshake with the Graph API, lazy imports or
+training the local intent classifier.
+
+The worker reports ready (see /ready) once the steps it can't serve requests
+without have succeeded. A failed Graph API step only makes the first replies
+slower, so the worker is ready but reported as degraded.
+"""
+# Modules that are otherwise only imported on the first request that needs them.
+LAZY_IMPORTS = ["random", "redis", "psutil"]
+
+# Number of pooled database connections to open and validate.
+WARMUP_DB_CONNECTIONS = int(os.environ.get("WARMUP_DB_CONNECTIONS", 2))
+
+GRAPH_API_HOST = "%s://%s/" % urlsplit(core.GRAPH_API_URL)[:2]
+
+# Steps that may fail without keeping the worker from being ready.
+OPTIONAL_STEPS = ("graph_api",)
+
+_ready = threading.Event()
+_status = {}
+
+
+def warm_up():
+    steps = [
+        ("imports", import_lazy_modules),
+        ("intent_classifier", intent_classifier.get_classifier),
+        ("database", warm_database),
+        ("redis", warm_redis),
+        ("graph_api", warm_graph_api)
+    ]
+    for name, step in steps:
+        start = time.time()
+        try:
+            step()
+            _status[name] = "ok"
+        except Exception as e:
+            print("ERROR: Warm-up step %s failed" % name)
+            print("ERROR: Reason: %s" % str(e))
+            _status[name] = "degraded" if name in OPTIONAL_STEPS else "failed"
+        elapsed = time.time() - start
+        metrics.observe("warmup.%s_seconds" % name, elapsed)
+        print("DEBUG: Warm-up step %s took %.3f seconds." % (name, elapsed))
+
+    failed = [name for name, result in _status.items() if result == "failed"]
+    if failed:
+        print("ERROR: Worker not ready, warm-up failed: %s" % ", ".join(failed))
+        return
+    degraded = [name for name, result in _status.items() if result == "degraded"]
+    if degraded:
+        print("ERROR: Worker ready but degraded: %s" % ", ".join(degraded))
+    _ready.set()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def status():
+    return dict(_status)
+
+
+def import_lazy_modules():
+    for module in LAZY_IMPORTS:
+        importlib.import_module(module)
+
+
+def warm_database():
+    connections = [core.db.engine.connect() for i in range(WARMUP_DB_CONNECTIONS)]
+    try:
+        for connection in connections:
+            connection.execute(text("SELECT 1"))
+    finally:
+        # Closing returns the validated connections to the pool.
+        for connection in connections:
+            connection.close()
+
+
+def warm_redis():
+    core.cache.ping()
+
+
+def warm_graph_api():
+    # Any response will do, this only opens a keep-alive TLS connection.
+    graph_delivery.request(core.graph_session, "HEAD", GRAPH_API_HOST)
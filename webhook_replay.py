@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request
+
+import argparse
+import copy
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import requests
+
+
+"""
+Record and replay production webhook traffic.
+
+Recording is opt-in. When WEBHOOK_RECORD_PATH is set, the webhook appends a
+sample of the payloads it receives (WEBHOOK_RECORD_SAMPLE_RATE of them) to
+that file as JSON lines, with the time they were received. Payloads are
+anonymized first:
+- sender ids are replaced by a salted hash (the same user keeps the same id);
+  WEBHOOK_RECORD_SALT must be set to a long random secret, since numeric ids
+  could be recovered from an unsalted hash by trying them all
+- letters in message text are masked, keeping length, digits and punctuation
+- only the intent, greetings and duration NLP entities are kept
+
+To replay a recording against a local instance with a stubbed Graph API:
+
+    python webhook_replay.py graph-stub --port 5001
+    GRAPH_API_URL=http://localhost:5001/ PAGE_ACCESS_TOKEN=stub python studybot.py
+    python webhook_replay.py replay recording.jsonl --url http://localhost:5000/ --speed 2
+"""
+RECORD_PATH = os.environ.get("WEBHOOK_RECORD_PATH")
+RECORD_SAMPLE_RATE = float(os.environ.get("WEBHOOK_RECORD_SAMPLE_RATE", 0.01))
+RECORD_SALT = os.environ.get("WEBHOOK_RECORD_SALT")
+
+RECORDED_ENTITIES = ("intent", "greetings", "duration")
+
+_LETTERS = re.compile(r"[^\W\d_]", re.UNICODE)
+
+
+class Recorder:
+    """Appends a sample of anonymized webhook payloads to a JSON lines file"""
+    def __init__(self, path, sample_rate, salt, rand=random.random):
+        if not salt:
+            raise ValueError("recording needs a salt to anonymize sender ids")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.salt = salt
+        self.rand = rand
+        self.lock = threading.Lock()
+
+    def record(self, payload, received_at=None):
+        if self.rand() >= self.sample_rate:
+            return False
+        received_at = time.time() if received_at is None else received_at
+        line = json.dumps({"received_at": received_at, "payload": anonymize(payload, self.salt)})
+        with self.lock:
+            with open(self.path, "a") as recording:
+                recording.write(line + "\n")
+        return True
+
+
+def recorder_from_env():
+    """Return a Recorder if recording is turned on, otherwise None"""
+    if not RECORD_PATH:
+        return None
+    if not RECORD_SALT:
+        print("ERROR: Not recording webhook payloads, WEBHOOK_RECORD_SALT isn't set")
+        return None
+    print("DEBUG: Recording %.1f%% of webhook payloads to %s" % (RECORD_SAMPLE_RATE * 100, RECORD_PATH))
+    return Recorder(RECORD_PATH, RECORD_SAMPLE_RATE, RECORD_SALT)
+
+
+def anonymize(payload, salt):
+    payload = copy.deepcopy(payload)
+    for entry in payload.get("entry", []):
+        for messaging_event in entry.get("messaging", []):
+            sender = messaging_event.get("sender")
+            if sender and "id" in sender:
+                sender["id"] = anonymize_id(sender["id"], salt)
+            message = messaging_event.get("message")
+            if message:
+                _anonymize_message(message, salt)
+    return payload
+
+
+def anonymize_id(user_id, salt):
+    digest = hashlib.sha256((salt + str(user_id)).encode()).hexdigest()
+    return str(int(digest[:15], 16))
+
+
+def anonymize_text(text):
+    return _LETTERS.sub("x", text)
+
+
+def _anonymize_message(message, salt):
+    if "mid" in message:
+        message["mid"] = "mid." + anonymize_id(message["mid"], salt)
+    if "text" in message:
+        message["text"] = anonymize_text(message["text"])
+    if "attachments" in message:
+        message["attachments"] = [{"type": attachment.get("type")} for attachment in message["attachments"]]
+    nlp = message.get("nlp")
+    if nlp and nlp.get("entities"):
+        nlp["entities"] = dict((name, value) for name, value in nlp["entities"].items()
+                               if name in RECORDED_ENTITIES)
+
+
+#===============================================================================
+# Replay
+#===============================================================================
+def load_recording(path):
+    """Yield (received_at, payload) for every recorded payload, in order"""
+    with open(path) as recording:
+        for line in recording:
+            if line.strip():
+                record = json.loads(line)
+                yield record["received_at"], record["payload"]
+
+
+def replay(records, url, speed=1.0, concurrency=8, session=None, clock=time.time, sleep=time.sleep):
+    """
+    POST the recorded payloads to url, keeping their original spacing divided
+    by speed (0 sends them back to back). Requests are sent from a pool of
+    concurrency threads so a slow instance doesn't stretch the load shape.
+    Returns the number of payloads sent, failed and the worst lateness in
+    seconds.
+    """
+    session = requests.Session() if session is None else session
+    stats = {"sent": 0, "failed": 0, "max_lateness": 0.0}
+    lock = threading.Lock()
+
+    def post(payload):
+        try:
+            response = session.post(url, json=payload)
+            ok = response.status_code == 200
+        except Exception as e:
+            print("ERROR: Failed to replay payload: %s" % str(e))
+            ok = False
+        with lock:
+            stats["sent" if ok else "failed"] += 1
+
+    start = clock()
+    first_received_at = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for received_at, payload in records:
+            if first_received_at is None:
+                first_received_at = received_at
+            if speed:
+                delay = start + (received_at - first_received_at) / speed - clock()
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    stats["max_lateness"] = max(stats["max_lateness"], -delay)
+            executor.submit(post, payload)
+    return stats
+
+
+#===============================================================================
+# Graph API stub
+#===============================================================================
+def create_graph_stub(latency_seconds=0.0):
+    """
+    Return a Flask app that accepts the Graph API calls StudyBot makes and
+    answers them after latency_seconds.
+    """
+    app = Flask(__name__)
+    message_ids = itertools.count(1)
+    attachment_ids = itertools.count(1)
+
+    @app.route('/', methods=['GET', 'HEAD'])
+    def handle_root():
+        return ("ok", 200)
+
+    @app.route('/me/messages', methods=['POST'])
+    def handle_send():
+        time.sleep(latency_seconds)
+        data = json.loads(request.get_data(as_text=True))
+        response = {"recipient_id": data["recipient"]["id"]}
+        if "message" in data:
+            response["message_id"] = "mid.stub.%d" % next(message_ids)
+        return (json.dumps(response), 200, {'Content-type': 'application/json'})
+
+    @app.route('/me/message_attachments', methods=['POST'])
+    def handle_attachment_upload():
+        time.sleep(latency_seconds)
+        if "filedata" not in request.files or "message" not in request.form:
+            return (json.dumps({"error": {"message": "filedata and message are required"}}), 400,
+                    {'Content-type': 'application/json'})
+        response = {"attachment_id": "attachment.stub.%d" % next(attachment_ids)}
+        return (json.dumps(response), 200, {'Content-type': 'application/json'})
+
+    @app.route('/<user_id>', methods=['GET'])
+    def handle_user_profile(user_id):
+        time.sleep(latency_seconds)
+        return (json.dumps({"first_name": "Replay", "id": user_id}), 200, {'Content-type': 'application/json'})
+
+    return app
+
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded StudyBot webhook traffic.")
+    commands = parser.add_subparsers(dest="command")
+
+    replay_parser = commands.add_parser("replay", help="send a recording to a local instance")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--url", default="http://localhost:5000/")
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="replay N times faster than recorded, 0 for no delays")
+    replay_parser.add_argument("--concurrency", type=int, default=8)
+
+    stub_parser = commands.add_parser("graph-stub", help="serve a stub of the Graph API")
+    stub_parser.add_argument("--port", type=int, default=5001)
+    stub_parser.add_argument("--latency-ms", type=float, default=0)
+
+    args = parser.parse_args()
+    if args.command == "replay":
+        start = time.time()
+        stats = replay(load_recording(args.recording), args.url, args.speed, args.concurrency)
+        print("DEBUG: Replayed %d payloads (%d failed) in %.1f seconds, at most %.3f seconds late." %
+              (stats["sent"], stats["failed"], time.time() - start, stats["max_lateness"]))
+    elif args.command == "graph-stub":
+        create_graph_stub(args.latency_ms / 1000.0).run(port=args.port, threaded=True)
+    else:
+        parser.print_help()